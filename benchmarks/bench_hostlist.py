@@ -0,0 +1,48 @@
+"""Microbenchmark of milatools.cli.hostlist on large node lists.
+
+Expands, counts and compresses a host list of 10k nodes spread over a few
+prefixes, with holes in the ranges like a real squeue output.
+
+Usage: python benchmarks/bench_hostlist.py [number of nodes]
+"""
+
+import random
+import sys
+import time
+
+from milatools.cli.hostlist import Hostlist, compress, count, expand, first
+
+
+def make_names(nnodes):
+    rng = random.Random(0)
+    names = []
+    for prefix in ["cn-a", "cn-b", "cn-c", "cn-d"]:
+        names += [f"{prefix}{i:05d}" for i in range(nnodes // 4) if rng.random() < 0.9]
+    return names
+
+
+def bench(name, fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<24}{best * 1000:>10.3f} ms")
+    return result
+
+
+def main():
+    nnodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    names = make_names(nnodes)
+    compact = bench("compress", lambda: compress(names))
+    expanded = bench("expand", lambda: list(expand(compact)))
+    assert expanded == sorted(names)
+    bench("count", lambda: count(compact))
+    bench("first", lambda: first(compact))
+    half = Hostlist(names[::2])
+    bench("difference", lambda: str(Hostlist(compact) - half))
+    print(f"{len(names)} nodes, {len(compact)} characters compressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Microbenchmark of the PatternMatcher used by Remote.extract.
+
+Matches the patterns used by mila serve against synthetic server logs where
+the interesting lines only come at the very end, and compares with the
+pattern-by-pattern search of milatools <= 0.0.18.
+
+Usage: python benchmarks/bench_matcher.py [number of lines]
+"""
+
+import random
+import re
+import sys
+import time
+
+from milatools.cli.matcher import PatternMatcher
+
+patterns = {
+    "node_name": "#### ([A-Za-z0-9_-]+)",
+    "port": "Listening at: http://[^:]+:([0-9]+)",
+    "token": r"\?token=([a-f0-9]+)",
+}
+
+noise = [
+    "[I 2023-03-01 12:00:00.000 ServerApp] Writing Jupyter server cookie secret",
+    "2023/03/01 12:00:00 INFO mlflow.store.db.utils: Updating database tables",
+    "INFO  [alembic.runtime.migration] Running upgrade 0a8213491aaa -> 728d730b5ebd",
+    "Loading checkpoint shards:  42%|████▎     | 5/12 [00:04<00:06,  1.03it/s]",
+    "W0301 12:00:00.000000 140000000000000 plugin_event_multiplexer.py:267]",
+]
+
+
+def make_log(nlines):
+    rng = random.Random(0)
+    lines = ["Submitted batch job 1234567", "#### cn-a001"]
+    lines += [rng.choice(noise) for _ in range(nlines)]
+    lines += [
+        "[I ServerApp] http://localhost:8888/lab?token=0123456789abcdef",
+        "[INFO] Listening at: http://127.0.0.1:5000 (12345)",
+    ]
+    return lines
+
+
+def old_extract(lines):
+    remaining = dict(patterns)
+    results = {}
+    for line in lines:
+        for name, patt in list(remaining.items()):
+            m = re.search(patt, line)
+            if m:
+                results[name] = m.groups()[0]
+                remaining.pop(name)
+        m = re.search("^Submitted batch job ([0-9]+)", line)
+        if m:
+            results["batch_id"] = m.groups()[0]
+    return results
+
+
+def new_extract(lines):
+    matcher = PatternMatcher({**patterns, "batch_id": "^Submitted batch job ([0-9]+)"})
+    for line in lines:
+        matcher.feed(line)
+    return matcher.results
+
+
+def main():
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    lines = make_log(nlines)
+    expected = None
+    for name, fn in [
+        ("pattern by pattern", old_extract),
+        ("PatternMatcher", new_extract),
+    ]:
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            results = fn(lines)
+            best = min(best, time.perf_counter() - start)
+        expected = expected or results
+        assert results == expected, (results, expected)
+        rate = len(lines) / best / 1e6
+        print(f"{name:<20}{best:>8.3f} s{rate:>8.2f} M lines/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Benchmark of the StreamReader used by Remote.extract.
+
+Feeds megabytes of synthetic command output to the reader from another
+thread, the way Fabric's IO threads do, and reports the throughput. The
+QueueIO implementation from milatools <= 0.0.18 is included for comparison.
+
+Usage: python benchmarks/bench_stream.py [megabytes]
+"""
+
+import sys
+import threading
+import time
+from queue import Empty, Queue
+
+from milatools.cli.remote import StreamReader
+
+
+class OldQueueIO:
+    def __init__(self):
+        self.q = Queue()
+
+    def write(self, s):
+        self.q.put(s)
+
+    def readlines(self, stop):
+        current = ""
+        lines = tuple()
+        while True:
+            try:
+                current += self.q.get(timeout=0.05)
+                if "\n" in current:
+                    *lines, current = current.split("\n")
+                for line in lines:
+                    yield f"{line}\n"
+                lines = ()
+            except Empty:
+                if stop():
+                    if current:
+                        yield current
+                    return
+
+
+def make_output(kind, size):
+    if kind == "lines":
+        unit = "INFO some server log line with a bit of text in it\n"
+    elif kind == "progress":
+        unit = "Loading:  42%|████▎     | 420/1000 [00:04<00:06, 97.3it/s]\r"
+    else:
+        unit = "x" * 64
+    return unit * (size // len(unit.encode("utf8")))
+
+
+def bench(reader_class, output, chunk_size=4096):
+    reader = reader_class()
+    done = threading.Event()
+
+    def writer():
+        for i in range(0, len(output), chunk_size):
+            reader.write(output[i : i + chunk_size])
+        done.set()
+        if hasattr(reader, "close"):
+            # Wakes up StreamReader.readlines right away
+            reader.close()
+
+    start = time.perf_counter()
+    threading.Thread(target=writer).start()
+    nlines = sum(1 for _ in reader.readlines(done.is_set))
+    return time.perf_counter() - start, nlines
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size = int(megabytes * 1024 * 1024)
+    print(f"{'output':<12}{'reader':<14}{'time (s)':>10}{'MB/s':>10}{'lines':>10}")
+    for kind in ["lines", "progress", "unbroken"]:
+        output = make_output(kind, size)
+        for name, cls in [("StreamReader", StreamReader), ("old QueueIO", OldQueueIO)]:
+            if cls is OldQueueIO and kind != "lines" and megabytes > 1:
+                # Quadratic, this would take forever
+                print(f"{kind:<12}{name:<14}{'skipped':>10}")
+                continue
+            elapsed, nlines = bench(cls, output)
+            mbs = megabytes / elapsed
+            print(f"{kind:<12}{name:<14}{elapsed:>10.3f}{mbs:>10.1f}{nlines:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""Asyncio counterparts of Remote and SlurmRemote.
+
+Fabric and paramiko are blocking, so the commands themselves still run on
+the shared channel pool, but their output is delivered to the event loop.
+This lets a single loop drive several allocations, log streams and tunnels
+at once, and Ctrl+C cancels whatever is pending right away.
+"""
+
+import asyncio
+import contextvars
+import threading
+from collections import deque
+from functools import partial
+
+from .remote import (
+    PatternMatcher,
+    SlurmRemote,
+    StreamReader,
+    batch_id_pattern,
+    channel_pool,
+    persist_command,
+    persist_patterns,
+    salloc_patterns,
+)
+from .trace import span
+
+
+async def to_thread(fn, *args, **kwargs):
+    """Call a blocking function on the channel pool and await its result.
+
+    The function sees the context variables of the caller, e.g. cache_enabled.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        channel_pool(), partial(context.run, fn, *args, **kwargs)
+    )
+
+
+class LineStream:
+    """Async iterator over the lines output by a command started on a Remote.
+
+    The output is written by Fabric's IO threads and handed over to the event
+    loop, where it is split into lines. Lines that contain one of the patterns
+    are recorded in ``results``, along with the id of a batch job submitted by
+    the command, under ``batch_id``.
+    """
+
+    def __init__(self, remote, cmd, patterns={}, **kwargs):
+        self.remote = remote
+        self.loop = asyncio.get_running_loop()
+        self.reader = StreamReader()
+        self.lines = deque()
+        self.ready = asyncio.Event()
+        self.finished = False
+        self.detached = False
+        self.patterns = patterns
+        self.matcher = PatternMatcher({**patterns, "batch_id": batch_id_pattern})
+        self.results = self.matcher.results
+        kwargs.setdefault("pty", True)
+        kwargs.setdefault("in_stream", False)
+        self.promise = remote.run(cmd, asynchronous=True, out_stream=self, **kwargs)
+        self.runner = self.promise.runner
+        self.waiter = self.loop.create_future()
+        # Not in the loop's executor: asyncio.run() waits for its threads, and
+        # some commands (salloc) outlive the loop.
+        threading.Thread(target=self._join, daemon=True).start()
+
+    # Called from other threads
+
+    def _join(self):
+        try:
+            result, exc = self.promise.join(), None
+        except BaseException as e:
+            result, exc = None, e
+        try:
+            self.loop.call_soon_threadsafe(self._finish, result, exc)
+        except RuntimeError:
+            # The event loop is closed, nobody is waiting anymore
+            pass
+
+    def write(self, data):
+        self.loop.call_soon_threadsafe(self._feed, data)
+
+    def flush(self):
+        pass
+
+    # Called in the event loop
+
+    def _feed(self, data):
+        if self.detached:
+            return
+        self.reader.write(data)
+        self.lines.extend(self.reader.take_lines(final=False))
+        self.ready.set()
+
+    def _finish(self, result, exc):
+        # Output written before the command ended was scheduled before this
+        if exc is None:
+            self.waiter.set_result(result)
+        else:
+            self.waiter.set_exception(exc)
+            # Only raise it if someone calls wait()
+            self.waiter.exception()
+        if not self.detached:
+            self.lines.extend(self.reader.take_lines(final=True))
+        self.finished = True
+        self.ready.set()
+
+    @property
+    def done(self):
+        """Whether all the patterns were found."""
+        return all(name in self.results for name in self.patterns)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.lines:
+            if self.finished:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+        line = self.lines.popleft()
+        self.matcher.feed(line)
+        return line
+
+    def detach(self):
+        """Stop reading the output. The command keeps running."""
+        self.detached = True
+        self.lines.clear()
+
+    async def wait(self):
+        """Wait for the command to end and return its result."""
+        return await asyncio.shield(self.waiter)
+
+    def kill(self):
+        """Kill the command."""
+        self.detach()
+        if not self.runner.process_is_finished:
+            self.runner.kill()
+
+    async def cancel(self):
+        """Kill the command, and cancel the batch job it submitted, if any."""
+        self.kill()
+        if "batch_id" in self.results:
+            # Cancel the job so that it doesn't clutter the user's squeue
+            await to_thread(
+                self.remote.simple_run, f"scancel {self.results['batch_id']}"
+            )
+
+
+class AsyncRemote:
+    """Wraps a Remote so that its methods can be awaited."""
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    @property
+    def hostname(self):
+        return self.remote.hostname
+
+    @property
+    def connection(self):
+        return self.remote.connection
+
+    @property
+    def jobid(self):
+        return self.remote.jobid
+
+    def with_transforms(self, *transforms):
+        return asyncify(self.remote.with_transforms(*transforms))
+
+    def with_precommand(self, precommand):
+        return asyncify(self.remote.with_precommand(precommand))
+
+    def with_profile(self, profile):
+        return asyncify(self.remote.with_profile(profile))
+
+    def with_bash(self):
+        return asyncify(self.remote.with_bash())
+
+    def persist(self):
+        return asyncify(self.remote.persist())
+
+    async def run(self, cmd, **kwargs):
+        kwargs.setdefault("in_stream", False)
+        return await to_thread(self.remote.run, cmd, **kwargs)
+
+    async def simple_run(self, cmd, **kwargs):
+        return await self.run(cmd, hide=True, **kwargs)
+
+    async def get_output(self, cmd, **kwargs):
+        return (await self.run(cmd, **kwargs)).stdout.strip()
+
+    async def get_lines(self, cmd, **kwargs):
+        return (await self.get_output(cmd, **kwargs)).split()
+
+    async def put(self, src, dest):
+        return await to_thread(self.remote.put, src, dest)
+
+    async def get(self, src, dest):
+        return await to_thread(self.remote.get, src, dest)
+
+    async def home(self):
+        return await to_thread(self.remote.home)
+
+    def lines(self, cmd, patterns={}, display=True, **kwargs):
+        """Start cmd and return a LineStream over its output."""
+        # invoke does not write hidden output to the stream
+        return LineStream(
+            self.remote, cmd, patterns, display=display, hide=False, **kwargs
+        )
+
+    async def extract(self, cmd, patterns, wait=False, **kwargs):
+        """Print the output of cmd until all the patterns are found.
+
+        Returns the LineStream, which can be used to wait for or to kill the
+        command, and the results. If the extraction is cancelled, the command
+        is killed.
+        """
+        hide = kwargs.pop("hide", False)
+        with span(
+            "extract", self.remote.host, command=cmd, patterns=list(patterns)
+        ) as s:
+            stream = self.lines(cmd, patterns, display=not hide, **kwargs)
+            try:
+                async for line in stream:
+                    if not hide:
+                        print(line, end="")
+                    if patterns and not wait and stream.done:
+                        stream.detach()
+                        break
+                else:
+                    await stream.wait()
+            except BaseException:
+                await stream.cancel()
+                raise
+            s.set(found=sorted(stream.results))
+        return stream, stream.results
+
+    async def ensure_allocation(self):
+        return {"node_name": self.hostname}, None
+
+
+class AsyncSlurmRemote(AsyncRemote):
+    async def ensure_allocation(self):
+        if self.remote.jobid is not None:
+            return await to_thread(self.remote.ensure_allocation)
+        elif self.remote._persist:
+            stream, results = await self.extract(
+                persist_command, patterns=persist_patterns, hide=True
+            )
+            return self.remote._persist_allocation(results), stream.runner
+        else:
+            salloc = AsyncRemote(self.remote._salloc_remote())
+            stream, results = await salloc.extract(
+                self.remote._salloc_command(), patterns=salloc_patterns
+            )
+            data = await to_thread(self.remote._salloc_allocation, results)
+            return data, stream.runner
+
+
+def asyncify(remote):
+    """Return the async counterpart of a Remote or SlurmRemote."""
+    if isinstance(remote, SlurmRemote):
+        return AsyncSlurmRemote(remote)
+    return AsyncRemote(remote)
+
+
+async def _probe(host, port, path=None):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        if path is None:
+            return True
+        request = f"HEAD {path} HTTP/1.0\r\nHost: {host}:{port}\r\n\r\n"
+        writer.write(request.encode("utf8"))
+        await writer.drain()
+        # A tunnel accepts the connection even if nothing listens on the other
+        # side, so we need an actual response to know that the app is up.
+        status = (await reader.readline()).split()
+    finally:
+        writer.close()
+    return (
+        len(status) >= 2
+        and status[0].startswith(b"HTTP/")
+        and status[1].isdigit()
+        and int(status[1]) < 500
+    )
+
+
+async def wait_until_ready(
+    host, port, path=None, timeout=10, initial_delay=0.05, max_delay=1.0
+):
+    """Wait until host:port accepts connections.
+
+    If path is given, also wait until a HEAD request for it gets an HTTP
+    response that is not a server error. The probe is retried with an
+    exponential backoff. Returns the number of seconds it took, or None if
+    it timed out.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start + timeout
+    delay = initial_delay
+    while True:
+        try:
+            ready = await asyncio.wait_for(
+                _probe(host, port, path), deadline - loop.time()
+            )
+        except (OSError, asyncio.TimeoutError):
+            ready = False
+        if ready:
+            return loop.time() - start
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+async def wait_first(*aws):
+    """Wait until one of the awaitables completes and cancel the others.
+
+    Returns the index of the first one to complete. Its exception, if it
+    raised one, is not propagated.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+    for task in done:
+        if not task.cancelled():
+            task.exception()
+    return min(tasks.index(task) for task in done)
+
+
+async def wait_closed(forwarder):
+    """Wait until a tunnel.Forwarder is closed."""
+    loop = asyncio.get_running_loop()
+    closed = loop.create_future()
+
+    def done():
+        try:
+            loop.call_soon_threadsafe(lambda: closed.done() or closed.set_result(None))
+        except RuntimeError:
+            # The event loop is closed
+            pass
+
+    forwarder.add_done_callback(done)
+    await closed
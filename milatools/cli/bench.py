@@ -0,0 +1,227 @@
+"""End-to-end benchmark of the operations that mila commands perform.
+
+Each phase uses the same Remote, SlurmRemote and Forwarder objects as the
+commands do, is repeated several times, and is summarized with percentiles.
+The results are saved as JSON so that runs can be compared over time.
+"""
+
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from fabric import Connection
+
+from ..version import version as mversion
+from .cache import cache_dir
+from .remote import Remote, SlurmRemote
+from .tunnel import open_forwarder
+from .utils import shjoin
+
+bench_dir = ".milatools/bench"
+
+# Serves count connections on a port of the remote host, sending size MiB on each
+sink_server = """\
+import socket, sys
+count, size = int(sys.argv[1]), int(sys.argv[2])
+s = socket.socket()
+s.bind(("localhost", 0))
+s.listen(1)
+print("port", s.getsockname()[1], flush=True)
+data = b"x" * (1 << 20)
+for _ in range(count):
+    c, _ = s.accept()
+    for _ in range(size):
+        c.sendall(data)
+    c.close()
+"""
+
+
+def percentile(samples, q):
+    """Return the qth percentile of samples, interpolating between values.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2.5
+    >>> percentile([5, 1, 3], 75)
+    4.0
+    >>> percentile([7.5], 99)
+    7.5
+    """
+    values = sorted(samples)
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def summarize(samples, unit):
+    """Return the percentiles of samples, along with the samples themselves."""
+    return {
+        "unit": unit,
+        "n": len(samples),
+        "min": min(samples),
+        "p50": percentile(samples, 50),
+        "p90": percentile(samples, 90),
+        "p99": percentile(samples, 99),
+        "max": max(samples),
+        "mean": sum(samples) / len(samples),
+        "samples": samples,
+    }
+
+
+def timed(fn, repeat):
+    """Call fn() repeat times and return the time each call took."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class Benchmark:
+    """Measure the phases of the mila commands on a host.
+
+    Each method measures one or a few phases and adds them to results.
+    """
+
+    def __init__(self, host="mila", repeat=5, out=sys.stdout):
+        self.host = host
+        self.repeat = repeat
+        self.out = out
+        self.results = {}
+
+    def record(self, phase, samples, unit="s"):
+        self.results[phase] = summary = summarize(samples, unit)
+        print(
+            f"    {phase:20} : p50 {summary['p50']:10.3f} {unit:5}"
+            f" p90 {summary['p90']:10.3f} {unit:5}"
+            f" (min {summary['min']:.3f}, max {summary['max']:.3f})",
+            file=self.out,
+        )
+        return summary
+
+    def connect(self):
+        """SSH handshake and authentication, as done by Remote without the daemon."""
+
+        def connect():
+            connection = Connection(self.host)
+            connection.open()
+            connection.close()
+
+        self.record("connect", timed(connect, self.repeat))
+
+    def login(self, remote):
+        """Round trip for a command that does nothing, and the Slurm queries."""
+        self.record("noop", timed(lambda: remote.simple_run("true"), self.repeat))
+        self.record(
+            "squeue",
+            timed(lambda: remote.simple_run("squeue --me -h"), self.repeat),
+        )
+        self.record(
+            "sinfo",
+            timed(lambda: remote.simple_run("sinfo -h -o %P"), self.repeat),
+        )
+
+    def allocation(self, remote, alloc):
+        """Time to get an allocation with salloc, then to launch srun steps."""
+        salloc = Remote(hostname="->", connection=remote.connection).with_bash()
+        start = time.perf_counter()
+        proc, results = salloc.extract(
+            shjoin(["salloc", "-J", "mila-bench", *alloc]),
+            patterns={
+                "jobid": "salloc: Granted job allocation ([0-9]+)",
+            },
+            hide=True,
+        )
+        self.record("salloc", [time.perf_counter() - start])
+        try:
+            cnode = SlurmRemote(
+                connection=remote.connection, alloc=[], jobid=results["jobid"]
+            )
+            self.record(
+                "srun",
+                timed(lambda: cnode.run("true", hide=True), self.repeat),
+            )
+        finally:
+            proc.kill()
+
+    def transfer(self, remote, size):
+        """Throughput of SFTP uploads and downloads of size MiB."""
+        nbytes = size << 20
+        dest = f"{bench_dir}/transfer-{time.time_ns()}"
+        remote.simple_run(f"mkdir -p {bench_dir}")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, "data")
+            with open(src, "wb") as f:
+                f.write(os.urandom(nbytes))
+            try:
+                puts = timed(lambda: remote.put(src, dest), self.repeat)
+                back = os.path.join(tmpdir, "back")
+                gets = timed(lambda: remote.get(dest, back), self.repeat)
+            finally:
+                remote.simple_run(f"rm -f {dest}")
+        self.record("put", [size / t for t in puts], unit="MiB/s")
+        self.record("get", [size / t for t in gets], unit="MiB/s")
+
+    def tunnel(self, remote, size):
+        """Throughput of a forwarded port, reading size MiB from a remote server."""
+        proc, results = remote.extract(
+            shjoin(["python3", "-c", sink_server, str(self.repeat), str(size)]),
+            patterns={"port": "port ([0-9]+)"},
+            hide=True,
+        )
+        forwarder = open_forwarder(self.host, remote.connection)
+        try:
+            port = forwarder.forward(("localhost", int(results["port"])))
+
+            def read():
+                received = 0
+                with socket.create_connection(("localhost", port)) as sock:
+                    while True:
+                        chunk = sock.recv(1 << 20)
+                        if not chunk:
+                            break
+                        received += len(chunk)
+                if received != size << 20:
+                    raise OSError(f"Received {received} bytes instead of {size} MiB")
+
+            times = timed(read, self.repeat)
+        finally:
+            forwarder.close()
+            proc.kill()
+        self.record("tunnel", [size / t for t in times], unit="MiB/s")
+
+    def run(self, alloc=None, size=16):
+        """Measure all the phases. No allocation is made if alloc is None."""
+        print(f"Benchmarking {self.host} ({self.repeat} repetitions)", file=self.out)
+        self.connect()
+        remote = Remote(self.host)
+        self.login(remote)
+        if alloc is not None:
+            self.allocation(remote, alloc)
+        self.transfer(remote, size)
+        self.tunnel(remote, size)
+        return self.results
+
+    def report(self):
+        return {
+            "version": mversion,
+            "host": self.host,
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "repeat": self.repeat,
+            "phases": self.results,
+        }
+
+    def save(self, path=None):
+        """Write the results as JSON, by default in ~/.cache/milatools/bench."""
+        if path is None:
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            path = cache_dir() / "bench" / f"{self.host}-{stamp}.json"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return path
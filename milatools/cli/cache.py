@@ -0,0 +1,88 @@
+"""Local cache of facts about remote hosts that rarely change."""
+
+import contextvars
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+# Set to False to bypass the cache (--no-cache)
+cache_enabled = contextvars.ContextVar("cache_enabled", default=True)
+
+# Default time-to-live of cache entries, in seconds
+default_ttl = 24 * 3600
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or "~/.cache"
+    return Path(base).expanduser() / "milatools"
+
+
+class RemoteCache:
+    """Cache of facts about a host, stored as JSON in ~/.cache/milatools.
+
+    Each entry records the time at which it was stored, and is ignored once
+    it is older than the ttl given to get().
+    """
+
+    def __init__(self, host, user, path=None):
+        self.host = host
+        self.user = user
+        self.path = Path(path or cache_dir() / f"{user}@{host}.json")
+
+    @property
+    def enabled(self):
+        return cache_enabled.get() and not os.environ.get("MILATOOLS_NO_CACHE")
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename it so that concurrent mila
+        # commands never see a partially written cache.
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def get(self, key, ttl=default_ttl):
+        """Return the value for key, or None if it is missing or expired."""
+        if not self.enabled:
+            return None
+        entry = self._load().get(key)
+        if entry is None or time.time() - entry["time"] > ttl:
+            return None
+        return entry["value"]
+
+    def set(self, key, value):
+        entries = self._load()
+        entries[key] = {"time": time.time(), "value": value}
+        self._save(entries)
+        return value
+
+    def get_or_set(self, key, compute, ttl=default_ttl):
+        """Return the cached value for key, calling compute() on a miss."""
+        value = self.get(key, ttl=ttl)
+        if value is None:
+            value = self.set(key, compute())
+        return value
+
+    def invalidate(self, *prefixes):
+        """Remove the entries whose keys start with one of the prefixes.
+
+        All entries are removed if no prefix is given.
+        """
+        entries = self._load()
+        kept = {
+            key: entry
+            for key, entry in entries.items()
+            if prefixes and not key.startswith(prefixes)
+        }
+        if kept != entries:
+            self._save(kept)
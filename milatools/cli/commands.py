@@ -1,46 +1,73 @@
+import argparse
 import os
 import re
 import shutil
 import socket
-import subprocess
 import sys
-import time
 import traceback
 import webbrowser
 from contextlib import ExitStack
 from pathlib import Path
 from urllib.parse import urlencode
 
-import questionary as qn
-from coleo import Option, auto_cli, default, tooled
-from invoke import UnexpectedExit
+from coleo import Option, default, make_cli, tooled
 
 from ..version import version as mversion
-from .init_command import setup_ssh_config
-from .local import Local
-from .profile import ensure_program, setup_profile
-from .remote import Remote, SlurmRemote
+from . import hostlist
+from .cache import cache_enabled
+from .control import (
+    control_path,
+    kill_record_command,
+    parse_control_record,
+    release_control_record,
+    update_control_record,
+    with_control_file,
+)
+from .trace import profiling, span, tracing
 from .utils import (
     CommandNotFoundError,
     MilatoolsUserError,
     T,
     qualified,
     randname,
-    with_control_file,
+    running_on_mila,
+    shjoin,
     yn,
 )
 
+# Fabric, questionary and the modules that depend on them are
+# imported by the commands that use them, so that e.g. `mila --version` or
+# `mila docs` start quickly (see tests/cli/test_startup.py).
+
 
 def main():
     """Entry point for milatools."""
-    on_mila = socket.getfqdn().endswith(".server.mila.quebec")
-    if on_mila:
+    if running_on_mila():
         exit(
             "ERROR: 'mila ...' should be run on your local machine and not on the Mila cluster"
         )
 
+    parser = argparse.ArgumentParser(
+        description=milatools.__doc__, argument_default=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Record the timings of remote operations to PATH"
+        " (or set $MILATOOLS_TRACE)",
+    )
+    parser.add_argument(
+        "--cprofile",
+        metavar="PATH",
+        help="Profile the local CPU time with cProfile and write it to PATH",
+    )
+
     try:
-        auto_cli(milatools)
+        opts, run = make_cli(milatools, parser=parser)
+        trace = vars(opts).pop("trace", os.environ.get("MILATOOLS_TRACE"))
+        cprofile = vars(opts).pop("cprofile", None)
+        with tracing(trace), profiling(cprofile):
+            run(opts=opts)
     except MilatoolsUserError as exc:
         # These are user errors and should not be reported
         print("ERROR:", exc, file=sys.stderr)
@@ -124,6 +151,12 @@ class milatools:
         # Step 1: SSH Configuration #
         #############################
 
+        from invoke import UnexpectedExit
+
+        from .init_command import setup_ssh_config
+        from .local import Local
+        from .remote import Remote
+
         print("Checking ssh config")
 
         setup_ssh_config()
@@ -233,34 +266,73 @@ class milatools:
         )
 
     def forward():
-        """Forward a port on a compute node to your local machine."""
+        """Forward ports on compute nodes to your local machine."""
 
-        # node:port to forward
-        # [positional]
+        # node:port to forward (several may be given)
+        # [positional: +]
         remote: Option
 
-        node, remote_port = remote.split(":")
-        try:
-            remote_port = int(remote_port)
-        except ValueError:
-            pass
-
         # String to append after the URL
         page: Option = default(None)
 
-        local_proc = _forward(
-            local=Local(),
-            node=f"{node}.server.mila.quebec",
-            to_forward=remote_port,
-            page=page,
+        import asyncio
+
+        from .remote import Remote
+
+        # 0 lets the OS pick a free port
+        port = _local_port(preferred_port=0)
+        if len(remote) > 1 and port:
+            exit("ERROR: --port can only be used to forward a single port")
+
+        forwards = []
+        for entry in remote:
+            node, remote_port = entry.split(":")
+            forwards.append(
+                {
+                    "node": f"{node}.server.mila.quebec",
+                    "to_forward": remote_port,
+                    "port": port,
+                    "page": page,
+                }
+            )
+
+        tunnel = _tunnel(Remote("mila").connection, forwards)
+
+        try:
+            asyncio.run(tunnel)
+        except KeyboardInterrupt:
+            exit("Terminated by user.")
+
+    def proxy():
+        """Run a SOCKS5 proxy to reach any port on the compute nodes."""
+
+        # Only accept SOCKS5, not HTTP CONNECT
+        no_http: Option & bool = default(False)
+
+        import questionary as qn
+
+        from .remote import Remote
+        from .tunnel import Proxy, open_forwarder, proxy_pac
+
+        remote = Remote("mila")
+        forwarder = open_forwarder("mila", remote.connection)
+        port = _local_port(preferred_port=1080)
+        pac = proxy_pac(port, [".server.mila.quebec"])
+        port = forwarder.proxy(
+            Proxy(http=not no_http, resolve=qualified, pac=pac), local_port=port
         )
 
+        qn.print(f"Proxy listening on localhost:{port}", style="bold")
+        qn.print("Proxy auto-config for your browser:")
+        qn.print(f"  http://localhost:{port}/proxy.pac", style="bold yellow")
+        qn.print("For example:")
+        qn.print(f"  curl --socks5-hostname localhost:{port} http://cn-a001:8888")
         try:
-            local_proc.wait()
+            forwarder.join()
         except KeyboardInterrupt:
             exit("Terminated by user.")
         finally:
-            local_proc.kill()
+            forwarder.close()
 
     def code():
         """Open a remote VSCode session on a compute node."""
@@ -275,6 +347,17 @@ class milatools:
         # Whether the server should persist or not
         persist: Option & bool = default(False)
 
+        # Do not use cached information about the cluster
+        no_cache: Option & bool = default(False)
+
+        import asyncio
+
+        from .local import Local
+        from .remote import Remote
+
+        if no_cache:
+            cache_enabled.set(False)
+
         if command is None:
             command = os.environ.get("MILATOOLS_CODE_COMMAND", "code")
 
@@ -285,17 +368,16 @@ class milatools:
         remote = Remote("mila")
         here = Local()
 
-        cnode = _find_allocation(remote, job_name="mila-code")
+        cnode = _find_allocation(remote, job_name="mila-code", use_pool=True)
         if persist:
             cnode = cnode.persist()
-        data, proc = cnode.ensure_allocation()
 
-        node_name = data["node_name"]
+        try:
+            data, proc, path = asyncio.run(_code_allocation(remote, cnode, path))
+        except KeyboardInterrupt:
+            exit("Terminated by user.")
 
-        if not path.startswith("/"):
-            # Get $HOME because we have to give the full path to code
-            home = remote.home()
-            path = "/".join([home, path])
+        node_name = data["node_name"]
 
         try:
             while True:
@@ -325,30 +407,67 @@ class milatools:
             print(f"To kill this allocation:")
             print(T.bold(f"  ssh mila scancel {data['jobid']}"))
 
+    def run():
+        """Run a command on a compute node, or on every node of an allocation."""
+
+        import questionary as qn
+
+        from .daemon import default_max_sessions
+        from .remote import Remote
+
+        # Command to run (with bash -c)
+        # [positional]
+        command: Option
+
+        # Run the command on every node of the allocation
+        all_nodes: Option & bool = default(False)
+
+        # Maximum number of nodes to run the command on at the same time
+        max_parallel: Option & int = default(default_max_sessions)
+
+        remote = Remote("mila")
+        cnode = _find_allocation(remote, job_name="mila-run", fan_out=all_nodes)
+
+        if not all_nodes:
+            exit(cnode.run(command, warn=True).exited)
+
+        try:
+            codes = cnode.fan_out(command, max_parallel=max_parallel)
+        except MilatoolsUserError as exc:
+            exit(f"ERROR: {exc}")
+        failed = {node: code for node, code in codes.items() if code != 0}
+        if failed:
+            for node, code in failed.items():
+                qn.print(f"{node}: exit code {code}", style="bold red")
+            exit(f"Failed on {len(failed)} of {len(codes)} nodes")
+        qn.print(f"Succeeded on {len(codes)} nodes", style="bold green")
+
     class serve:
         """Start services on compute nodes and forward them to your local machine."""
 
         def connect():
             """Reconnect to a persistent server."""
 
+            import asyncio
+
+            from .remote import Remote
+
             remote = Remote("mila")
             _, info = _get_server_info_command(remote)
 
-            local_proc = _forward(
-                local=Local(),
-                node=f"{info['node_name']}.server.mila.quebec",
-                to_forward=info["to_forward"],
-                options={"token": info.get("token", None)},
-                preferred_port=info["local_port"],
-                through_login=info["host"] == "0.0.0.0",
-            )
+            forward = {
+                "node": f"{info['node_name']}.server.mila.quebec",
+                "to_forward": info["to_forward"],
+                "port": _local_port(preferred_port=info["local_port"]),
+                "options": {"token": info.get("token", None)},
+                "through_login": info["host"] == "0.0.0.0",
+            }
+            tunnel = _tunnel(remote.connection, [forward])
 
             try:
-                local_proc.wait()
+                asyncio.run(tunnel)
             except KeyboardInterrupt:
                 exit("Terminated by user.")
-            finally:
-                local_proc.kill()
 
         def kill():
             """Kill a persistent server."""
@@ -360,23 +479,28 @@ class milatools:
             # Kill all servers
             all: Option & bool = default(False)
 
+            from .remote import Remote
+
             remote = Remote("mila")
 
             if all:
-                for identifier in remote.get_lines("ls .milatools/control", hide=True):
-                    info = _get_server_info(remote, identifier, hide=True)
-                    if "jobid" in info:
-                        remote.run(f"scancel {info['jobid']}")
-                    remote.run(f"rm .milatools/control/{identifier}")
+                servers = _get_all_servers(remote)
+                _purge_servers(
+                    remote,
+                    [
+                        (identifier, info.get("jobid"))
+                        for identifier, info, _ in servers
+                    ],
+                )
 
             elif identifier is None:
                 exit("Please give the name of the server to kill")
 
             else:
-                info = _get_server_info(remote, identifier)
-
-                remote.run(f"scancel {info['jobid']}")
-                remote.run(f"rm .milatools/control/{identifier}")
+                # Read the jobid, cancel it and remove the record in one go
+                command = kill_record_command(control_path(identifier))
+                if not remote.run(command, warn=True).ok:
+                    exit(f"Could not kill server {identifier}")
 
         def list():
             """List active servers."""
@@ -384,18 +508,16 @@ class milatools:
             # Purge dead or invalid servers
             purge: Option & bool = default(False)
 
+            import questionary as qn
+
+            from .remote import Remote
+
             remote = Remote("mila")
 
             to_purge = []
 
-            remote.run("mkdir -p ~/.milatools/control", hide=True)
-
-            for identifier in remote.get_lines("ls .milatools/control", hide=True):
-                info = _get_server_info(remote, identifier, hide=True)
+            for identifier, info, status in _get_all_servers(remote):
                 jobid = info.get("jobid", None)
-                status = remote.get_output(
-                    f"squeue -j {jobid} -ho %T", hide=True, warn=True
-                )
                 program = info.pop("program", "???")
                 if status == "RUNNING":
                     necessary_keys = {"node_name", "to_forward"}
@@ -413,10 +535,7 @@ class milatools:
                     print(f"    {k:20} : {v}")
 
             if purge:
-                for identifier, jobid in to_purge:
-                    if jobid is not None:
-                        remote.run(f"scancel {jobid}")
-                    remote.run(f"rm .milatools/control/{identifier}")
+                _purge_servers(remote, to_purge)
 
         def lab():
             """Start a Jupyterlab server."""
@@ -514,11 +633,260 @@ class milatools:
                 port_pattern=f"Open http://[^:]+:([0-9]+)",
             )
 
+    def bench():
+        """Measure the latency of the operations that mila commands perform."""
+
+        # Host to benchmark
+        host: Option = default("mila")
+
+        # Number of times each phase is repeated
+        repeat: Option & int = default(5)
+
+        # Size of the file transfers and of the tunnel transfers, in MiB
+        size: Option & int = default(16)
+
+        # Do not measure the time to get an allocation
+        no_alloc: Option & bool = default(False)
+
+        # JSON file to save the results to
+        # (defaults to a new file in ~/.cache/milatools/bench)
+        output: Option = default(None)
+
+        # Options to pass to salloc
+        # [nargs: --]
+        alloc: Option = default(["-c", "1", "--mem=1G", "-t", "10"])
+
+        from .bench import Benchmark
+
+        bench = Benchmark(host=host, repeat=repeat)
+        bench.run(alloc=None if no_alloc else alloc, size=size)
+        print(f"Results saved to {bench.save(output)}")
+
+    class pool:
+        """Keep allocations ready so that mila code and mila serve start instantly."""
+
+        def start():
+            """Start the pool, or change its size or its options."""
+
+            # Number of allocations to keep ready
+            size: Option & int = default(1)
+
+            # Minutes after which an allocation that was not claimed ends
+            idle: Option & int = default(60)
+
+            # Extra options to pass to slurm
+            # [nargs: --]
+            alloc: Option = default([])
+
+            from .pool import Pool
+            from .remote import Remote
+
+            submitted = Pool(Remote("mila")).start(alloc, size=size, idle=idle * 60)
+            print(f"Submitted {submitted} new allocation(s) to the pool.")
+            print("mila code and mila serve will use them when given the same --alloc.")
+
+        def stop():
+            """Cancel the allocations of the pool that were not claimed."""
+
+            from .pool import Pool
+            from .remote import Remote
+
+            cancelled = Pool(Remote("mila")).stop()
+            print(f"Cancelled {len(cancelled)} allocation(s).")
+
+        def status():
+            """Show the allocations of the pool."""
+
+            from .pool import Pool, pool_tag
+            from .remote import Remote
+
+            pool = Pool(Remote("mila"))
+            config = pool.config
+            if config is None:
+                exit("There is no pool. Start one with mila pool start.")
+            print(f"Pool of {config['size']} allocation(s) with --alloc", end=" ")
+            print(shjoin(config["alloc"]) or "(nothing)")
+            tag = pool_tag(config["alloc"])
+            for jobid, state, member_tag in pool.members():
+                if member_tag != tag:
+                    state = f"{state}, other options"
+                print(f"    {jobid:20} : {state}")
+
+    class daemon:
+        """Keep connections to the cluster open to speed up other commands."""
+
+        def start():
+            """Start the connection daemon (in the foreground)."""
+
+            from .daemon import Daemon, daemon_connection, default_max_sessions
+
+            # Maximum number of concurrent sessions on each host
+            max_sessions: Option & int = default(default_max_sessions)
+
+            d = Daemon(max_sessions=max_sessions)
+            if d.path.exists() and daemon_connection("mila", d.path) is not None:
+                exit(f"The daemon is already running on {d.path}")
+
+            # Connect right away so that authentication happens in this terminal
+            d.connection("mila")
+            print(f"Listening on {d.path}")
+            print("Other mila commands will now reuse this connection.")
+            print("Press Ctrl+C to stop the daemon.")
+            try:
+                d.serve()
+            except KeyboardInterrupt:
+                print("Daemon stopped.")
+
+        def stop():
+            """Stop the connection daemon."""
+
+            from .daemon import daemon_request
+
+            try:
+                daemon_request(op="shutdown")
+            except OSError:
+                exit("The daemon is not running.")
+            print("Daemon stopped.")
+
+        def status():
+            """Show the connections held by the daemon."""
+
+            from .daemon import daemon_request, socket_path
+
+            try:
+                reply = daemon_request(op="ping")
+            except OSError:
+                exit("The daemon is not running.")
+            print(f"Daemon listening on {socket_path()}")
+            for host, info in reply["hosts"].items():
+                state = "connected" if info["connected"] else "disconnected"
+                print(f"    {host:30} : {state}, {info['sessions']} active session(s)")
+
 
 def _get_server_info(remote, identifier, hide=False):
     text = remote.get_output(f"cat .milatools/control/{identifier}", hide=hide)
-    info = dict(line.split(" = ") for line in text.split("\n") if line)
-    return info
+    return parse_control_record(text)
+
+
+def _parse_control_dump(text):
+    """Split the output of dump_control_files into {identifier: info}.
+
+    >>> _parse_control_dump("@@@ a\\njobid = 1\\n@@@ b\\n")
+    {'a': {'jobid': '1'}, 'b': {}}
+    """
+    servers = {}
+    for section in text.split("@@@ ")[1:]:
+        identifier, _, contents = section.partition("\n")
+        servers[identifier] = parse_control_record(contents)
+    return servers
+
+
+def _parse_squeue_states(text):
+    """Parse the output of squeue -o '%i %T' into {jobid: state}.
+
+    >>> _parse_squeue_states("123 RUNNING\\n456 PENDING\\n")
+    {'123': 'RUNNING', '456': 'PENDING'}
+    """
+    return dict(line.split(None, 1) for line in text.splitlines() if line.strip())
+
+
+# Print every control file preceded by a header with its name
+dump_control_files = (
+    "for f in .milatools/control/*; do"
+    ' case "$f" in *.tmp.*) continue;; esac;'
+    ' [ -f "$f" ] && printf \'@@@ %s\\n\' "${f##*/}" && cat "$f" && echo;'
+    " done"
+)
+
+
+def _get_all_servers(remote):
+    """Return (identifier, info, status) for every persistent server.
+
+    The control files and the status of the user's jobs are fetched in a
+    single round trip. The status is None if the job is not in the queue.
+    """
+    _, dump, squeue = remote.run_batch(
+        [
+            "mkdir -p ~/.milatools/control",
+            dump_control_files,
+            "squeue --me -h -o '%i %T'",
+        ]
+    )
+    states = _parse_squeue_states(squeue.stdout)
+    return [
+        (identifier, info, states.get(info.get("jobid")))
+        for identifier, info in _parse_control_dump(dump.stdout).items()
+    ]
+
+
+def _preflight(remote, path, profile, program, installers, sockets=False):
+    """Gather the facts that mila serve needs before allocating a node.
+
+    The commands are run in a single round trip, and only the facts that are
+    not cached are fetched. Returns a dict with:
+
+    * ``home``: the home directory.
+    * ``preferred``: the preferred profile in path, or None (only if profile
+      is None).
+    * ``profiles``: the available profiles (only if profile is None).
+    * ``contents``: the text of profile, or of the preferred profile, or None
+      if it could not be read (only if there is a profile to read).
+    * ``which``: the output of which_command in profile (only if profile is
+      given, and the index of its programs cannot answer).
+
+    The sockets directory is also created if sockets is True.
+    """
+    from .profile import ProgramIndex, list_profiles, which_command
+    from .remote import home_ttl
+
+    facts = {}
+    commands = {}
+    home = remote.cache.get("home", ttl=home_ttl)
+    if home is None:
+        commands["home"] = "echo $HOME"
+    else:
+        facts["home"] = home
+    if sockets:
+        commands["sockets"] = "mkdir -p ~/.milatools/sockets"
+    if profile is None:
+        preferred = f"{path}/.milatools-profile"
+        commands["preferred"] = f"cat {preferred}"
+        commands["contents"] = f'p=$(cat {preferred}) && eval "cat $p"'
+        profiles = remote.cache.get("profiles")
+        if profiles is None:
+            commands["profiles"] = list_profiles
+        else:
+            facts["profiles"] = profiles
+    else:
+        commands["contents"] = f"cat {profile}"
+        if not ProgramIndex(remote, profile).has(program, installers):
+            commands["which"] = (
+                f"source {profile} && {which_command(program, installers)}"
+            )
+
+    results = dict(zip(commands, remote.run_batch(commands.values())))
+    for key, result in results.items():
+        if key == "home":
+            facts["home"] = remote.cache.set("home", result.stdout.strip())
+        elif key == "profiles":
+            facts["profiles"] = remote.cache.set("profiles", result.stdout.split())
+        elif key in ("preferred", "contents"):
+            facts[key] = result.stdout.rstrip() if result.ok else None
+        elif key == "which":
+            facts[key] = result.stdout
+    return facts
+
+
+def _purge_servers(remote, servers):
+    """Cancel the jobs and remove the control files of (identifier, jobid) pairs."""
+    jobids = [jobid for _, jobid in servers if jobid is not None]
+    files = [f".milatools/control/{identifier}" for identifier, _ in servers]
+    commands = []
+    if jobids:
+        commands.append(shjoin(["scancel", *jobids]))
+    if files:
+        commands.append(shjoin(["rm", "-f", *files]))
+    remote.run_batch(commands, display=True)
 
 
 @tooled
@@ -548,6 +916,25 @@ def _standard_server(
     # Name of the persistent server
     name: Option = default(None)
 
+    # Do not use cached information about the cluster
+    no_cache: Option & bool = default(False)
+
+    import asyncio
+
+    import questionary as qn
+
+    from .aio import asyncify
+    from .profile import (
+        ProgramIndex,
+        check_program,
+        ensure_program,
+        setup_profile,
+    )
+    from .remote import Remote
+
+    if no_cache:
+        cache_enabled.set(False)
+
     # Make the server visible from the login node (other users will be able to connect)
     # share: Option & bool = default(False)
     # Temporarily disabled
@@ -559,41 +946,65 @@ def _standard_server(
         name = program
 
     remote = Remote("mila")
-
     path = path or "~"
+    if profile:
+        prof = f"~/.milatools/profiles/{profile}.bash"
+    else:
+        prof = None
+    facts = _preflight(
+        remote, path, prof, program, installers, sockets=not port_pattern
+    )
+    home = facts["home"]
     if path == "~" or path.startswith("~/"):
-        path = remote.home() + path[1:]
+        path = home + path[1:]
 
     with ExitStack() as stack:
         if persist:
-            cf = stack.enter_context(with_control_file(remote, name=name))
+            record = {"program": program}
+            cf = stack.enter_context(
+                with_control_file(remote, name=name, record=record)
+            )
         else:
-            cf = None
+            cf = record = None
 
-        if profile:
-            prof = f"~/.milatools/profiles/{profile}.bash"
-        else:
-            prof = setup_profile(remote, path)
+        contents = facts.get("contents")
+        if not prof:
+            prof = setup_profile(remote, path, facts)
+            if prof != facts["preferred"]:
+                result = remote.run(f"cat {prof}", hide=True, warn=True)
+                contents = result.stdout.rstrip() if result.ok else None
 
         qn.print(f"Using profile: {prof}")
-        cat_result = remote.run(f"cat {prof}", hide=True, warn=True)
-        if cat_result.ok:
+        if contents is not None:
             qn.print(f"=" * 50)
-            qn.print(cat_result.stdout.rstrip())
+            qn.print(contents)
             qn.print(f"=" * 50)
         else:
+            remote.cache.invalidate("profiles")
             exit(f"Could not find or load profile: {prof}")
 
         premote = remote.with_profile(prof)
+        which_output, indexed = check_program(
+            premote,
+            prof,
+            program,
+            installers,
+            contents=contents,
+            which_output=facts.get("which"),
+        )
 
         if not ensure_program(
             remote=premote,
             program=program,
             installers=installers,
+            which_output=which_output,
+            profile=prof,
         ):
             exit(f"Exit: {program} is not installed.")
 
-        cnode = _find_allocation(remote, job_name=f"mila-serve-{program}")
+        cnode = _find_allocation(
+            remote, job_name=f"mila-serve-{program}", use_pool=True
+        )
 
         patterns = {
             "node_name": "#### ([A-Za-z0-9_-]+)",
@@ -605,8 +1016,6 @@ def _standard_server(
             exit(
                 "Server cannot be shared because it is serving over a Unix domain socket"
             )
-        else:
-            remote.run("mkdir -p ~/.milatools/sockets", hide=True)
 
         if share:
             host = "0.0.0.0"
@@ -626,61 +1035,135 @@ def _standard_server(
         if persist:
             cnode = cnode.persist()
 
-        proc, results = (
-            cnode.with_profile(prof)
-            .with_precommand("echo '####' $(hostname)")
-            .extract(
-                command,
-                patterns=patterns,
-            )
-        )
-        node_name = results["node_name"]
-
         if port_pattern:
-            to_forward = int(results["port"])
+            sock_path = None
         else:
-            to_forward = f"{remote.home()}/.milatools/sockets/{sock_name}.sock"
+            sock_path = f"{home}/.milatools/sockets/{sock_name}.sock"
 
+        server = _run_server(
+            remote=remote,
+            cnode=asyncify(
+                cnode.with_profile(prof).with_precommand("echo '####' $(hostname)")
+            ),
+            command=command,
+            patterns=patterns,
+            sock_path=sock_path,
+            host=host,
+            port=_local_port(),
+            cf=cf,
+            record=record,
+        )
+        try:
+            started = asyncio.run(server)
+        except KeyboardInterrupt:
+            qn.print("Terminated by user.")
+            started = True
+        finally:
+            if cnode.jobid is not None and not persist:
+                # The allocation was claimed from the pool and outlives the server
+                remote.simple_run(f"scancel {cnode.jobid}", warn=True)
+        if not started:
+            if indexed:
+                # The program may have been removed since it was indexed
+                ProgramIndex(premote, prof).invalidate()
+            exit(f"Exit: {program} did not start.")
+
+
+async def _run_server(
+    remote, cnode, command, patterns, sock_path, host, port, cf, record
+):
+    """Start the server, forward it to the local port, and wait until either ends.
+
+    Returns False if the server ended before it printed all the patterns.
+    """
+    import asyncio
+
+    import questionary as qn
+
+    from .aio import to_thread, wait_closed, wait_first
+    from .tunnel import open_forwarder
+
+    try:
+        stream, results = await cnode.extract(command, patterns=patterns)
+    except asyncio.CancelledError:
         if cf is not None:
-            remote.simple_run(f"echo program = {program} >> {cf}")
-            remote.simple_run(f"echo node_name = {results['node_name']} >> {cf}")
-            remote.simple_run(f"echo host = {host} >> {cf}")
-            remote.simple_run(f"echo to_forward = {to_forward} >> {cf}")
-            if token_pattern:
-                remote.simple_run(f"echo token = {results['token']} >> {cf}")
-
-    if token_pattern:
+            # Nothing was recorded yet, so the name is free again
+            await to_thread(release_control_record, remote, cf, record)
+        raise
+    if any(name not in results for name in patterns):
+        stream.kill()
+        return False
+    node_name = results["node_name"]
+
+    if sock_path is None:
+        to_forward = int(results["port"])
+    else:
+        to_forward = sock_path
+
+    if "token" in patterns:
         options = {"token": results["token"]}
     else:
         options = {}
 
-    local_proc = _forward(
-        local=Local(),
-        node=qualified(node_name),
-        to_forward=to_forward,
-        options=options,
-    )
-
     if cf is not None:
-        remote.simple_run(f"echo local_port = {local_proc.local_port} >> {cf}")
+        new_record = {
+            **record,
+            "jobid": results.get("batch_id") or cnode.jobid,
+            "node_name": node_name,
+            "host": host,
+            "to_forward": to_forward,
+            "local_port": port,
+            **options,
+        }
+        if not await to_thread(update_control_record, remote, cf, record, new_record):
+            # The record was removed or changed meanwhile, e.g. by mila serve
+            # kill, so do not tell the user to reconnect with it
+            qn.print(
+                f"Warning: {cf} was changed by another command,"
+                " mila serve connect will not reach this server.",
+                style="bold yellow",
+            )
+            cf = None
 
     try:
-        local_proc.wait()
-    except KeyboardInterrupt:
-        qn.print("Terminated by user.")
+        host, dest = _forward_target(qualified(node_name), to_forward)
+        forwarder = await to_thread(open_forwarder, host, remote.connection)
+        try:
+            await _forward(forwarder, dest, port=port, options=options)
+            if await wait_first(wait_closed(forwarder), stream.wait()) == 1:
+                qn.print("The server has stopped.")
+        finally:
+            forwarder.close()
+    except asyncio.CancelledError:
         if cf is not None:
             name = Path(cf).name
             qn.print("To reconnect to this server, use the command:")
             qn.print(f"  mila serve connect {name}", style="bold yellow")
             qn.print("To kill this server, use the command:")
             qn.print(f"  mila serve kill {name}", style="bold red")
+        raise
     finally:
-        local_proc.kill()
-        proc.kill()
+        stream.kill()
+    return True
+
+
+async def _code_allocation(remote, cnode, path):
+    """Get an allocation and, concurrently, the full path to open with code."""
+    import asyncio
+
+    from .aio import asyncify
+
+    allocation = asyncify(cnode).ensure_allocation()
+    if path.startswith("/"):
+        data, proc = await allocation
+        return data, proc, path
+    # Get $HOME because we have to give the full path to code
+    (data, proc), home = await asyncio.gather(allocation, asyncify(remote).home())
+    return data, proc, "/".join([home, path])
 
 
 @tooled
-def _find_allocation(remote, job_name="mila-tools"):
+def _find_allocation(remote, job_name="mila-tools", fan_out=False, use_pool=False):
     # Node to connect to
     node: Option = default(None)
 
@@ -691,35 +1174,58 @@ def _find_allocation(remote, job_name="mila-tools"):
     # [nargs: --]
     alloc: Option = default([])
 
+    # Copy a file or directory to $SLURM_TMPDIR on the node when the job
+    # starts, as src[:dest] (can be given several times)
+    # [action: append]
+    stage: Option = default([])
+
+    import questionary as qn
+
+    from .pool import Pool
+    from .remote import Remote, SlurmRemote
+    from .stage import parse_stage, start_staging
+
     if (node is not None) + (job is not None) + bool(alloc) > 1:
         exit("ERROR: --node, --job and --alloc are mutually exclusive")
 
+    stage = [parse_stage(spec) for spec in stage]
+
     if node is not None:
+        if fan_out:
+            exit("ERROR: --node cannot be used to run on all nodes, use --job")
+        if stage:
+            exit("ERROR: --stage cannot be used with --node, use --job")
         node_name = qualified(node)
         return Remote(node_name)
 
     elif job is not None:
-        node_name = remote.get_output(f"squeue --jobs {job} -ho %N")
+        if fan_out:
+            return SlurmRemote(
+                connection=remote.connection, alloc=[], jobid=job, stage=stage
+            )
+        node_names = remote.get_output(f"squeue --jobs {job} -ho %N")
+        node_name = hostlist.first(node_names)
+        if stage:
+            start_staging(remote.connection, job, node_name, stage)
         return Remote(node_name)
 
     else:
+        jobid = use_pool and Pool(remote).claim(alloc)
+        if jobid:
+            qn.print(f"Using allocation {jobid} from the pool", style="bold")
+            return SlurmRemote(
+                connection=remote.connection, alloc=[], jobid=jobid, stage=stage
+            )
         alloc = ["-J", job_name, *alloc]
         return SlurmRemote(
             connection=remote.connection,
             alloc=alloc,
+            stage=stage,
         )
 
 
 @tooled
-def _forward(
-    local,
-    node,
-    to_forward,
-    page=None,
-    options={},
-    preferred_port=None,
-    through_login=False,
-):
+def _local_port(preferred_port=None):
     # Port to open on the local machine
     port: Option = default(preferred_port)
 
@@ -728,57 +1234,99 @@ def _forward(
         # Find a free local port by binding to port 0
         sock.bind(("localhost", 0))
         _, port = sock.getsockname()
-        # Close it for ssh -L. It is *unlikely* it will not be available.
+        # Close it for the forwarder. It is *unlikely* it will not be available.
         sock.close()
 
+    return int(port)
+
+
+def _forward_target(node, to_forward, through_login=False):
+    """Return the host to connect to and the destination to forward to."""
     if isinstance(to_forward, int) or re.match("[0-9]+", to_forward):
         if through_login:
-            to_forward = f"{node}:{to_forward}"
-            args = [f"localhost:{port}:{to_forward}", "mila"]
+            return "mila", (node, int(to_forward))
         else:
-            to_forward = f"localhost:{to_forward}"
-            args = [f"localhost:{port}:{to_forward}", node]
+            return node, ("localhost", int(to_forward))
     else:
-        args = [f"localhost:{port}:{to_forward}", node]
-
-    proc = local.popen(
-        "ssh",
-        "-o",
-        "UserKnownHostsFile=/dev/null",
-        "-o",
-        "StrictHostKeyChecking=no",
-        "-nNL",
-        *args,
-    )
+        # Path to a Unix socket
+        return node, to_forward
 
-    url = f"http://localhost:{port}"
-    if page is not None:
-        if not page.startswith("/"):
-            page = f"/{page}"
-        url += page
+
+async def _forward(
+    forwarder,
+    dest,
+    port,
+    page=None,
+    options={},
+    http=True,
+):
+    """Forward port to dest and open the browser once the server responds.
+
+    Returns the local port, which is chosen by the OS if port is 0.
+    """
+    import questionary as qn
+
+    from .aio import wait_until_ready
+
+    port = forwarder.forward(dest, local_port=port)
+    if isinstance(dest, tuple):
+        dest = ":".join(map(str, dest))
+    print(T.bold_green(f"(local) forward localhost:{port} -> {forwarder.host}:{dest}"))
+
+    path = page or "/"
+    if not path.startswith("/"):
+        path = f"/{path}"
 
     options = {k: v for k, v in options.items() if v is not None}
     if options:
-        url += f"?{urlencode(options)}"
+        path += f"?{urlencode(options)}"
 
-    qn.print("Waiting for connection to be active...")
-    nsecs = 10
-    period = 0.2
-    for _ in range(int(nsecs / period)):
-        time.sleep(period)
-        try:
-            # This feels stupid, there's probably a better way
-            local.silent_get("nc", "-z", "localhost", str(port))
-        except subprocess.CalledProcessError as exc:
-            continue
-        except Exception as exc:
-            break
-        break
-
-    qn.print(
-        "Starting browser. You might need to refresh the page.",
-        style="bold",
-    )
+    url = f"http://localhost:{port}{path}"
+
+    qn.print("Waiting for the server to respond...")
+    with span("forward", forwarder.host, destination=dest, local_port=port) as s:
+        elapsed = await wait_until_ready(
+            "localhost", port, path=path if http else None, timeout=30
+        )
+        s.set(ready=elapsed is not None)
+
+    if elapsed is None:
+        qn.print(
+            "The server is not responding yet. Starting browser anyway,"
+            " you might need to refresh the page.",
+            style="bold orange",
+        )
+    else:
+        qn.print(f"Ready in {elapsed:.1f}s. Starting browser.", style="bold")
     webbrowser.open(url)
-    proc.local_port = port
-    return proc
+    return port
+
+
+async def _tunnel(login, forwards):
+    """Forward ports until the connections end.
+
+    Each forward is a dict with the node, to_forward and through_login
+    arguments of _forward_target and the arguments of _forward. There is one
+    connection per host, shared by all the ports forwarded to it.
+    """
+    import asyncio
+
+    from .aio import to_thread, wait_closed, wait_first
+    from .tunnel import open_forwarder
+
+    forwarders = {}
+    try:
+        tasks = []
+        for fw in forwards:
+            fw = dict(fw)
+            host, dest = _forward_target(
+                fw.pop("node"), fw.pop("to_forward"), fw.pop("through_login", False)
+            )
+            if host not in forwarders:
+                forwarders[host] = await to_thread(open_forwarder, host, login)
+            tasks.append(_forward(forwarders[host], dest, **fw))
+        await asyncio.gather(*tasks)
+        await wait_first(*[wait_closed(fw) for fw in forwarders.values()])
+    finally:
+        for forwarder in forwarders.values():
+            forwarder.close()
@@ -0,0 +1,149 @@
+"""Control records of persistent servers, stored in ~/.milatools/control.
+
+A record is a JSON object on a single line. It is always written to a
+temporary file which is then linked or renamed into place, so that readers
+never see a partially written record.
+"""
+
+import hashlib
+import json
+import shlex
+from contextlib import contextmanager
+
+from .utils import randname
+
+control_dir = ".milatools/control"
+
+
+def control_path(name):
+    return f"{control_dir}/{name}"
+
+
+def encode_record(record):
+    return json.dumps(record, sort_keys=True) + "\n"
+
+
+def parse_control_record(text):
+    """Parse a control record.
+
+    Records written by older versions of milatools, with one ``key = value``
+    entry per line, are also understood.
+
+    >>> parse_control_record('{"jobid": "1234", "local_port": 8888}')
+    {'jobid': '1234', 'local_port': 8888}
+    >>> parse_control_record("jobid = 1234\\nnode_name = cn-a001\\n")
+    {'jobid': '1234', 'node_name': 'cn-a001'}
+    >>> parse_control_record("")
+    {}
+    """
+    text = text.strip()
+    if text.startswith("{"):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return {}
+    return dict(line.split(" = ", 1) for line in text.split("\n") if " = " in line)
+
+
+def _write_tmp(pth, record):
+    data = shlex.quote(encode_record(record))
+    tmp = f"{pth}.tmp.$$"
+    return tmp, f"printf '%s' {data} > {tmp}"
+
+
+def create_record_command(pth, record):
+    """Return a command that creates the record, failing if it already exists."""
+    tmp, write = _write_tmp(pth, record)
+    # ln fails if the destination exists, so this is an atomic create
+    return (
+        f"mkdir -p {control_dir} && {write} && ln {tmp} {pth};"
+        f" status=$?; rm -f {tmp}; exit $status"
+    )
+
+
+def write_record_command(pth, record):
+    """Return a command that writes the record, replacing it if it exists."""
+    base = pth.rpartition("/")[0]
+    tmp, write = _write_tmp(pth, record)
+    return f"mkdir -p {base} && {write} && mv -f {tmp} {pth}"
+
+
+def _if_unchanged(pth, old, action):
+    """Return a command that runs action only if the record is exactly old."""
+    expected = hashlib.md5(encode_record(old).encode("utf8")).hexdigest()
+    check = f'[ "$(md5sum < {pth})" = "{expected}  -" ] && {action}'
+    # Lock the control directory so that concurrent updates cannot interleave
+    return f"flock {control_dir} sh -c {shlex.quote(check)}"
+
+
+def update_record_command(pth, old, new):
+    """Return a command that replaces the record old by new.
+
+    The command fails, without writing anything, if the current contents of
+    the record are not exactly old.
+    """
+    tmp, write = _write_tmp(pth, new)
+    return _if_unchanged(pth, old, f"{write} && mv -f {tmp} {pth}")
+
+
+def remove_record_command(pth, old):
+    """Return a command that removes the record, if it is still exactly old."""
+    return _if_unchanged(pth, old, f"rm -f {pth}")
+
+
+def kill_record_command(pth):
+    """Return a command that cancels the job of a record, and removes it.
+
+    The command fails, without doing anything, if the record does not exist.
+    """
+    # The jobid of JSON records, or of the key = value records of old versions
+    jobid = "; ".join(
+        [
+            r's/.*"jobid": *"\{0,1\}\([0-9][0-9]*\).*/\1/p',
+            r"s/^jobid = \([0-9][0-9]*\)$/\1/p",
+        ]
+    )
+    return (
+        f"[ -f {pth} ] || {{ echo No such server: {pth} >&2; exit 1; }};"
+        f" jobid=$(sed -n {shlex.quote(jobid)} {pth}); rm -f {pth};"
+        ' [ -z "$jobid" ] || scancel "$jobid"'
+    )
+
+
+def create_control_record(remote, pth, record):
+    """Atomically create a control record. Returns False if it already exists."""
+    return remote.run(create_record_command(pth, record), hide=True, warn=True).ok
+
+
+def update_control_record(remote, pth, old, new):
+    """Replace a control record, if it is still equal to old (compare-and-swap).
+
+    Returns whether the record was replaced.
+    """
+    return remote.run(update_record_command(pth, old, new), hide=True, warn=True).ok
+
+
+def release_control_record(remote, pth, record):
+    """Remove a reserved control record, unless it was updated since."""
+    return remote.run(remove_record_command(pth, record), hide=True, warn=True).ok
+
+
+@contextmanager
+def with_control_file(remote, name=None, record=None):
+    """Reserve the control record for a new persistent server.
+
+    The record is created right away with the given contents, in a single
+    round trip. Exits if a server with that name already exists. If the body
+    fails, e.g. the server did not start, the record is removed, unless a
+    server was recorded in it meanwhile, so that the name can be used again.
+    """
+    name = name or randname()
+    pth = control_path(name)
+    record = record or {}
+    if not create_control_record(remote, pth, record):
+        exit(f"Server {name} already exists. You may use mila serve kill to remove it.")
+    try:
+        yield pth
+    except BaseException:
+        release_control_record(remote, pth, record)
+        raise
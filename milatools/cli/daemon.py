@@ -0,0 +1,477 @@
+"""Background daemon that keeps SSH connections to the cluster open.
+
+The daemon listens on a per-user Unix socket. Each request is a single JSON
+line, and the daemon answers with a stream of JSON lines. ``Remote`` uses a
+``DaemonConnection`` in place of a Fabric ``Connection`` whenever the daemon
+is running, so that commands reuse an already authenticated transport instead
+of paying for a new handshake.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from pathlib import Path
+
+from fabric import Connection
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import Result
+
+from .cache import cache_dir
+
+# OpenSSH's default MaxSessions is 10, leave a little room for ssh -L & co.
+default_max_sessions = 8
+
+
+class DaemonError(Exception):
+    pass
+
+
+def socket_dir():
+    """Return the directory of the daemon's socket, unless it is overridden."""
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return Path(runtime) / "milatools"
+    return cache_dir()
+
+
+def socket_path():
+    """Return the path of the Unix socket the daemon listens on."""
+    if "MILATOOLS_DAEMON_SOCKET" in os.environ:
+        return Path(os.environ["MILATOOLS_DAEMON_SOCKET"])
+    return socket_dir() / "daemon.sock"
+
+
+def _send(sock, **message):
+    sock.sendall(json.dumps(message).encode("utf8") + b"\n")
+
+
+def daemon_request(path=None, **message):
+    """Send a request to the daemon and return its single reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(path or socket_path()))
+        _send(sock, **message)
+        reply = json.loads(sock.makefile("r", encoding="utf8").readline() or "{}")
+    if "error" in reply:
+        raise DaemonError(reply["error"])
+    return reply
+
+
+def _recv_line(sock):
+    """Read a single JSON line, and not a byte more, from sock."""
+    line = b""
+    while not line.endswith(b"\n"):
+        chunk = sock.recv(1)
+        if not chunk:
+            break
+        line += chunk
+    return json.loads(line or b"{}")
+
+
+def daemon_connection(host, path=None):
+    """Return a DaemonConnection to host, or None if the daemon is not running."""
+    if os.environ.get("MILATOOLS_NO_DAEMON"):
+        return None
+    path = path or socket_path()
+    if not path.exists():
+        return None
+    try:
+        daemon_request(path, op="ping")
+    except (OSError, ValueError, DaemonError):
+        return None
+    return DaemonConnection(host, path)
+
+
+##########
+# Client #
+##########
+
+
+class DaemonConnection:
+    """Stand-in for fabric.Connection that goes through the daemon."""
+
+    def __init__(self, host, path):
+        # Like fabric.Connection, host is the HostName resolved from the SSH
+        # config, and original_host the name it was given. This does not
+        # connect. The daemon is asked for original_host, which it resolves.
+        config = Connection(host)
+        self.original_host = host
+        self.host = config.host
+        self.user = config.user
+        self.path = path
+
+    def open(self):
+        pass
+
+    def run(
+        self,
+        command,
+        hide=False,
+        warn=False,
+        pty=False,
+        asynchronous=False,
+        out_stream=None,
+        err_stream=None,
+        **kwargs,
+    ):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(str(self.path))
+        _send(sock, op="run", host=self.original_host, command=command, pty=pty)
+        run = DaemonRun(
+            sock,
+            command=command,
+            hide=hide,
+            warn=warn,
+            pty=pty,
+            out_stream=out_stream,
+            err_stream=err_stream,
+        )
+        if asynchronous:
+            run.start()
+            return run
+        run.pump()
+        return run.join()
+
+    def _transfer(self, op, local, remote):
+        return daemon_request(
+            self.path,
+            op=op,
+            host=self.original_host,
+            local=str(Path(local).expanduser().absolute()),
+            remote=str(remote),
+        )
+
+    def put(self, local, remote=None):
+        return self._transfer("put", local, remote)
+
+    def get(self, remote, local=None):
+        return self._transfer("get", local, remote)
+
+
+class DaemonTransport:
+    """Stand-in for the paramiko Transport of a host, for port forwarding.
+
+    Channels are opened on the daemon's connection to the host, and relayed
+    to local sockets by the daemon. via is the host that the daemon connects
+    through, i.e. the login node if host is a compute node.
+    """
+
+    def __init__(self, path, host, via=None):
+        self.path = path
+        self.host = host
+        self.via = via
+
+    def is_active(self):
+        return Path(self.path).exists()
+
+    def open_relay(self, dest):
+        """Return a socket connected to dest, on the other side of the connection.
+
+        dest is a (host, port) pair or the path to a Unix socket.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.path))
+            _send(sock, op="channel", host=self.host, via=self.via, dest=dest)
+            reply = _recv_line(sock)
+        except BaseException:
+            sock.close()
+            raise
+        if not reply.get("ok"):
+            sock.close()
+            raise DaemonError(reply.get("error", "The daemon closed the connection"))
+        return sock
+
+
+class DaemonRun:
+    """A command running through the daemon.
+
+    This acts both as the promise returned by asynchronous runs and as its
+    runner, so that it can be used like an invoke Promise by Remote.extract.
+    """
+
+    def __init__(self, sock, command, hide, warn, pty, out_stream, err_stream):
+        self.sock = sock
+        self.command = command
+        self.hide = hide
+        self.warn = warn
+        self.pty = pty
+        self.streams = {
+            "out": out_stream or (None if hide else sys.stdout),
+            "err": err_stream or (None if hide else sys.stderr),
+        }
+        self.captured = {"out": [], "err": []}
+        self.exited = None
+        self.error = None
+        self.thread = None
+        self.finished = threading.Event()
+
+    @property
+    def runner(self):
+        return self
+
+    @property
+    def process_is_finished(self):
+        return self.finished.is_set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.pump, daemon=True)
+        self.thread.start()
+
+    def pump(self):
+        try:
+            for line in self.sock.makefile("r", encoding="utf8"):
+                message = json.loads(line)
+                if "exited" in message:
+                    self.exited = message["exited"]
+                elif "waiting" in message:
+                    # Shown even if the output is hidden, or it looks stuck
+                    print(message["waiting"], file=sys.stderr)
+                elif "error" in message:
+                    self.error = message
+                else:
+                    for name, data in message.items():
+                        self.captured[name].append(data)
+                        stream = self.streams[name]
+                        if stream is not None:
+                            stream.write(data)
+                            stream.flush()
+        except OSError as exc:
+            if self.exited is None and self.error is None:
+                self.error = {"error": str(exc)}
+        finally:
+            self.sock.close()
+            self.finished.set()
+
+    def kill(self):
+        try:
+            _send(self.sock, op="kill")
+        except OSError:
+            pass
+
+    def join(self):
+        self.finished.wait()
+        if self.error is not None:
+            if self.error.get("type") == "gaierror":
+                raise socket.gaierror(self.error["error"])
+            raise DaemonError(self.error["error"])
+        result = Result(
+            stdout="".join(self.captured["out"]),
+            stderr="".join(self.captured["err"]),
+            command=self.command,
+            exited=-1 if self.exited is None else self.exited,
+            pty=self.pty,
+            hide=("stdout", "stderr") if self.hide else (),
+        )
+        if not result.ok and not self.warn:
+            raise UnexpectedExit(result)
+        return result
+
+
+##########
+# Server #
+##########
+
+
+class _MessageStream:
+    """File-like object that forwards writes to the client as JSON lines."""
+
+    def __init__(self, sock, lock, name):
+        self.sock = sock
+        self.lock = lock
+        self.name = name
+
+    def write(self, data):
+        with self.lock:
+            try:
+                _send(self.sock, **{self.name: data})
+            except OSError:
+                # The client went away, the command will be killed shortly.
+                pass
+
+    def flush(self):
+        pass
+
+
+class _Host:
+    def __init__(self, max_sessions):
+        self.lock = threading.Lock()
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.active = 0
+        self.connection = None
+
+
+def open_connection(host, keepalive=60, gateway=None):
+    connection = Connection(host, gateway=gateway)
+    connection.open()
+    if keepalive:
+        connection.transport.set_keepalive(keepalive)
+    return connection
+
+
+class Daemon:
+    """Holds one connection per host and serves commands over a Unix socket.
+
+    At most ``max_sessions`` commands run concurrently on each host, the
+    others wait for a free session. Forwarded ports are not sessions, and are
+    not limited. The connections to compute nodes, for forwarding, go through
+    the connection to the login node.
+    """
+
+    def __init__(self, path=None, max_sessions=default_max_sessions, connect=None):
+        self.path = Path(path or socket_path())
+        self.max_sessions = max_sessions
+        self.connect = connect or open_connection
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def host(self, name):
+        with self.lock:
+            if name not in self.hosts:
+                self.hosts[name] = _Host(self.max_sessions)
+            return self.hosts[name]
+
+    def connection(self, name, via=None):
+        host = self.host(name)
+        with host.lock:
+            conn = host.connection
+            if conn is None or not getattr(conn, "is_connected", True):
+                if via is None:
+                    host.connection = self.connect(name)
+                else:
+                    gateway = self.connection(via)
+                    host.connection = self.connect(name, gateway=gateway)
+            return host.connection
+
+    def status(self):
+        with self.lock:
+            return {
+                name: {
+                    "connected": host.connection is not None
+                    and getattr(host.connection, "is_connected", True),
+                    "sessions": host.active,
+                }
+                for name, host in self.hosts.items()
+            }
+
+    def handle(self, sock):
+        request = json.loads(sock.makefile("r", encoding="utf8").readline() or "{}")
+        op = request.get("op")
+        try:
+            if op == "ping":
+                _send(sock, ok=True, hosts=self.status())
+            elif op == "shutdown":
+                _send(sock, ok=True)
+                threading.Thread(target=self.server.shutdown).start()
+            elif op == "run":
+                self.run(sock, request)
+            elif op == "channel":
+                self.channel(sock, request)
+            elif op == "put":
+                conn = self.connection(request["host"])
+                conn.put(request["local"], request["remote"])
+                _send(sock, ok=True)
+            elif op == "get":
+                conn = self.connection(request["host"])
+                conn.get(request["remote"], request["local"])
+                _send(sock, ok=True)
+            else:
+                _send(sock, error=f"Unknown operation: {op}")
+        except socket.gaierror as exc:
+            _send(sock, error=str(exc), type="gaierror")
+        except Exception as exc:
+            _send(sock, error=f"{type(exc).__name__}: {exc}")
+
+    def run(self, sock, request):
+        host = self.host(request["host"])
+        conn = self.connection(request["host"])
+        lock = threading.Lock()
+        if not host.sessions.acquire(blocking=False):
+            _send(
+                sock,
+                waiting=f"Waiting for one of the {self.max_sessions} sessions"
+                f" on {request['host']}, which are all in use",
+            )
+            host.sessions.acquire()
+        host.active += 1
+        try:
+            promise = conn.run(
+                request["command"],
+                hide=True,
+                warn=True,
+                pty=request.get("pty", False),
+                asynchronous=True,
+                in_stream=False,
+                out_stream=_MessageStream(sock, lock, "out"),
+                err_stream=_MessageStream(sock, lock, "err"),
+            )
+            watcher = threading.Thread(
+                target=self._watch, args=(sock, promise.runner), daemon=True
+            )
+            watcher.start()
+            result = promise.join()
+        finally:
+            host.active -= 1
+            host.sessions.release()
+        with lock:
+            _send(sock, exited=result.exited)
+
+    def channel(self, sock, request):
+        """Relay sock to a channel to request["dest"], on request["host"]."""
+        from .tunnel import open_channel, pipe
+
+        conn = self.connection(request["host"], via=request.get("via"))
+        dest = request["dest"]
+        chan = open_channel(
+            conn.transport, dest if isinstance(dest, str) else tuple(dest)
+        )
+        _send(sock, ok=True)
+        back = threading.Thread(target=pipe, args=(chan, sock), daemon=True)
+        back.start()
+        try:
+            pipe(sock, chan)
+            back.join()
+        finally:
+            chan.close()
+
+    def _watch(self, sock, runner):
+        # Any message from the client, or the client going away, means that
+        # the command should be killed.
+        try:
+            sock.recv(1024)
+        except OSError:
+            pass
+        if not runner.process_is_finished:
+            runner.kill()
+
+    def serve(self):
+        daemon = self
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if self.path.parent == socket_dir():
+            # Our own directory may predate the daemon, or have been loosened
+            os.chmod(self.path.parent, 0o700)
+        if self.path.exists():
+            self.path.unlink()
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                daemon.handle(self.request)
+
+        # The socket is private from the moment it is bound
+        umask = os.umask(0o077)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(
+                str(self.path), Handler
+            )
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if self.path.exists():
+                self.path.unlink()
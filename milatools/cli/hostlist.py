@@ -0,0 +1,251 @@
+"""Slurm host lists, such as ``cn-a[001-003,010],cn-b[01-02]``.
+
+Host lists are what salloc, squeue (``%N``) and sacct print to describe a set
+of nodes. A host list is a comma-separated list of names, where each name may
+contain any number of bracket groups. A bracket group is a comma-separated
+list of numbers and ranges of numbers, whose zero-padding is preserved.
+"""
+
+import itertools
+import re
+
+_number_rx = re.compile(r"^(.*?)([0-9]+)([^0-9]*)$")
+
+
+def _split_top(hostlist):
+    """Split a host list on the commas that are outside of brackets."""
+    depth = 0
+    start = 0
+    for i, c in enumerate(hostlist):
+        if c == "[":
+            depth += 1
+            if depth > 1:
+                raise ValueError(f"Nested brackets in host list: {hostlist!r}")
+        elif c == "]":
+            depth -= 1
+            if depth < 0:
+                raise ValueError(f"Unbalanced brackets in host list: {hostlist!r}")
+        elif c == "," and depth == 0:
+            yield hostlist[start:i]
+            start = i + 1
+    if depth != 0:
+        raise ValueError(f"Unbalanced brackets in host list: {hostlist!r}")
+    yield hostlist[start:]
+
+
+def _parse_ranges(group, hostlist):
+    ranges = []
+    for part in group.split(","):
+        start, dash, end = part.partition("-")
+        if not dash:
+            end = start
+        if not (start.isdigit() and end.isdigit()):
+            raise ValueError(f"Invalid range {part!r} in host list: {hostlist!r}")
+        if int(end) < int(start):
+            raise ValueError(f"Decreasing range {part!r} in host list: {hostlist!r}")
+        ranges.append((int(start), int(end), len(start)))
+    return ranges
+
+
+def _parse_name(name, hostlist):
+    """Parse a name into a list of literal strings and lists of ranges."""
+    pieces = []
+    for i, piece in enumerate(re.split(r"\[([^\]]*)\]", name)):
+        if i % 2:
+            pieces.append(_parse_ranges(piece, hostlist))
+        elif piece:
+            pieces.append(piece)
+    return pieces
+
+
+def parse(hostlist):
+    """Return one list of pieces for each comma-separated name of the host list.
+
+    >>> parse("cn-a[001-003,010]x,rtx8")
+    [['cn-a', [(1, 3, 3), (10, 10, 3)], 'x'], ['rtx8']]
+    """
+    hostlist = hostlist.strip()
+    if not hostlist:
+        return []
+    return [_parse_name(name, hostlist) for name in _split_top(hostlist) if name]
+
+
+def _expand_ranges(ranges):
+    for start, end, width in ranges:
+        for n in range(start, end + 1):
+            yield f"{n:0{width}d}"
+
+
+def _expand_pieces(pieces):
+    # Unlike itertools.product, this never materializes a range
+    if not pieces:
+        yield ""
+        return
+    head, rest = pieces[0], pieces[1:]
+    heads = (head,) if isinstance(head, str) else _expand_ranges(head)
+    for h in heads:
+        for tail in _expand_pieces(rest):
+            yield h + tail
+
+
+def expand(hostlist):
+    """Generate the names in a host list, in order, without building a list.
+
+    >>> list(expand("cn-a[001-003,010],cn-b[01-02]"))
+    ['cn-a001', 'cn-a002', 'cn-a003', 'cn-a010', 'cn-b01', 'cn-b02']
+    >>> list(expand("rack[1-2]-gpu[0-1]"))
+    ['rack1-gpu0', 'rack1-gpu1', 'rack2-gpu0', 'rack2-gpu1']
+    """
+    hostlist = hostlist.strip()
+    if not hostlist:
+        return
+    # Names are parsed as they come, so that first() doesn't parse everything
+    for name in _split_top(hostlist):
+        if name:
+            yield from _expand_pieces(_parse_name(name, hostlist))
+
+
+def first(hostlist):
+    """Return the first name of a host list.
+
+    >>> first("cn-c[005,008],rtx8")
+    'cn-c005'
+    """
+    for name in expand(hostlist):
+        return name
+    raise ValueError("Empty host list")
+
+
+def count(hostlist):
+    """Return the number of names in a host list, without expanding it.
+
+    >>> count("cn-a[001-100],cn-b[1-4]x[1-2]")
+    108
+    """
+    total = 0
+    for pieces in parse(hostlist):
+        n = 1
+        for piece in pieces:
+            if not isinstance(piece, str):
+                n *= sum(end - start + 1 for start, end, _ in piece)
+        total += n
+    return total
+
+
+def _format_ranges(numbers, width):
+    parts = []
+    for _, run in itertools.groupby(enumerate(numbers), lambda x: x[1] - x[0]):
+        run = [n for _, n in run]
+        if len(run) == 1:
+            parts.append(f"{run[0]:0{width}d}")
+        else:
+            parts.append(f"{run[0]:0{width}d}-{run[-1]:0{width}d}")
+    return ",".join(parts)
+
+
+def compress(names):
+    """Return a compact host list for the given names.
+
+    Names are grouped on their last number. Duplicates are removed and the
+    numbers are sorted, so that the result expands to the same set of names.
+
+    >>> compress(["cn-a001", "cn-a002", "cn-a003", "cn-a010", "cn-b01", "rtx8"])
+    'cn-a[001-003,010],cn-b01,rtx8'
+    >>> compress(["n08", "n09", "n10", "n7"])
+    'n[08-10],n7'
+    """
+    groups = {}
+    # Position of the first occurrence of each name, to order the groups
+    first = {}
+    for i, name in enumerate(names):
+        first.setdefault(name, i)
+        m = _number_rx.match(name)
+        if m is None:
+            groups.setdefault((name, None, None), None)
+            continue
+        prefix, digits, suffix = m.groups()
+        # Numbers that don't start with 0 are not padded, width 0
+        width = len(digits) if digits[0] == "0" and len(digits) > 1 else 0
+        groups.setdefault((prefix, suffix, width), set()).add(int(digits))
+
+    # Unpadded numbers with the same number of digits as a padded group are
+    # put in that group, e.g. cn-a010 goes with cn-a001.
+    for (prefix, suffix, width), numbers in list(groups.items()):
+        if width == 0 and numbers is not None:
+            for n in list(numbers):
+                key = (prefix, suffix, len(str(n)))
+                if key in groups:
+                    groups[key].add(n)
+                    numbers.discard(n)
+            if not numbers:
+                del groups[(prefix, suffix, width)]
+
+    def position(group):
+        (prefix, suffix, width), numbers = group
+        if numbers is None:
+            return first[prefix]
+        return min(first[f"{prefix}{n:0{width}d}{suffix}"] for n in numbers)
+
+    parts = []
+    for (prefix, suffix, width), numbers in sorted(groups.items(), key=position):
+        if numbers is None:
+            parts.append(prefix)
+        elif len(numbers) == 1:
+            parts.append(f"{prefix}{_format_ranges(numbers, width)}{suffix}")
+        else:
+            parts.append(f"{prefix}[{_format_ranges(sorted(numbers), width)}]{suffix}")
+    return ",".join(parts)
+
+
+class Hostlist:
+    """A set of node names, which can be built from a host list or names.
+
+    Iteration expands the host list lazily. Set operations return a new
+    Hostlist, and str() gives back the compact form.
+
+    >>> nodes = Hostlist("cn-a[001-004]")
+    >>> str(nodes - Hostlist("cn-a002"))
+    'cn-a[001,003-004]'
+    >>> str(nodes & ["cn-a004", "cn-b001"])
+    'cn-a004'
+    """
+
+    def __init__(self, nodes=""):
+        if isinstance(nodes, Hostlist):
+            nodes = nodes.hostlist
+        elif not isinstance(nodes, str):
+            nodes = compress(nodes)
+        self.hostlist = nodes
+        # Parse right away to report errors early
+        parse(nodes)
+
+    def __iter__(self):
+        return expand(self.hostlist)
+
+    def __len__(self):
+        return count(self.hostlist)
+
+    def __contains__(self, name):
+        return any(node == name for node in self)
+
+    def __str__(self):
+        return compress(self)
+
+    def __repr__(self):
+        return f"Hostlist({str(self)!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, Hostlist):
+            return NotImplemented
+        return set(self) == set(other)
+
+    def __or__(self, other):
+        return Hostlist(itertools.chain(self, Hostlist(other)))
+
+    def __and__(self, other):
+        other = set(Hostlist(other))
+        return Hostlist(node for node in self if node in other)
+
+    def __sub__(self, other):
+        other = set(Hostlist(other))
+        return Hostlist(node for node in self if node not in other)
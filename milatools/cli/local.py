@@ -1,5 +1,6 @@
 import subprocess
 
+from .trace import span
 from .utils import CommandNotFoundError, T, shjoin
 
 
@@ -8,28 +9,33 @@ class Local:
         print(T.bold_green(f"(local) $ ", shjoin(args)))
 
     def silent_get(self, *args, **kwargs):
-        return subprocess.check_output(
-            args,
-            universal_newlines=True,
-            **kwargs,
-        )
+        with span("local", "localhost", command=shjoin(args)):
+            return subprocess.check_output(
+                args,
+                universal_newlines=True,
+                **kwargs,
+            )
 
     def get(self, *args, **kwargs):
         self.display(args)
-        return subprocess.check_output(
-            args,
-            universal_newlines=True,
-            **kwargs,
-        )
-
-    def run(self, *args, **kwargs):
-        self.display(args)
-        try:
-            return subprocess.run(
+        with span("local", "localhost", command=shjoin(args)):
+            return subprocess.check_output(
                 args,
                 universal_newlines=True,
                 **kwargs,
             )
+
+    def run(self, *args, **kwargs):
+        self.display(args)
+        try:
+            with span("local", "localhost", command=shjoin(args)) as s:
+                result = subprocess.run(
+                    args,
+                    universal_newlines=True,
+                    **kwargs,
+                )
+                s.set(exit_code=result.returncode)
+                return result
         except FileNotFoundError as e:
             if e.filename == args[0]:
                 raise CommandNotFoundError(e.filename)
@@ -38,11 +44,13 @@ class Local:
 
     def popen(self, *args, **kwargs):
         self.display(args)
-        return subprocess.Popen(
-            args,
-            universal_newlines=True,
-            **kwargs,
-        )
+        # Only the time it takes to start the process
+        with span("local", "localhost", command=shjoin(args), asynchronous=True):
+            return subprocess.Popen(
+                args,
+                universal_newlines=True,
+                **kwargs,
+            )
 
     def check_passwordless(self, host):
         results = self.run(
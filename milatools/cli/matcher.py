@@ -0,0 +1,106 @@
+"""Match many named patterns against lines of output in a single pass."""
+
+import re
+
+try:
+    import re._parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+
+def required_literal(rx):
+    """Return the longest literal string that any match of rx must contain.
+
+    >>> required_literal(re.compile("^Submitted batch job ([0-9]+)"))
+    'Submitted batch job '
+    >>> required_literal(re.compile("TensorBoard [^ ]+ at http://[^:]+:([0-9]+)/"))
+    'TensorBoard '
+    >>> print(required_literal(re.compile("a|b")))
+    None
+    """
+    if rx.flags & re.IGNORECASE:
+        return None
+    best = current = ""
+    for op, av in sre_parse.parse(rx.pattern, rx.flags):
+        if op is sre_parse.LITERAL:
+            current += chr(av)
+            best = max(best, current, key=len)
+        else:
+            current = ""
+    return best if len(best) > 1 else None
+
+
+class PatternMatcher:
+    """Find named patterns in lines of output.
+
+    All patterns are compiled once, along with a single alternation of the
+    literal strings they require (e.g. ``Submitted batch job``). A line that
+    matches none of the patterns, which is the vast majority of them, thus
+    costs a single search. The value recorded for a match is the pattern's
+    first group, or the whole match if it has no group.
+
+    In "first" mode, only the first match of each pattern is kept and the
+    pattern is not searched for anymore. In "all" mode, every match is kept,
+    in a list.
+
+    >>> m = PatternMatcher({"port": "port ([0-9]+)", "node": "on (cn-[a-z0-9]+)"})
+    >>> m.feed("listening on cn-a001 port 8888")
+    {'port': '8888', 'node': 'cn-a001'}
+    >>> m.done
+    True
+    """
+
+    def __init__(self, patterns, mode="first"):
+        if mode not in ("first", "all"):
+            raise ValueError(f"mode should be 'first' or 'all', not {mode!r}")
+        self.mode = mode
+        self.compiled = {name: re.compile(patt) for name, patt in patterns.items()}
+        self.literals = {
+            name: required_literal(rx) for name, rx in self.compiled.items()
+        }
+        self.results = {}
+        self._compile()
+
+    def _compile(self):
+        literals = [self.literals[name] for name in self.compiled]
+        if not literals or None in literals:
+            # Some pattern has no required literal, it has to be searched on
+            # every line anyway.
+            self._prefilter = None
+        else:
+            # Longest first, so that a literal can't hide one it is a prefix of
+            literals.sort(key=len, reverse=True)
+            self._prefilter = re.compile("|".join(map(re.escape, literals)))
+
+    @property
+    def done(self):
+        """Whether every pattern was found (in "first" mode)."""
+        return self.mode == "first" and not self.compiled
+
+    def search(self, line):
+        """Return {name: value} for the patterns that match the line."""
+        if self._prefilter is not None and not self._prefilter.search(line):
+            return {}
+        found = {}
+        for name, rx in self.compiled.items():
+            literal = self.literals[name]
+            if literal is not None and literal not in line:
+                continue
+            m = rx.search(line)
+            if m:
+                found[name] = m.group(1) if rx.groups else m.group(0)
+        return found
+
+    def feed(self, line):
+        """Search the line and record the matches. Returns the new matches."""
+        found = self.search(line)
+        if self.mode == "first":
+            for name in found:
+                del self.compiled[name]
+            if found:
+                self._compile()
+            self.results.update(found)
+        else:
+            for name, value in found.items():
+                self.results.setdefault(name, []).append(value)
+        return found
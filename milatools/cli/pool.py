@@ -0,0 +1,188 @@
+"""Warm pool of allocations that mila code and mila serve can claim instantly.
+
+Each member of the pool is a batch job that holds an allocation until it is
+claimed, or until it has been idle for too long. A member is claimed by
+creating the directory ~/.milatools/pool/claimed-<jobid>. mkdir is atomic, so
+two commands can never claim the same member, and a member that expires
+claims itself first for the same reason.
+"""
+
+import hashlib
+
+from .control import write_record_command
+from .remote import SlurmRemote
+from .utils import shjoin
+
+pool_dir = ".milatools/pool"
+pool_config = f"{pool_dir}/config"
+member_script = f"{pool_dir}/member.sh"
+pool_job_name = "mila-pool"
+
+# The local record of the pool, which tells whether to look for a member
+pool_ttl = 30 * 24 * 3600
+
+member_command = """\
+claim={pool_dir}/claimed-$SLURM_JOB_ID
+end=$((SECONDS + {idle}))
+while [ ! -d "$claim" ] && [ $SECONDS -lt $end ]; do
+    sleep 1
+done
+# Nobody claimed this member in time
+mkdir "$claim" 2>/dev/null && exit 0
+# Hold the allocation until the job is cancelled, like --persist does
+sleep 1000d
+"""
+
+# Print the jobid, state and tag of each member, CLAIMED ones included
+list_members = (
+    f"squeue --me -h -n {pool_job_name} -o '%i %T %k' |"
+    " while read -r jobid state tag; do"
+    f" [ -d {pool_dir}/claimed-$jobid ] && state=CLAIMED;"
+    ' echo "$jobid $state $tag";'
+    " done"
+)
+
+# Remove the claims of the members that have ended
+remove_stale_claims = (
+    f"queued=\" $(squeue --me -h -n {pool_job_name} -o %i | tr '\\n' ' ') \";"
+    f" for d in {pool_dir}/claimed-*; do"
+    ' [ -d "$d" ] || continue;'
+    ' case "$queued" in *" ${d##*-} "*) ;; *) rmdir "$d";; esac;'
+    " done"
+)
+
+
+def pool_tag(alloc):
+    """Return the tag of the members allocated with the given slurm options.
+
+    >>> pool_tag(["--gres=gpu:1"]) == pool_tag(["--gres=gpu:1"])
+    True
+    >>> pool_tag(["--gres=gpu:1"]) == pool_tag([])
+    False
+    """
+    digest = hashlib.md5(shjoin(alloc).encode("utf8")).hexdigest()
+    return f"milatools-pool-{digest[:12]}"
+
+
+def submit_command(alloc, count):
+    """Return a command that submits count new members to the pool."""
+    sbatch = shjoin(
+        ["sbatch", "-J", pool_job_name, "--comment", pool_tag(alloc), *alloc]
+    )
+    return f"for i in $(seq {count}); do {sbatch} {member_script}; done"
+
+
+def claim_command(alloc):
+    """Return a command that claims a running member allocated with alloc.
+
+    It prints ``claimed <jobid>`` for the member it claimed, if any, and
+    ``member <jobid> <state>`` for each of the other unclaimed members.
+    """
+    return (
+        f"{list_members} | while read -r jobid state tag; do"
+        f' [ "$tag" = {pool_tag(alloc)} ] || continue;'
+        ' if [ -z "$claimed" ] && [ "$state" = RUNNING ]'
+        f" && mkdir {pool_dir}/claimed-$jobid 2>/dev/null; then"
+        ' claimed=$jobid; echo "claimed $jobid";'
+        ' elif [ "$state" != CLAIMED ]; then echo "member $jobid $state"; fi;'
+        " done"
+    )
+
+
+def _parse_members(text):
+    """Parse the output of list_members into (jobid, state, tag) tuples.
+
+    >>> _parse_members("12 RUNNING milatools-pool-x\\n13 PENDING (null)\\n")
+    [('12', 'RUNNING', 'milatools-pool-x'), ('13', 'PENDING', '(null)')]
+    """
+    return [tuple(line.split(None, 2)) for line in text.splitlines() if line.strip()]
+
+
+class Pool:
+    """Warm pool of allocations on the cluster that remote is connected to.
+
+    The configuration of the pool is also recorded in the local cache, so
+    that commands only look for a member when there is a pool to look in.
+    """
+
+    def __init__(self, remote):
+        self.remote = remote
+        # Future for the submission of new members after a claim
+        self.topup = None
+
+    @property
+    def config(self):
+        return self.remote.cache.get("pool", ttl=pool_ttl)
+
+    def members(self):
+        """Return (jobid, state, tag) for every member, claimed or not."""
+        return _parse_members(self.remote.get_output(list_members, hide=True))
+
+    def start(self, alloc, size, idle):
+        """Configure the pool and submit the members it is missing.
+
+        Unclaimed members allocated with other options are cancelled. Members
+        that are not claimed after idle seconds end. Returns the number of
+        members that were submitted.
+        """
+        remote = self.remote
+        config = {"alloc": alloc, "size": size, "idle": idle}
+        SlurmRemote(connection=remote.connection, alloc=alloc).put_batch_script(
+            member_command.format(pool_dir=pool_dir, idle=idle),
+            batch_file=member_script,
+            output_file="/dev/null",
+        )
+        _, _, listing = remote.run_batch(
+            [
+                write_record_command(pool_config, config),
+                remove_stale_claims,
+                list_members,
+            ]
+        )
+        tag = pool_tag(alloc)
+        unclaimed = [m for m in _parse_members(listing.stdout) if m[1] != "CLAIMED"]
+        stale = [jobid for jobid, _, t in unclaimed if t != tag]
+        missing = size - (len(unclaimed) - len(stale))
+        commands = []
+        if stale:
+            commands.append(shjoin(["scancel", *stale]))
+        if missing > 0:
+            commands.append(submit_command(alloc, missing))
+        remote.run_batch(commands)
+        remote.cache.set("pool", config)
+        return max(missing, 0)
+
+    def stop(self):
+        """Cancel the unclaimed members and remove the pool's configuration."""
+        remote = self.remote
+        remote.cache.invalidate("pool")
+        unclaimed = [jobid for jobid, state, _ in self.members() if state != "CLAIMED"]
+        commands = [f"rm -f {pool_config}", remove_stale_claims]
+        if unclaimed:
+            commands.insert(0, shjoin(["scancel", *unclaimed]))
+        remote.run_batch(commands)
+        return unclaimed
+
+    def claim(self, alloc):
+        """Claim a running member allocated with alloc and return its jobid.
+
+        Returns None if there is no such member. The pool is topped up in the
+        background, so that the next claim also succeeds.
+        """
+        config = self.config
+        if config is None or config["alloc"] != alloc:
+            return None
+        output = self.remote.get_output(claim_command(alloc), hide=True, warn=True)
+        claimed = None
+        members = 0
+        for line in output.splitlines():
+            kind, jobid, *_ = line.split()
+            if kind == "claimed":
+                claimed = jobid
+            else:
+                members += 1
+        if members < config["size"]:
+            self.topup = self.remote.run_async(
+                submit_command(alloc, config["size"] - members), hide=True, warn=True
+            )
+        return claimed
@@ -1,10 +1,13 @@
+import hashlib
 import json
 import re
+import time
 from pathlib import Path
 
 import invoke
 import questionary as qn
 
+from .stage import helper, helper_path, stage_lines
 from .utils import askpath, shjoin, yn
 
 style = qn.Style(
@@ -18,6 +21,129 @@ style = qn.Style(
 )
 
 
+profile_dir = "~/.milatools/profiles"
+
+list_profiles = f"ls {profile_dir}/*.bash"
+
+
+# Discoveries are kept until their signal changes, but at most a month
+discovery_ttl = 30 * 24 * 3600
+
+# The modification times of the module directories and of the directory of
+# each module in them, of Lmod's spider cache directories and their files,
+# and of the cache timestamp files named in Lmod's configuration
+modules_signal = r"""
+stat -L -c "%n %Y" $(
+    for dir in $(echo "$MODULEPATH:$LMOD_SPIDER_CACHE_DIRS" | tr : " "); do
+        echo "$dir" "$dir"/*
+    done
+    sed -n 's/.*timestamp *= *"\([^"]*\)".*/\1/p' "${LMOD_RC:-/dev/null}"
+)"""
+
+# Module that provides conda, and the files where it records its environments
+conda_loader = "module load miniconda/3"
+conda_signal = 'stat -L -c "%n %Y" ~/.conda/environments.txt ~/.condarc'
+
+
+class Discovery:
+    """Output of a slow command, cached until the output of a cheap one changes.
+
+    signal is a command whose output changes whenever the output of command
+    would, e.g. the modification times of the files that it reads. Both are
+    run in a single round trip, and command only runs if the signal changed.
+    parse(stdout, stderr) turns the output of command into the value to cache.
+    """
+
+    def __init__(self, remote, name, command, signal, parse):
+        self.remote = remote
+        self.cache = remote.cache
+        self.key = f"discovery:{name}"
+        self.command = command
+        self.signal = signal
+        self.parse = parse
+        self.future = None
+
+    def entry(self):
+        return self.cache.get(self.key, ttl=discovery_ttl)
+
+    def script(self, entry):
+        known = shjoin([entry["signal"] if entry else ""])
+        return (
+            f"__signal=$( {{ {self.signal}\n}} 2>/dev/null | md5sum | cut -c-32 )\n"
+            'echo "$__signal"\n'
+            f'[ "$__signal" = {known} ] || {{ {self.command}\n}}'
+        )
+
+    def start(self):
+        """Start the discovery in the background, and return self."""
+        self.future = self.remote.run_async(
+            self.script(self.entry()), hide=True, warn=True
+        )
+        return self
+
+    def value(self):
+        """Return the cached value if the signal did not change, else the new one.
+
+        Raises UnexpectedExit if command fails.
+        """
+        if self.future is None:
+            self.start()
+        entry = self.entry()
+        result = self.future.result()
+        signal, _, stdout = result.stdout.partition("\n")
+        if entry is not None and signal == entry["signal"]:
+            return entry["value"]
+        if not result.ok:
+            raise invoke.exceptions.UnexpectedExit(result)
+        value = self.parse(stdout, result.stderr)
+        self.cache.set(self.key, {"signal": signal, "value": value})
+        return value
+
+
+def _parse_modules(stdout, stderr):
+    r"""Return {name: module} for the output of ``module --terse avail``.
+
+    >>> _parse_modules("", "/cvmfs/modules:\nminiconda/3\npytorch/2.0(@torch)\n")
+    {'miniconda/3': 'miniconda/3', 'pytorch/2.0': 'torch'}
+    """
+    # "module --terse avail" prints on stderr? Really?!
+    modlist = stderr.strip().split()
+    return {
+        x.split("(@")[0]: x.split("(@")[-1].rstrip(")")
+        for x in modlist
+        if not x.endswith(":")
+    }
+
+
+def module_catalog(remote):
+    return Discovery(
+        remote,
+        "modules",
+        command="module --terse avail",
+        signal=modules_signal,
+        parse=_parse_modules,
+    )
+
+
+def conda_environments(remote, loader=conda_loader):
+    # Another conda module may know about other environments
+    return Discovery(
+        remote.with_precommand(loader),
+        f"conda:{loader}",
+        command="conda env list --json",
+        signal=conda_signal,
+        parse=lambda stdout, stderr: json.loads(stdout)["envs"],
+    )
+
+
+def list_virtual_environments(remote, path):
+    return remote.run_async(
+        f"ls -d {path}/venv {path}/.venv {path}/virtualenv ~/virtualenvs/* ~/scratch/virtualenvs/*",
+        hide=True,
+        warn=True,
+    )
+
+
 def _ask_name(message, default=""):
     while True:
         name = qn.text(message, default=default).unsafe_ask()
@@ -27,11 +153,16 @@ def _ask_name(message, default=""):
             qn.print(f"Invalid name: {name}", style="bold red")
 
 
-def setup_profile(remote, path):
-    profile = select_preferred(remote, path)
+def setup_profile(remote, path, facts={}):
+    """Find the profile to use in path, asking the user to select one if needed.
+
+    facts may contain the preferred profile (``preferred``) and the list of
+    profiles (``profiles``), if they were already fetched.
+    """
+    profile = select_preferred(remote, path, facts)
     preferred = profile is not None
     if not preferred:
-        profile = select_profile(remote)
+        profile = select_profile(remote, facts)
     if profile is None:
         profile = create_profile(remote)
 
@@ -46,25 +177,33 @@ def setup_profile(remote, path):
     return profile
 
 
-def select_preferred(remote, path):
+def select_preferred(remote, path, facts={}):
     preferred = f"{path}/.milatools-profile"
     qn.print(f"Checking for preferred profile in {preferred}")
 
-    try:
-        preferred = remote.get_output(f"cat {preferred}", hide=True)
-    except invoke.exceptions.UnexpectedExit:
-        qn.print("None found.", style="grey")
-        preferred = None
+    if "preferred" in facts:
+        preferred = facts["preferred"]
+    else:
+        try:
+            preferred = remote.get_output(f"cat {preferred}", hide=True)
+        except invoke.exceptions.UnexpectedExit:
+            preferred = None
 
+    if preferred is None:
+        qn.print("None found.", style="grey")
     return preferred
 
 
-def select_profile(remote):
-    profdir = "~/.milatools/profiles"
+def select_profile(remote, facts={}):
+    qn.print(f"Fetching profiles in {profile_dir}")
 
-    qn.print(f"Fetching profiles in {profdir}")
-
-    profiles = remote.get_lines(f"ls {profdir}/*.bash", hide=True, warn=True)
+    if "profiles" in facts:
+        profiles = facts["profiles"]
+    else:
+        profiles = remote.cache.get_or_set(
+            "profiles",
+            lambda: remote.get_lines(list_profiles, hide=True, warn=True),
+        )
 
     if not profiles:
         qn.print("None found.", style="grey")
@@ -97,20 +236,34 @@ def select_profile(remote):
 
 
 def create_profile(remote, path="~"):
-    modules = select_modules(remote)
+    # The lookups run in the background while the user answers the prompts
+    catalog = module_catalog(remote).start()
+    environments = conda_environments(remote).start()
+    venvs = list_virtual_environments(remote, path)
+
+    modules = select_modules(remote, catalog)
 
     mload = f"module load {' '.join(modules)}"
     lines = [mload]
 
     default_profname = ""
     if any("conda" in m for m in modules):
-        env = select_conda_environment(remote.with_precommand(mload))
-        lines.append(f"conda activate {env}")
+        if conda_loader.split()[-1] not in modules:
+            # The environments were listed with another module
+            environments = conda_environments(remote, loader=mload)
+        env = select_conda_environment(remote.with_precommand(mload), environments)
+        if ask_stage(remote):
+            lines.extend(stage_lines("conda", env))
+        else:
+            lines.append(f"conda activate {env}")
         default_profname = _env_basename(env)
 
     elif any("python" in m for m in modules):
-        vpath = select_virtual_environment(remote.with_precommand(mload), path)
-        lines.append(f"source {vpath}/bin/activate")
+        vpath = select_virtual_environment(remote.with_precommand(mload), path, venvs)
+        if ask_stage(remote):
+            lines.extend(stage_lines("venv", vpath))
+        else:
+            lines.append(f"source {vpath}/bin/activate")
         default_profname = _env_basename(vpath)
 
     profname = _ask_name("Name of the profile:", default=default_profname)
@@ -121,11 +274,23 @@ def create_profile(remote, path="~"):
     qn.print(profcontents)
     qn.print("==========")
     remote.puttext(f"{profcontents}\n", prof_file)
+    remote.cache.invalidate("profiles")
 
     return prof_file
 
 
-def select_modules(remote):
+def ask_stage(remote):
+    """Ask whether to stage the environment, uploading the helper if so."""
+    if not yn(
+        "Copy the environment to the local disk of the node when jobs start?",
+        default=False,
+    ):
+        return False
+    remote.puttext(helper, helper_path)
+    return True
+
+
+def select_modules(remote, catalog=None):
     choices = [
         qn.Choice(
             title="miniconda/3",
@@ -150,13 +315,7 @@ def select_modules(remote):
     ).unsafe_ask()
     if modules == "<OTHER>":
         qn.print("Fetching the list of modules...")
-        # "module --terse avail" prints on stderr? Really?!
-        modlist = remote.run("module --terse avail", hide=True).stderr.strip().split()
-        modchoices = {
-            x.split("(@")[0]: x.split("(@")[-1].rstrip(")")
-            for x in modlist
-            if not x.endswith(":")
-        }
+        modchoices = (catalog or module_catalog(remote)).value()
         qn.print(
             "Write one module on each line, press enter on an empty line to finish",
             style="bold",
@@ -191,10 +350,9 @@ def _env_basename(pth):
     return base
 
 
-def select_conda_environment(remote, loader="module load miniconda/3"):
+def select_conda_environment(remote, environments):
     qn.print("Fetching the list of conda environments...")
-    envstr = remote.get_output(f"conda env list --json", hide=True)
-    envlist = json.loads(envstr)["envs"]
+    envlist = environments.value()
 
     choices = [
         qn.Choice(
@@ -244,13 +402,9 @@ def select_conda_environment(remote, loader="module load miniconda/3"):
     return env
 
 
-def select_virtual_environment(remote, path):
-    envstr = remote.get_output(
-        f"ls -d {path}/venv {path}/.venv {path}/virtualenv ~/virtualenvs/* ~/scratch/virtualenvs/*",
-        hide=True,
-        warn=True,
-    )
-    choices = [x for x in envstr.split() if x]
+def select_virtual_environment(remote, path, venvs=None):
+    venvs = venvs or list_virtual_environments(remote, path)
+    choices = venvs.result().stdout.split()
     choices.extend(
         [
             qn.Choice(
@@ -281,16 +435,133 @@ def select_virtual_environment(remote, path):
     return env
 
 
-def ensure_program(remote, program, installers):
-    to_test = [program, *installers.keys()]
-    progs = [
-        Path(p).name
-        for p in remote.get_output(
-            shjoin(["which", *to_test]),
+def which_command(program, installers):
+    return shjoin(["which", program, *installers.keys()])
+
+
+# Programs found in a profile are looked up again in the background after a
+# day, and forgotten after a month
+program_index_refresh = 24 * 3600
+program_index_ttl = 30 * 24 * 3600
+
+
+def profile_digest(contents):
+    return hashlib.md5(contents.encode("utf8")).hexdigest()
+
+
+def _parse_which(names, which_output):
+    """Return {name: path} for names, with None for the ones that were not found.
+
+    >>> _parse_which(["jupyter", "conda", "pip"], "/env/bin/jupyter\\n/env/bin/pip")
+    {'jupyter': '/env/bin/jupyter', 'conda': None, 'pip': '/env/bin/pip'}
+    """
+    paths = {Path(p).name: p for p in which_output.split()}
+    return {name: paths.get(name) for name in names}
+
+
+class ProgramIndex:
+    """Local index of the programs that are available in a profile.
+
+    The entry of a profile records the hash of the profile's contents, and is
+    ignored once the profile changes. It is stored in the remote's cache.
+    """
+
+    def __init__(self, remote, profile):
+        self.remote = remote
+        self.cache = remote.cache
+        self.key = f"programs:{profile}"
+
+    def entry(self):
+        return self.cache.get(self.key, ttl=program_index_ttl)
+
+    def update(self, digest, names, which_output):
+        entry = self.entry()
+        programs = {}
+        if entry is not None and entry["digest"] == digest:
+            programs = entry["programs"]
+        programs.update(_parse_which(names, which_output))
+        self.cache.set(
+            self.key, {"digest": digest, "checked": time.time(), "programs": programs}
+        )
+
+    def invalidate(self):
+        self.cache.invalidate(self.key)
+
+    def has(self, program, installers):
+        """Whether program is available according to the index.
+
+        The hash of the profile is not checked, use lookup() for that. A
+        program that was not found is never available, in case it was
+        installed since.
+        """
+        entry = self.entry()
+        return (
+            entry is not None
+            and bool(entry["programs"].get(program))
+            and all(name in entry["programs"] for name in installers)
+        )
+
+    def lookup(self, program, installers, digest):
+        """Return the output of which_command for program, if it is indexed.
+
+        Returns None if the program is not available according to the index,
+        or if the profile changed (its hash is not digest).
+        """
+        if not self.has(program, installers):
+            return None
+        entry = self.entry()
+        if entry["digest"] != digest:
+            return None
+        names = [program, *installers]
+        if time.time() - entry["checked"] > program_index_refresh:
+            refresh = self.remote.run_async(
+                which_command(program, installers), hide=True, warn=True
+            )
+            refresh.add_done_callback(
+                lambda f: f.exception() or self.update(digest, names, f.result().stdout)
+            )
+        programs = entry["programs"]
+        return "".join(f"{programs[name]}\n" for name in names if programs[name])
+
+
+def check_program(remote, profile, program, installers, contents, which_output=None):
+    """Return the output of which_command for program in profile.
+
+    contents is the text of the profile, and which_output the output of
+    which_command, if it was already fetched. Otherwise, the check is skipped
+    if the index of the profile says that program is available and the
+    profile did not change, in which case the index is refreshed in the
+    background once it is old. Returns the output and whether it came from
+    the index.
+    """
+    digest = profile_digest(contents)
+    index = ProgramIndex(remote, profile)
+    output = which_output
+    if output is None:
+        output = index.lookup(program, installers, digest)
+        if output is not None:
+            return output, True
+        output = remote.run(
+            which_command(program, installers), hide=True, warn=True
+        ).stdout
+    index.update(digest, [program, *installers], output)
+    return output, False
+
+
+def ensure_program(remote, program, installers, which_output=None, profile=None):
+    """Make sure program is available, offering to install it if it is not.
+
+    which_output is the output of which_command, if it was already fetched.
+    The index of the programs of profile is invalidated if program is
+    installed.
+    """
+    if which_output is None:
+        which_output = remote.get_output(
+            which_command(program, installers),
             hide=True,
             warn=True,
-        ).split()
-    ]
+        )
+    progs = [Path(p).name for p in which_output.split()]
 
     if program not in progs:
         choices = [
@@ -305,5 +576,7 @@ def ensure_program(remote, program, installers):
             return False
         else:
             remote.run(f"srun {install}")
+            if profile is not None:
+                ProgramIndex(remote, profile).invalidate()
 
     return True
@@ -1,50 +1,258 @@
+import contextvars
+import getpass
+import os
 import re
 import socket
+import sys
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from queue import Empty, Queue
+from typing import NamedTuple
 
 import questionary as qn
 from fabric import Connection
 
-from .utils import T, control_file_var, here, shjoin
+from . import hostlist
+from .cache import RemoteCache
+from .daemon import DaemonRun, daemon_connection, default_max_sessions
+from .matcher import PatternMatcher
+from .stage import stage_script, start_staging
+from .trace import span, transform_names
+from .utils import MilatoolsUserError, T, here, shjoin
 
 batch_template = """#!/bin/bash
 #SBATCH --output={output_file}
 #SBATCH --ntasks=1
 
-echo jobid = $SLURM_JOB_ID >> {control_file}
-
 {command}
 """
 
 
-class QueueIO:
-    def __init__(self):
-        self.q = Queue()
+batch_id_pattern = "^Submitted batch job ([0-9]+)"
+
+# What salloc prints once the allocation is ready
+salloc_patterns = {
+    "jobid": "salloc: Granted job allocation ([0-9]+)",
+    "node_names": "salloc: Nodes ([^ ]+) are ready for job",
+}
+
+# Holds a persistent allocation, and tells on which node it runs
+persist_command = "echo @@@ $(hostname) @@@ && sleep 1000d"
+persist_patterns = {
+    "node_name": "@@@ ([^ ]+) @@@",
+    "jobid": "Submitted batch job ([0-9]+)",
+}
+
+# Seconds between the checks of tail -f for new output of persistent commands
+tail_interval = 0.2
+
+# $HOME practically never changes
+home_ttl = 30 * 24 * 3600
+
+# Thread pool shared by all calls to Remote.run_async
+_channel_pool = None
+
+
+def channel_pool():
+    global _channel_pool
+    if _channel_pool is None:
+        _channel_pool = ThreadPoolExecutor(
+            max_workers=default_max_sessions, thread_name_prefix="milatools-channel"
+        )
+    return _channel_pool
+
+
+class BatchResult(NamedTuple):
+    """Result of one of the commands given to Remote.run_batch."""
+
+    command: str
+    stdout: str
+    stderr: str
+    exited: int
+
+    @property
+    def ok(self):
+        return self.exited == 0
+
+
+def _batch_script(cmds, tag):
+    parts = []
+    for i, cmd in enumerate(cmds):
+        begin = f"{tag} begin {i}"
+        end = f"{tag} end {i}"
+        parts.append(
+            f"echo '{begin}'; echo '{begin}' >&2\n"
+            f"( {cmd}\n)\n"
+            "__status=$?\n"
+            f"printf '\\n%s %d\\n' '{end}' $__status\n"
+            f"printf '\\n%s %d\\n' '{end}' $__status >&2"
+        )
+    # Group the commands so that transforms apply to the whole batch
+    return "{\n" + "\n".join(parts) + "\n}"
+
+
+def _batch_section(text, tag, i):
+    r"""Return the output and the exit code of the ith command of a batch.
+
+    >>> _batch_section("@ begin 0\nhello\n\n@ end 0 1\n", "@", 0)
+    ('hello\n', '1')
+    >>> _batch_section("@ begin 0\nhello", "@", 0)
+    (None, None)
+    """
+    begin = f"{tag} begin {i}\n"
+    end = f"\n{tag} end {i} "
+    start = text.find(begin)
+    if start == -1:
+        return None, None
+    start += len(begin)
+    stop = text.find(end, start)
+    if stop == -1:
+        return None, None
+    code = text[stop + len(end) :].partition("\n")[0]
+    return text[start:stop], code
+
+
+# Splits after a \r that is not part of a \r\n
+_lone_cr = re.compile(r"(?<=\r)(?!\n)")
+
+
+def _split_lines(text):
+    r"""Split text after each \n, \r\n or lone \r, keeping the line endings.
+
+    >>> _split_lines("a\nb\r\n50%\r100%\rdone\nrest")
+    ['a\n', 'b\r\n', '50%\r', '100%\r', 'done\n', 'rest']
+    """
+    *pieces, last = text.split("\n")
+    lines = []
+    for piece in pieces:
+        if "\r" in piece[:-1]:
+            lines.extend(_lone_cr.split(piece + "\n"))
+        else:
+            lines.append(piece + "\n")
+    if "\r" in last:
+        lines.extend(_lone_cr.split(last))
+    elif last:
+        lines.append(last)
+    return [line for line in lines if line]
+
+
+class StreamReader:
+    """File-like object that receives a command's output and splits it in lines.
+
+    write() may be called from any thread. readlines() blocks on a condition
+    until a complete line is available, so lines are handed out as soon as
+    they are written. Lines end with \\n, \\r\\n or a lone \\r (progress
+    bars), and lines longer than max_line_length are split.
+    """
+
+    # Interval at which readlines() checks whether the writer is done, in case
+    # nobody calls close(). This only matters at the very end of the output.
+    stop_check_interval = 0.2
+
+    def __init__(self, max_line_length=64 * 1024):
+        self.buffer = bytearray()
+        # Bytes at the start of the buffer that are known to contain no line
+        # terminator, so that they are never scanned twice.
+        self.scanned = 0
+        self.max_line_length = max_line_length
+        self.closed = False
+        self.condition = threading.Condition()
 
     def write(self, s):
-        self.q.put(s)
+        if isinstance(s, str):
+            s = s.encode("utf8")
+        with self.condition:
+            self.buffer += s
+            self.condition.notify_all()
 
     def flush(self):
         pass
 
-    def readlines(self, stop):
-        current = ""
-        lines = tuple()
+    def close(self):
+        """Signal that there will be no more output."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _pop(self, size):
+        data = bytes(self.buffer[:size])
+        # Deleting from the front of a bytearray does not copy what remains
+        del self.buffer[:size]
+        self.scanned = max(0, self.scanned - size)
+        return data.decode("utf8", errors="replace")
+
+    def _split(self, text):
+        n = self.max_line_length
+        for line in _split_lines(text):
+            if len(line) <= n:
+                yield line
+            else:
+                yield from (line[i : i + n] for i in range(0, len(line), n))
+
+    def take_lines(self, final):
+        """Remove all the complete lines from the buffer and return them."""
+        buf = self.buffer
+        stop = len(buf)
+        if not final and stop and buf[-1] == 13:
+            # A \r at the very end may be the start of a \r\n
+            stop -= 1
+        end = max(
+            buf.rfind(b"\n", self.scanned, stop), buf.rfind(b"\r", self.scanned, stop)
+        )
+        if end != -1:
+            return list(self._split(self._pop(end + 1)))
+        self.scanned = stop
+        if final and buf:
+            return list(self._split(self._pop(len(buf))))
+        lines = []
+        while len(buf) >= self.max_line_length:
+            lines.append(self._pop(self.max_line_length))
+        return lines
+
+    def readlines(self, stop=lambda: False):
+        """Yield lines as they come, until stop() returns True (or close())."""
         while True:
-            try:
-                current += self.q.get(timeout=0.05)
-                if "\n" in current:
-                    *lines, current = current.split("\n")
-                for line in lines:
-                    yield f"{line}\n"
-            except Empty:
-                if stop():
-                    if current:
-                        yield current
-                    return
+            with self.condition:
+                lines = self.take_lines(final=False)
+                while not lines:
+                    if self.closed or stop():
+                        lines = self.take_lines(final=True)
+                        if not lines:
+                            return
+                        break
+                    self.condition.wait(self.stop_check_interval)
+                    lines = self.take_lines(final=False)
+            yield from lines
+
+
+# Kept for compatibility
+QueueIO = StreamReader
+
+
+def close_when_done(runner, reader):
+    """Close reader once runner has written all of the command's output.
+
+    This wakes up readlines() as soon as the command ends, instead of at its
+    next check of whether the command is finished.
+    """
+    if isinstance(runner, DaemonRun):
+        threads = [runner.thread]
+    else:
+        # The stdin thread only stops once the runner is joined
+        threads = [
+            thread
+            for target, thread in runner.threads.items()
+            if target != runner.handle_stdin
+        ]
+
+    def close():
+        for thread in threads:
+            thread.join()
+        reader.close()
+
+    threading.Thread(target=close, daemon=True).start()
 
 
 def get_first_node_name(node_names_out: str) -> str:
@@ -60,28 +268,63 @@ def get_first_node_name(node_names_out: str) -> str:
     >>> get_first_node_name("cn-c001,rtx8")
     'cn-c001'
     """
-    if "[" not in node_names_out:
-        if "," in node_names_out:
-            # different nodes
-            return node_names_out.split(",")[0]
-        # single node
-        return node_names_out
-    base, _, rest = node_names_out.partition("[")
-    inside_brackets, _, _ = rest.partition("]")
+    return hostlist.first(node_names_out)
+
+
+class PrefixWriter:
+    """File-like object that writes each complete line to out, with a prefix.
+
+    The lock is shared by all the writers to the same output, so that lines
+    from different nodes are never interleaved.
+    """
+
+    def __init__(self, prefix, out, lock):
+        self.prefix = prefix
+        self.out = out
+        self.lock = lock
+        self.buffer = ""
+
+    def write(self, data):
+        lines = (self.buffer + data.replace("\r\n", "\n")).split("\n")
+        self.buffer = lines.pop()
+        if lines:
+            with self.lock:
+                self.out.write("".join(f"{self.prefix}{line}\n" for line in lines))
+                self.out.flush()
+
+    def flush(self):
+        pass
 
-    if "," in inside_brackets:
-        return base + inside_brackets.split(",")[0]
-    assert "-" in inside_brackets
-    return base + inside_brackets.split("-")[0]
+    def close(self):
+        if self.buffer:
+            self.write("\n")
+
+
+class JobHandle:
+    """Stands in for the process that holds an allocation: kill() cancels the job."""
+
+    def __init__(self, remote, jobid):
+        self.remote = remote
+        self.jobid = jobid
+
+    def kill(self):
+        self.remote.simple_run(f"scancel {self.jobid}", warn=True)
 
 
 class Remote:
+    # Id of the job whose allocation the commands run in, if any
+    jobid = None
+
     def __init__(self, hostname, connection=None, transforms=(), keepalive=60):
         self.hostname = hostname
+        if connection is None:
+            # Reuse the daemon's connection if it is running
+            connection = daemon_connection(hostname)
         if connection is None:
             connection = Connection(hostname)
             if keepalive:
-                connection.open()
+                with span("connect", hostname):
+                    connection.open()
                 connection.transport.set_keepalive(keepalive)
         self.connection = connection
         self.transforms = transforms
@@ -108,9 +351,27 @@ class Remote:
     def display(self, cmd):
         print(T.bold_cyan(f"({self.hostname}) $ ", cmd))
 
-    def _run(self, cmd, **kwargs):
+    @property
+    def host(self):
+        """The host that the connection goes to."""
+        return getattr(self.connection, "host", self.hostname)
+
+    def _run(self, cmd, transforms=(), **kwargs):
         try:
-            return self.connection.run(cmd, **kwargs)
+            with span(
+                "run",
+                self.host,
+                command=cmd,
+                transforms=transform_names(transforms),
+                asynchronous=kwargs.get("asynchronous", False),
+            ) as s:
+                result = self.connection.run(cmd, **kwargs)
+                if not kwargs.get("asynchronous"):
+                    s.set(
+                        exit_code=result.exited,
+                        bytes=len(result.stdout) + len(result.stderr),
+                    )
+                return result
         except socket.gaierror:
             exit(
                 f"Error: Could not connect to host '{self.hostname}', did you run 'mila init'?"
@@ -126,7 +387,7 @@ class Remote:
             self.display(cmd)
         for transform in self.transforms:
             cmd = transform(cmd)
-        return self._run(cmd, hide=hide, **kwargs)
+        return self._run(cmd, transforms=self.transforms, hide=hide, **kwargs)
 
     def get_output(self, cmd, **kwargs):
         return self.run(cmd, **kwargs).stdout.strip()
@@ -134,26 +395,72 @@ class Remote:
     def get_lines(self, cmd, **kwargs):
         return self.get_output(cmd, **kwargs).split()
 
+    def run_batch(self, cmds, display=False, **kwargs):
+        """Run several commands in a single round trip.
+
+        Each command runs in its own subshell, one after the other, whether the
+        previous ones failed or not. Returns one BatchResult per command. A
+        command whose output could not be found (e.g. because the connection
+        was lost) has an exit code of -1.
+        """
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        if display:
+            for cmd in cmds:
+                self.display(cmd)
+        tag = f"@@milatools-batch-{time.time_ns()}@@"
+        kwargs.setdefault("warn", True)
+        # The commands are not interactive
+        kwargs.setdefault("in_stream", False)
+        result = self.run(_batch_script(cmds, tag), display=False, hide=True, **kwargs)
+        results = []
+        for i, cmd in enumerate(cmds):
+            stdout, code = _batch_section(result.stdout, tag, i)
+            stderr, _ = _batch_section(result.stderr, tag, i)
+            results.append(
+                BatchResult(
+                    command=cmd,
+                    stdout=stdout or "",
+                    stderr=stderr or "",
+                    exited=-1 if code is None else int(code),
+                )
+            )
+        return results
+
+    def run_async(self, cmd, **kwargs):
+        """Run a command on a new channel of the connection, in the background.
+
+        Returns a Future for the result of run(). Commands started this way
+        cannot read from stdin.
+        """
+        # Open the connection now so that the threads don't race to do it
+        self.connection.open()
+        kwargs.setdefault("in_stream", False)
+        # The thread sees the context variables of the caller, e.g. cache_enabled
+        context = contextvars.copy_context()
+        return channel_pool().submit(context.run, self.run, cmd, **kwargs)
+
     def extract(self, cmd, patterns, wait=False, **kwargs):
+        with span("extract", self.host, command=cmd, patterns=list(patterns)) as s:
+            proc, results = self._extract(cmd, patterns, wait=wait, **kwargs)
+            s.set(found=sorted(results))
+        return proc, results
+
+    def _extract(self, cmd, patterns, wait=False, **kwargs):
         kwargs.setdefault("pty", True)
-        qio = QueueIO()
+        qio = StreamReader()
         proc = self.run(cmd, asynchronous=True, out_stream=qio, **kwargs)
-        results = {}
+        close_when_done(proc.runner, qio)
+        # Check what the job id is when we sbatch
+        matcher = PatternMatcher({**patterns, "batch_id": batch_id_pattern})
+        results = matcher.results
         try:
             for line in qio.readlines(lambda: proc.runner.process_is_finished):
                 print(line, end="")
-                for name, patt in list(patterns.items()):
-                    m = re.search(patt, line)
-                    if m:
-                        results[name] = m.groups()[0]
-                        patterns.pop(name)
-                        if not patterns and not wait:
-                            return proc.runner, results
-
-                # Check what the job id is when we sbatch
-                m = re.search("^Submitted batch job ([0-9]+)", line)
-                if m:
-                    results["batch_id"] = m.groups()[0]
+                if matcher.feed(line) and patterns and not wait:
+                    if all(name in results for name in patterns):
+                        return proc.runner, results
         except KeyboardInterrupt:
             proc.runner.kill()
             if "batch_id" in results:
@@ -165,10 +472,16 @@ class Remote:
         return proc.runner, results
 
     def get(self, src, dest):
-        return self.connection.get(src, dest)
+        with span("get", self.host, path=src) as s:
+            result = self.connection.get(src, dest)
+            if isinstance(dest, (str, os.PathLike)) and os.path.isfile(dest):
+                s.set(bytes=os.path.getsize(dest))
+        return result
 
     def put(self, src, dest):
-        return self.connection.put(src, dest)
+        size = os.path.getsize(src) if isinstance(src, (str, os.PathLike)) else None
+        with span("put", self.host, path=dest, bytes=size):
+            return self.connection.put(src, dest)
 
     def puttext(self, text, dest):
         base = Path(dest).parent
@@ -178,8 +491,17 @@ class Remote:
             f.flush()
             self.put(f.name, dest)
 
+    @property
+    def cache(self):
+        user = getattr(self.connection, "user", None) or getpass.getuser()
+        return RemoteCache(self.host, user)
+
     def home(self):
-        return self.get_output("echo $HOME", hide=True)
+        return self.cache.get_or_set(
+            "home",
+            lambda: self.get_output("echo $HOME", hide=True),
+            ttl=home_ttl,
+        )
 
     def persist(self):
         qn.print(
@@ -208,9 +530,14 @@ class Remote:
 
 
 class SlurmRemote(Remote):
-    def __init__(self, connection, alloc, transforms=(), persist=False):
+    def __init__(
+        self, connection, alloc, transforms=(), persist=False, jobid=None, stage=()
+    ):
         self.alloc = alloc
         self._persist = persist
+        self.jobid = jobid
+        # (source, destination) pairs to copy to $SLURM_TMPDIR when the job starts
+        self.stage = list(stage)
         super().__init__(
             hostname="->",
             connection=connection,
@@ -220,21 +547,54 @@ class SlurmRemote(Remote):
             ],
         )
 
+    def _srun(self):
+        if self.jobid is None:
+            return ["srun", *self.alloc]
+        # Run in the job's existing allocation, alongside what already runs there
+        return ["srun", "--jobid", self.jobid, "--overlap"]
+
+    def _staged(self, cmd):
+        """Start the copies of self.stage in the background before cmd."""
+        if not self.stage:
+            return cmd
+        return f"{stage_script(self.stage)}{cmd}"
+
     def srun_transform(self, cmd):
-        return shjoin(["srun", *self.alloc, "bash", "-c", cmd])
+        return shjoin([*self._srun(), "bash", "-c", self._staged(cmd)])
 
     def srun_transform_persist(self, cmd):
         tag = time.time_ns()
-        batch_file = f".milatools/batch/batch-{tag}.sh"
         output_file = f".milatools/batch/out-{tag}.txt"
+        # tail polls files on NFS, once per second by default
+        tail = f"tail -n +1 -s {tail_interval} -f {output_file}"
+        if self.jobid is not None:
+            # The job already exists (e.g. it was claimed from the pool), so
+            # the command is detached from the session instead of submitted.
+            srun = self.srun_transform(cmd)
+            return (
+                f"mkdir -p .milatools/batch; touch {output_file};"
+                f" setsid nohup {srun} > {output_file} 2>&1 < /dev/null &"
+                f" {tail}"
+            )
+        # The batch script is given to sbatch on stdin, in the same command
+        # as the tail, so nothing has to be uploaded first.
+        eof = f"MILATOOLS_BATCH_{tag}"
+        batch = batch_template.format(
+            command=self._staged(cmd), output_file=output_file
+        )
+        sbatch = shjoin(["sbatch", *self.alloc])
+        return (
+            f"mkdir -p .milatools/batch; {sbatch} <<'{eof}'\n{batch}{eof}\n"
+            f"touch {output_file}; {tail}"
+        )
+
+    def put_batch_script(self, cmd, batch_file, output_file):
+        """Write a batch script that runs cmd to batch_file on the remote."""
         batch = batch_template.format(
             command=cmd,
             output_file=output_file,
-            control_file=control_file_var.get(),
         )
         self.puttext(batch, batch_file)
-        cmd = shjoin(["sbatch", *self.alloc, batch_file])
-        return f"{cmd}; touch {output_file}; tail -n +1 -f {output_file}"
 
     def with_transforms(self, *transforms, persist=None):
         return SlurmRemote(
@@ -242,31 +602,136 @@ class SlurmRemote(Remote):
             alloc=self.alloc,
             transforms=[*self.transforms[:-1], *transforms],
             persist=self._persist if persist is None else persist,
+            jobid=self.jobid,
+            stage=self.stage,
         )
 
     def persist(self):
         return self.with_transforms(persist=True)
 
     def ensure_allocation(self):
-        if self._persist:
+        if self.jobid is not None:
+            return self._job_allocation()
+        elif self._persist:
             proc, results = self.extract(
-                "echo @@@ $(hostname) @@@ && sleep 1000d",
-                patterns={
-                    "node_name": "@@@ ([^ ]+) @@@",
-                    "jobid": "Submitted batch job ([0-9]+)",
-                },
-                hide=True,
+                persist_command, patterns=persist_patterns, hide=True
             )
-            node_name = get_first_node_name(results["node_name"])
-            return {"node_name": node_name, "jobid": results["jobid"]}, proc
+            return self._persist_allocation(results), proc
         else:
-            remote = Remote(hostname="->", connection=self.connection).with_bash()
-            proc, results = remote.extract(
-                shjoin(["salloc", *self.alloc]),
-                patterns={"node_name": "salloc: Nodes ([^ ]+) are ready for job"},
+            proc, results = self._salloc_remote().extract(
+                self._salloc_command(), patterns=salloc_patterns
+            )
+            return self._salloc_allocation(results), proc
+
+    def _salloc_remote(self):
+        """Return the remote that runs salloc, on the login node."""
+        return Remote(hostname="->", connection=self.connection).with_bash()
+
+    def _salloc_command(self):
+        return shjoin(["salloc", *self.alloc])
+
+    def _persist_allocation(self, results):
+        """Return the allocation data, given the results of persist_patterns."""
+        node_name = get_first_node_name(results["node_name"])
+        return {"node_name": node_name, "jobid": results["jobid"]}
+
+    def _salloc_allocation(self, results):
+        """Return the allocation data, given the results of salloc_patterns.
+
+        This also starts staging to the node, if there is anything to stage.
+        """
+        # The node name can look like 'cn-c001', or 'cn-c[001-003]', or
+        # 'cn-c[001,008]', or 'cn-c001,rtx8', etc. We will only connect to a
+        # single one, though, so we will simply pick the first one.
+        node_name = get_first_node_name(results["node_names"])
+        self.start_staging(results["jobid"], node_name)
+        return {"node_name": node_name}
+
+    def _job_allocation(self):
+        node_names = self.simple_run(f"squeue --jobs {self.jobid} -ho %N").stdout
+        data = {"node_name": hostlist.first(node_names), "jobid": self.jobid}
+        self.start_staging(self.jobid, data["node_name"])
+        return data, JobHandle(self, self.jobid)
+
+    def start_staging(self, jobid, node_name):
+        """Copy self.stage to the node in the background, if there is anything."""
+        if self.stage:
+            start_staging(self.connection, jobid, node_name, self.stage)
+
+    def fan_out(self, cmd, max_parallel=default_max_sessions, out=None, err=None):
+        """Run cmd on every node of the allocation, in parallel.
+
+        Each line of output is prefixed with the name of the node it comes
+        from. Without a jobid, a new allocation is made with salloc for the
+        duration of the command. At most max_parallel nodes run the command
+        at the same time. Returns {node_name: exit code}.
+
+        Raises MilatoolsUserError if the job has no nodes, e.g. it is pending.
+        """
+        salloc = None
+        if self.jobid is None:
+            salloc, results = self._salloc_remote().extract(
+                self._salloc_command(), patterns=salloc_patterns
             )
-            # The node name can look like 'cn-c001', or 'cn-c[001-003]', or
-            # 'cn-c[001,008]', or 'cn-c001,rtx8', etc. We will only connect to a
-            # single one, though, so we will simply pick the first one.
-            node_name = get_first_node_name(results["node_name"])
-            return {"node_name": node_name}, proc
+            jobid = results["jobid"]
+            node_names = results["node_names"]
+        else:
+            jobid = self.jobid
+            node_names = self.simple_run(f"squeue --jobs {jobid} -ho %N").stdout
+        try:
+            nodes = list(hostlist.expand(node_names))
+            if not nodes:
+                raise MilatoolsUserError(
+                    f"Job {jobid} has no nodes allocated, it may still be pending"
+                )
+            return self._fan_out(cmd, jobid, nodes, max_parallel, out, err)
+        finally:
+            if salloc is not None:
+                salloc.kill()
+
+    def _fan_out(self, cmd, jobid, nodes, max_parallel, out, err):
+        self.display(cmd)
+        for transform in self.transforms[:-1]:
+            cmd = transform(cmd)
+        cmd = self._staged(cmd)
+        lock = threading.Lock()
+        running = {}
+        cancelled = threading.Event()
+
+        def run_on(node):
+            if cancelled.is_set():
+                return -1
+            outw = PrefixWriter(f"[{node}] ", out or sys.stdout, lock)
+            errw = PrefixWriter(f"[{node}] ", err or sys.stderr, lock)
+            srun = ["srun", "--jobid", jobid, "--overlap", "-N1", "-n1", "-w", node]
+            try:
+                running[node] = self._run(
+                    shjoin([*srun, "bash", "-c", cmd]),
+                    warn=True,
+                    asynchronous=True,
+                    in_stream=False,
+                    out_stream=outw,
+                    err_stream=errw,
+                )
+                if cancelled.is_set():
+                    running[node].runner.kill()
+                return running[node].join().exited
+            except Exception as exc:
+                errw.write(f"{type(exc).__name__}: {exc}\n")
+                return -1
+            finally:
+                outw.close()
+                errw.close()
+
+        self.connection.open()
+        executor = ThreadPoolExecutor(max_workers=max_parallel)
+        futures = {node: executor.submit(run_on, node) for node in nodes}
+        try:
+            return {node: future.result() for node, future in futures.items()}
+        except KeyboardInterrupt:
+            cancelled.set()
+            for promise in list(running.values()):
+                promise.runner.kill()
+            raise
+        finally:
+            executor.shutdown(wait=False)
@@ -0,0 +1,202 @@
+"""Copies of environments and datasets on the local disk of compute nodes.
+
+Python environments and datasets live on the network filesystem, which is
+slow to read from compute nodes, and which every job that reads from it
+loads. A profile can instead stage its environment: the first time it is
+sourced in a job, the environment is unpacked to $SLURM_TMPDIR, the local
+disk of the node, and activated from there. Datasets given with ``--stage``
+are copied to $SLURM_TMPDIR in the background as soon as the job starts.
+"""
+
+import shlex
+
+# Where the helper that staging profiles source is uploaded, in the home
+helper_path = ".milatools/stage.bash"
+
+# Defines milatools_stage KIND ENV, which activates ENV, a conda environment
+# (KIND is conda) or a virtualenv (KIND is venv). Outside of a job, ENV is
+# activated in place. In a job, ENV is packed in ~/.milatools/packs (with
+# conda-pack or tar), unpacked to $SLURM_TMPDIR and activated from there. The
+# pack is named after a hash of the list of packages in ENV, so that it is
+# made again when they change. If anything fails, ENV is activated in place.
+helper = r"""
+milatools_activate() {
+    if [ "$1" = conda ]; then
+        conda activate "$2"
+    else
+        source "$2/bin/activate"
+    fi
+}
+
+milatools_stage() {
+    local kind=$1 env
+    env=$(cd "$2" && pwd) || return 1
+    if [ -z "$SLURM_TMPDIR" ]; then
+        milatools_activate "$kind" "$env"
+        return
+    fi
+    local packs digest
+    packs="$HOME/.milatools/packs/$(echo "$env" | md5sum | cut -c-16)"
+    digest=$(ls "$env"/conda-meta "$env"/lib/python*/site-packages 2>/dev/null | md5sum | cut -c-16)
+    local pack="$packs/$digest.tar.gz" dest="$SLURM_TMPDIR/env-$digest"
+    (
+        flock 9
+        [ -e "$dest/.milatools-staged" ] && exit 0
+        if [ ! -e "$pack" ]; then
+            mkdir -p "$packs" || exit 1
+            # The lock is in the shared directory, so that a single job on
+            # the whole cluster packs env while the others wait for it
+            (
+                flock 8
+                [ -e "$pack" ] && exit 0
+                echo "Packing $env to $pack" >&2
+                local tmp="$(hostname).$$" old
+                if [ "$kind" = conda ]; then
+                    conda pack -q -p "$env" -o "$pack.$tmp"
+                else
+                    tar czf "$pack.$tmp" -C "$env" .
+                fi || { rm -f "$pack.$tmp"; exit 1; }
+                mv "$pack.$tmp" "$pack"
+                # Packs of older versions of env are of no use anymore
+                for old in "$packs"/*.tar.gz; do
+                    [ "$old" = "$pack" ] || rm -f "$old"
+                done
+            ) 8> "$packs/.lock" || exit 1
+        fi
+        echo "Staging $env to $dest" >&2
+        mkdir -p "$dest" && tar xzf "$pack" -C "$dest" || exit 1
+        if [ "$kind" = conda ]; then
+            (source "$dest/bin/activate" && conda-unpack) || exit 1
+        else
+            # Scripts refer to the environment by its absolute path
+            sed -i "s|$env|$dest|g" "$dest"/bin/activate*
+            grep -Il "^#!$env/" "$dest"/bin/* | xargs -r sed -i "1s|$env|$dest|"
+        fi
+        touch "$dest/.milatools-staged"
+    ) 9> "$SLURM_TMPDIR/.milatools-stage.lock"
+    if [ -e "$dest/.milatools-staged" ]; then
+        milatools_activate "$kind" "$dest"
+    else
+        echo "Could not stage $env, using it in place" >&2
+        milatools_activate "$kind" "$env"
+    fi
+}
+"""
+
+
+def stage_lines(kind, env):
+    """Return the lines of a profile that stage and activate env.
+
+    >>> stage_lines("venv", "~/virtualenvs/torch")
+    ['source ~/.milatools/stage.bash', 'milatools_stage venv ~/virtualenvs/torch']
+    """
+    return [f"source ~/{helper_path}", f"milatools_stage {kind} {env}"]
+
+
+# Created in $SLURM_TMPDIR once all the copies of --stage are done
+staged_marker = ".milatools-staged"
+
+# Seconds between the reports of the amount of data copied so far
+progress_interval = 10
+
+
+def parse_stage(spec):
+    """Return (source, destination) for a --stage option, src[:dest].
+
+    The destination is relative to $SLURM_TMPDIR, and defaults to the last
+    component of the source.
+
+    >>> parse_stage("/network/datasets/imagenet")
+    ('/network/datasets/imagenet', 'imagenet')
+    >>> parse_stage("~/scratch/data/:train")
+    ('~/scratch/data', 'train')
+    """
+    src, _, dest = spec.partition(":")
+    src = src.rstrip("/")
+    return src, dest or src.split("/")[-1]
+
+
+def _quote_path(path):
+    """Quote path for the shell, except for a leading ~ which must be expanded.
+
+    >>> _quote_path("~/my data")
+    "~/'my data'"
+    """
+    if path == "~" or path.startswith("~/"):
+        return "~/" + shlex.quote(path[2:]) if path[2:] else "~"
+    return shlex.quote(path)
+
+
+def stage_script(stages):
+    """Return a script that copies the (src, dest) pairs to $SLURM_TMPDIR.
+
+    The copies run in parallel, in the background, so the commands that come
+    after the script start right away. They can wait for the file named by
+    $MILATOOLS_STAGED, which is created once all the copies succeeded. If
+    several commands of a job run the script, the copies are only made once.
+    """
+    copies = []
+    for src, dest in stages:
+        src = _quote_path(src)
+        dest = f'"$SLURM_TMPDIR"/{shlex.quote(dest)}'
+        copies.append(f"""\
+    (
+        set -o pipefail
+        if [ -d {src} ]; then
+            mkdir -p {dest} && tar -C {src} -cf - . | tar -C {dest} -xf -
+        else
+            mkdir -p "$(dirname {dest})" && cp {src} {dest}
+        fi && echo "Staged {src} in ${{SECONDS}}s" >&2
+    ) &
+""")
+    return f"""\
+export MILATOOLS_STAGED="$SLURM_TMPDIR/{staged_marker}"
+(
+    flock -n 9 || exit 0
+    [ -e "$MILATOOLS_STAGED" ] && exit 0
+    echo "Staging {len(stages)} path(s) to $SLURM_TMPDIR" >&2
+    SECONDS=0
+{"".join(copies)}\
+    copies=$(jobs -p)
+    (
+        while sleep 1; do
+            [ $((SECONDS % {progress_interval})) = 0 ] &&
+                echo "Staged $(du -sh "$SLURM_TMPDIR" | cut -f1) so far" >&2
+        done
+    ) &
+    progress=$!
+    failed=0
+    for pid in $copies; do
+        wait $pid || failed=1
+    done
+    kill $progress
+    if [ $failed = 0 ]; then
+        touch "$MILATOOLS_STAGED"
+        echo "Staging done in ${{SECONDS}}s" >&2
+    else
+        echo "Staging failed" >&2
+    fi
+) 9> "$SLURM_TMPDIR/.milatools-data.lock" &
+"""
+
+
+def start_staging(connection, jobid, node_name, stages):
+    """Make the copies of stages on a node of a running job, in the background.
+
+    The copies run in their own job step, detached from the connection, so
+    that nothing waits for them when the session ends. Their progress is
+    written to ~/.milatools/stage/JOBID.log.
+    """
+    from .remote import Remote
+    from .utils import shjoin
+
+    remote = Remote(hostname="->", connection=connection)
+    log = f".milatools/stage/{jobid}.log"
+    srun = ["srun", "--jobid", jobid, "--overlap", "-N1", "-n1", "-w", node_name]
+    step = shjoin([*srun, "bash", "-c", f"{stage_script(stages)}wait"])
+    print(f"Staging data to $SLURM_TMPDIR on {node_name}, progress in ~/{log}")
+    remote.run(
+        f"mkdir -p .milatools/stage; setsid nohup {step} > {log} 2>&1 < /dev/null &",
+        hide=True,
+        warn=True,
+    )
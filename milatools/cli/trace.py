@@ -0,0 +1,244 @@
+"""Timing of the remote operations performed by a command.
+
+Tracing is enabled with ``mila --trace PATH`` or ``MILATOOLS_TRACE=PATH``.
+Every remote command, file transfer, local command and port forward is then
+recorded as a span, which is written to PATH when the command ends, in the
+Chrome trace format (open it in chrome://tracing or https://ui.perfetto.dev),
+or as one JSON object per line if PATH ends with ``.jsonl``. A summary of the
+round trips and of the critical path is also printed.
+
+When tracing is disabled, span() does nothing.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Kinds of spans that are a round trip to a remote host
+round_trip_kinds = {"run", "extract", "put", "get", "connect"}
+
+_tracer = None
+
+
+class Span:
+    def __init__(self, kind, host, attrs):
+        self.kind = kind
+        self.host = host
+        self.attrs = attrs
+        self.thread = threading.current_thread().name
+        self.start = None
+        self.end = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def label(self):
+        attrs = self.attrs
+        what = str(
+            attrs.get("command") or attrs.get("path") or attrs.get("destination") or ""
+        )
+        if len(what) > 60:
+            what = what[:57] + "..."
+        return f"{self.kind} ({self.host}) {what}".rstrip()
+
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Tracer:
+    """Collects the spans of all threads."""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def events(self):
+        """Return the spans as dicts, in the order in which they started."""
+        return [
+            {
+                "kind": s.kind,
+                "host": s.host,
+                "thread": s.thread,
+                "start": s.start - self.origin,
+                "duration": s.duration,
+                **s.attrs,
+            }
+            for s in sorted(self.spans, key=lambda s: s.start)
+        ]
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for event in self.events():
+            tid = threads.setdefault(event["thread"], len(threads))
+            events.append(
+                {
+                    "name": f"{event['kind']} {event['host']}",
+                    "cat": event["kind"],
+                    "ph": "X",
+                    "ts": round(event.pop("start") * 1e6),
+                    "dur": round(event.pop("duration") * 1e6),
+                    "pid": pid,
+                    "tid": tid,
+                    "args": event,
+                }
+            )
+        for name, tid in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path):
+        with open(path, "w") as f:
+            if str(path).endswith(".jsonl"):
+                for event in self.events():
+                    f.write(json.dumps(event, default=str) + "\n")
+            else:
+                json.dump(self.chrome_trace(), f, default=str)
+
+    def critical_path(self):
+        """Return the chain of spans that determined the total time.
+
+        Starting from the span that ended last, each step goes to the span
+        that ended last before the current one started.
+        """
+        path = []
+        spans = sorted(self.spans, key=lambda s: (s.end, s.duration))
+        limit = float("inf")
+        while True:
+            candidates = [s for s in spans if s.end <= limit]
+            if not candidates:
+                break
+            span = candidates[-1]
+            path.append(span)
+            limit = span.start
+        return path[::-1]
+
+    def summary(self):
+        lines = []
+        # Commands started in the background are counted by their extract span
+        trips = Counter(
+            (s.host, s.kind)
+            for s in self.spans
+            if s.kind in round_trip_kinds and not s.attrs.get("asynchronous")
+        )
+        total = time.perf_counter() - self.origin
+        lines.append(f"{len(self.spans)} spans in {total:.2f}s")
+        lines.append(f"Round trips: {sum(trips.values())}")
+        for host in sorted({host for host, _ in trips}):
+            counts = ", ".join(
+                f"{n} {kind}" for (h, kind), n in sorted(trips.items()) if h == host
+            )
+            lines.append(f"    {host:30} : {counts}")
+        lines.append("Critical path:")
+        for span in self.critical_path():
+            start = span.start - self.origin
+            lines.append(f"    {start:8.3f}s {span.duration:8.3f}s  {span.label}")
+        return "\n".join(lines)
+
+
+@contextmanager
+def span(kind, host, **attrs):
+    """Record the time it takes to run the body of the with statement.
+
+    Yields an object whose set() method adds attributes to the span, such as
+    an exit code or a number of bytes.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield _null_span
+        return
+    s = Span(kind, host, attrs)
+    s.start = time.perf_counter()
+    try:
+        yield s
+    except BaseException as exc:
+        s.set(error=type(exc).__name__)
+        raise
+    finally:
+        s.end = time.perf_counter()
+        tracer.add(s)
+
+
+def transform_names(transforms):
+    """Describe a chain of command transforms.
+
+    >>> transform_names(["source {} && {{}}".format, str.upper])
+    ['source {} && {{}}', 'str.upper']
+    """
+    names = []
+    for transform in transforms:
+        template = getattr(transform, "__self__", None)
+        if isinstance(template, str):
+            names.append(template)
+        else:
+            names.append(getattr(transform, "__qualname__", repr(transform)))
+    return names
+
+
+@contextmanager
+def tracing(path, out=sys.stderr):
+    """Record spans while in the with statement, then write them to path.
+
+    Does nothing if path is None.
+    """
+    global _tracer
+    if not path:
+        yield None
+        return
+    _tracer = tracer = Tracer()
+    try:
+        yield tracer
+    finally:
+        _tracer = None
+        tracer.write(path)
+        print(f"Trace written to {path}", file=out)
+        print(tracer.summary(), file=out)
+
+
+@contextmanager
+def profiling(path):
+    """Profile the local CPU time spent in the with statement with cProfile.
+
+    The statistics are written to path, and can be read with pstats or
+    snakeviz. Does nothing if path is None.
+    """
+    if not path:
+        yield None
+        return
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
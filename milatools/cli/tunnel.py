@@ -0,0 +1,501 @@
+"""Port forwarding over an SSH connection, without spawning ssh -L.
+
+Local ports are forwarded to TCP ports (``direct-tcpip`` channels) or Unix
+sockets (``direct-streamlocal@openssh.com`` channels) on the other side of a
+paramiko transport. A single thread relays the data of every forwarded
+connection, with a selector, and never blocks on a slow reader.
+"""
+
+import selectors
+import socket
+import threading
+import time
+
+from fabric import Connection
+from paramiko.channel import Channel
+from paramiko.common import cMSG_CHANNEL_OPEN
+from paramiko.message import Message
+from paramiko.ssh_exception import SSHException
+
+from .daemon import DaemonConnection, DaemonError, DaemonTransport
+from .trace import span
+
+buffer_size = 64 * 1024
+
+
+def open_streamlocal_channel(transport, path, timeout=30):
+    """Open a channel to the Unix socket at path on the remote host.
+
+    This is Transport.open_channel, which only knows how to write the
+    arguments of direct-tcpip channels.
+    """
+    if not transport.active:
+        raise SSHException("SSH session not active")
+    with transport.lock:
+        window_size = transport._sanitize_window_size(None)
+        max_packet_size = transport._sanitize_packet_size(None)
+        chanid = transport._next_channel()
+        m = Message()
+        m.add_byte(cMSG_CHANNEL_OPEN)
+        m.add_string("direct-streamlocal@openssh.com")
+        m.add_int(chanid)
+        m.add_int(window_size)
+        m.add_int(max_packet_size)
+        m.add_string(path)
+        # Reserved fields
+        m.add_string("")
+        m.add_int(0)
+        chan = Channel(chanid)
+        transport._channels.put(chanid, chan)
+        transport.channel_events[chanid] = event = threading.Event()
+        transport.channels_seen[chanid] = True
+        chan._set_transport(transport)
+        chan._set_window(window_size, max_packet_size)
+    transport._send_user_message(m)
+    deadline = time.time() + timeout
+    while not event.wait(0.1):
+        if not transport.active or time.time() > deadline:
+            break
+    chan = transport._channels.get(chanid)
+    if chan is None or not event.is_set():
+        raise transport.get_exception() or SSHException(
+            f"Unable to open a channel to {path}"
+        )
+    return chan
+
+
+def open_channel(transport, dest, src=("127.0.0.1", 0)):
+    """Open a channel to dest, a (host, port) pair or the path to a socket.
+
+    Through a DaemonTransport, the channel is a socket that the daemon relays.
+    """
+    if isinstance(transport, DaemonTransport):
+        return transport.open_relay(dest)
+    if isinstance(dest, str):
+        return open_streamlocal_channel(transport, dest)
+    return transport.open_channel("direct-tcpip", dest_addr=dest, src_addr=src)
+
+
+class ProxyError(Exception):
+    pass
+
+
+def _recv_exact(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ProxyError("Connection closed during the proxy handshake")
+        data += chunk
+    return data
+
+
+def proxy_pac(port, domains):
+    """Return a proxy auto-config file that sends domains through the proxy."""
+    conditions = " || ".join(f'dnsDomainIs(host, "{domain}")' for domain in domains)
+    return (
+        "function FindProxyForURL(url, host) {\n"
+        f"  if ({conditions})\n"
+        f'    return "SOCKS5 localhost:{port}; SOCKS localhost:{port}";\n'
+        '  return "DIRECT";\n'
+        "}\n"
+    )
+
+
+class Proxy:
+    """Handshake of a SOCKS5 proxy, that also understands HTTP CONNECT.
+
+    The destination host is not resolved locally. It goes through resolve(),
+    and then to the other side of the SSH connection, which resolves it.
+    An HTTP GET for /proxy.pac returns the pac file, if there is one.
+    """
+
+    def __init__(self, http=True, resolve=None, pac=None):
+        self.http = http
+        self.resolve = resolve or (lambda host: host)
+        self.pac = pac
+
+    def handshake(self, sock):
+        """Read the request on sock.
+
+        Returns (destination, reply), where reply(ok) answers the client
+        once the channel is opened, or (None, None) if nothing is to be
+        forwarded.
+        """
+        if sock.recv(1, socket.MSG_PEEK) == b"\x05":
+            return self._socks5(sock)
+        elif self.http:
+            return self._http(sock)
+        else:
+            raise ProxyError("Not a SOCKS5 request")
+
+    def _socks5(self, sock):
+        _, nmethods = _recv_exact(sock, 2)
+        if 0 not in _recv_exact(sock, nmethods):
+            sock.sendall(b"\x05\xff")
+            raise ProxyError("The client requires authentication")
+        sock.sendall(b"\x05\x00")
+        _, cmd, _, atyp = _recv_exact(sock, 4)
+        if atyp == 1:
+            host = socket.inet_ntop(socket.AF_INET, _recv_exact(sock, 4))
+        elif atyp == 3:
+            host = _recv_exact(sock, _recv_exact(sock, 1)[0]).decode("idna")
+        elif atyp == 4:
+            host = socket.inet_ntop(socket.AF_INET6, _recv_exact(sock, 16))
+        else:
+            sock.sendall(b"\x05\x08\x00\x01" + bytes(6))
+            raise ProxyError(f"Unknown address type: {atyp}")
+        port = int.from_bytes(_recv_exact(sock, 2), "big")
+        if cmd != 1:
+            sock.sendall(b"\x05\x07\x00\x01" + bytes(6))
+            raise ProxyError("Only CONNECT is supported")
+
+        def reply(ok):
+            # 0: succeeded, 5: connection refused
+            sock.sendall(
+                b"\x05" + (b"\x00" if ok else b"\x05") + b"\x00\x01" + bytes(6)
+            )
+
+        return (self.resolve(host), port), reply
+
+    def _http(self, sock):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = sock.recv(4096)
+            if not chunk or len(request) > 65536:
+                raise ProxyError("Invalid HTTP request")
+            request += chunk
+        method, target, _ = request.split(b"\r\n", 1)[0].decode("latin1").split(" ", 2)
+        if method == "CONNECT":
+            host, _, port = target.rpartition(":")
+
+            def reply(ok):
+                status = "200 Connection established" if ok else "502 Bad Gateway"
+                sock.sendall(f"HTTP/1.1 {status}\r\n\r\n".encode("latin1"))
+
+            return (self.resolve(host.strip("[]")), int(port)), reply
+        elif method == "GET" and target == "/proxy.pac" and self.pac:
+            body = self.pac.encode("utf8")
+            sock.sendall(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: application/x-ns-proxy-autoconfig\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode("latin1")
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+        else:
+            sock.sendall(
+                b"HTTP/1.1 405 Method Not Allowed\r\nConnection: close\r\n\r\n"
+            )
+        return None, None
+
+
+def node_connection(node, login=None):
+    """Return an open Connection to a compute node.
+
+    The connection goes through the login node's connection when it is an
+    open Fabric Connection, which saves a handshake. Otherwise, the SSH
+    config (ProxyJump) is used.
+    """
+    gateway = login if isinstance(login, Connection) else None
+    connection = Connection(node, gateway=gateway)
+    with span("connect", node, gateway=gateway is not None):
+        connection.open()
+    return connection
+
+
+def shutdown_write(end):
+    """Pass the end of file on to end, a socket or a channel."""
+    if isinstance(end, Channel):
+        end.shutdown_write()
+    else:
+        end.shutdown(socket.SHUT_WR)
+
+
+def pipe(src, dst):
+    """Copy src to dst until the end of file, with blocking calls."""
+    try:
+        while True:
+            data = src.recv(buffer_size)
+            if not data:
+                break
+            dst.sendall(data)
+        shutdown_write(dst)
+    except OSError:
+        pass
+
+
+class _Pair:
+    """A local socket and the channel it is relayed to.
+
+    The channel is a paramiko Channel, or a socket relayed by the daemon.
+
+    The data read from an end waits in the buffer of the other end until it
+    can be written. An end is not read from while that buffer is full.
+    """
+
+    def __init__(self, sock, chan):
+        self.sock = sock
+        self.chan = chan
+        self.buffers = {sock: bytearray(), chan: bytearray()}
+        # Selector events each end is registered for
+        self.events = {sock: 0, chan: 0}
+        self.eof = set()
+        self.shut = set()
+
+    def other(self, end):
+        return self.chan if end is self.sock else self.sock
+
+
+class Forwarder:
+    """Forward local ports through an SSH transport.
+
+    Destinations are given to forward() and may be added while the forwarder
+    is running. Channels are opened in short-lived threads, since opening one
+    takes a round trip, but all the data goes through a single relay thread.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.listeners = []
+        self.pairs = set()
+        self.closed = threading.Event()
+        self.callbacks = []
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def forward(self, dest, local_port=0, local_host="localhost"):
+        """Forward local_port to dest, a (host, port) pair or a socket path.
+
+        Returns the local port, which is chosen by the OS if local_port is 0.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((local_host, local_port))
+        sock.listen(16)
+        sock.setblocking(False)
+        self._schedule(lambda: self._listen(sock, dest))
+        return sock.getsockname()[1]
+
+    def proxy(self, proxy, local_port=0, local_host="localhost"):
+        """Run a proxy on local_port. Destinations are given by the clients.
+
+        Returns the local port, which is chosen by the OS if local_port is 0.
+        """
+        return self.forward(proxy, local_port=local_port, local_host=local_host)
+
+    def add_done_callback(self, fn):
+        """Call fn() in the relay thread once the forwarder is closed."""
+        with self.lock:
+            if not self.closed.is_set():
+                self.callbacks.append(fn)
+                return
+        fn()
+
+    def close(self):
+        self._schedule(None)
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    # Everything below runs in the relay thread, except _connect
+
+    def _schedule(self, fn):
+        with self.lock:
+            self.pending.append(fn)
+        try:
+            self._wake_w.send(b"x")
+        except OSError:
+            pass
+
+    def _listen(self, sock, dest):
+        self.listeners.append(sock)
+        self.selector.register(sock, selectors.EVENT_READ, dest)
+
+    def _accept(self, listener, dest):
+        try:
+            sock, addr = listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(True)
+        threading.Thread(
+            target=self._connect, args=(sock, addr, dest), daemon=True
+        ).start()
+
+    def _connect(self, sock, addr, dest):
+        reply = chan = None
+        try:
+            if isinstance(dest, Proxy):
+                dest, reply = dest.handshake(sock)
+                if dest is None:
+                    sock.close()
+                    return
+            chan = open_channel(self.transport, dest, src=addr[:2])
+            if reply is not None:
+                reply(True)
+        except (OSError, ValueError, SSHException, ProxyError, DaemonError):
+            try:
+                if chan is not None:
+                    chan.close()
+                elif reply is not None:
+                    reply(False)
+            except OSError:
+                pass
+            sock.close()
+            return
+        self._schedule(lambda: self._add_pair(_Pair(sock, chan)))
+
+    def _add_pair(self, pair):
+        pair.sock.setblocking(False)
+        if not isinstance(pair.chan, Channel):
+            pair.chan.setblocking(False)
+        self.pairs.add(pair)
+        self._update(pair)
+
+    def _update(self, pair):
+        """Register the ends of pair for the events they wait for."""
+        for end in (pair.sock, pair.chan):
+            events = 0
+            if end not in pair.eof and len(pair.buffers[pair.other(end)]) < buffer_size:
+                events |= selectors.EVENT_READ
+            if not isinstance(end, Channel) and pair.buffers[end]:
+                # Channels have no write event, _loop polls them instead
+                events |= selectors.EVENT_WRITE
+            if events == pair.events[end]:
+                continue
+            if not pair.events[end]:
+                self.selector.register(end, events, pair)
+            elif not events:
+                self.selector.unregister(end)
+            else:
+                self.selector.modify(end, events, pair)
+            pair.events[end] = events
+
+    def _close_pair(self, pair):
+        self.pairs.discard(pair)
+        for end in (pair.sock, pair.chan):
+            if pair.events[end]:
+                self.selector.unregister(end)
+                pair.events[end] = 0
+            end.close()
+
+    def _relay(self, pair, end):
+        """Read from end into the buffer of the other end, and flush it."""
+        try:
+            data = end.recv(buffer_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        other = pair.other(end)
+        if data:
+            pair.buffers[other] += data
+        else:
+            # End of file on this side, passed on once other is flushed
+            pair.eof.add(end)
+        self._flush(pair, other)
+
+    def _flush(self, pair, end):
+        """Write as much of the buffer of end as can be without blocking."""
+        buffer = pair.buffers[end]
+        try:
+            while buffer:
+                if isinstance(end, Channel) and not end.send_ready():
+                    break
+                del buffer[: end.send(bytes(buffer[:buffer_size]))]
+            if not buffer and pair.other(end) in pair.eof and end not in pair.shut:
+                pair.shut.add(end)
+                if len(pair.eof) == 2 and not any(pair.buffers.values()):
+                    return self._close_pair(pair)
+                shutdown_write(end)
+        except BlockingIOError:
+            pass
+        except OSError:
+            return self._close_pair(pair)
+        self._update(pair)
+
+    def _run_pending(self):
+        try:
+            while self._wake_r.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for fn in pending:
+            if fn is None:
+                return False
+            fn()
+        return True
+
+    def _loop(self):
+        try:
+            while self.transport.is_active():
+                # Channels waiting for their window to open are polled
+                waiting = [
+                    pair
+                    for pair in self.pairs
+                    if isinstance(pair.chan, Channel) and pair.buffers[pair.chan]
+                ]
+                timeout = 0.01 if waiting else 1
+                for key, mask in self.selector.select(timeout=timeout):
+                    if key.data is None:
+                        if not self._run_pending():
+                            return
+                    elif key.fileobj in self.listeners:
+                        self._accept(key.fileobj, key.data)
+                    elif key.data in self.pairs and mask & selectors.EVENT_WRITE:
+                        self._flush(key.data, key.fileobj)
+                    elif key.data in self.pairs:
+                        self._relay(key.data, key.fileobj)
+                for pair in waiting:
+                    if pair in self.pairs:
+                        self._flush(pair, pair.chan)
+        finally:
+            for pair in list(self.pairs):
+                self._close_pair(pair)
+            for sock in self.listeners:
+                sock.close()
+            self.selector.close()
+            self._wake_r.close()
+            self._wake_w.close()
+            with self.lock:
+                self.closed.set()
+                callbacks, self.callbacks = self.callbacks, []
+            for fn in callbacks:
+                fn()
+
+
+def open_forwarder(host, login=None):
+    """Return a Forwarder through a connection to host.
+
+    login is the connection to the login node. It is used directly if host
+    is the login node, and as the gateway to compute nodes otherwise. If it
+    is a DaemonConnection, the daemon holds the connections to both, and
+    relays the forwarded ports.
+    """
+    is_login = isinstance(login, (Connection, DaemonConnection)) and host in (
+        login.original_host,
+        login.host,
+    )
+    if isinstance(login, DaemonConnection):
+        if is_login:
+            transport = DaemonTransport(login.path, login.original_host)
+        else:
+            transport = DaemonTransport(login.path, host, via=login.original_host)
+        forwarder = Forwarder(transport)
+    elif is_login:
+        login.open()
+        forwarder = Forwarder(login.transport)
+    else:
+        connection = node_connection(host, login)
+        forwarder = Forwarder(connection.transport)
+        forwarder.add_done_callback(connection.close)
+    forwarder.host = host
+    return forwarder
@@ -1,32 +1,34 @@
 from __future__ import annotations
 
-import contextvars
 import itertools
 import random
 import shlex
-from contextlib import contextmanager
+import socket
 from pathlib import Path
 
-import blessed
-import questionary as qn
-from invoke.exceptions import UnexpectedExit
-from sshconf import read_ssh_config
+from .cache import RemoteCache, cache_dir
 
-control_file_var = contextvars.ContextVar("control_file", default="/dev/null")
+# blessed, questionary, invoke and sshconf are imported where they are used,
+# because they make up most of the startup time of the mila command.
 
-T = blessed.Terminal()
 
-here = Path(__file__).parent
+class LazyTerminal:
+    """Stand-in for blessed.Terminal() that creates it on first use."""
+
+    def __init__(self):
+        self._term = None
+
+    def __getattr__(self, attr):
+        if self._term is None:
+            import blessed
+
+            self._term = blessed.Terminal()
+        return getattr(self._term, attr)
+
 
-style = qn.Style(
-    [
-        ("envname", "yellow bold"),
-        ("envpath", "cyan"),
-        ("prefix", "bold"),
-        ("special", "orange bold"),
-        ("cancel", "grey bold"),
-    ]
-)
+T = LazyTerminal()
+
+here = Path(__file__).parent
 
 vowels = list("aeiou")
 consonants = list("bdfgjklmnprstvz")
@@ -41,25 +43,6 @@ def randname():
     return f"{a}{b}-{c}{d}"
 
 
-@contextmanager
-def with_control_file(remote, name=None):
-    name = name or randname()
-    pth = f".milatools/control/{name}"
-    remote.run("mkdir -p ~/.milatools/control", hide=True)
-
-    try:
-        remote.simple_run(f"[ -f {pth} ]")
-        exit(f"Server {name} already exists. You may use mila serve kill to remove it.")
-    except UnexpectedExit:
-        pass
-
-    token = control_file_var.set(pth)
-    try:
-        yield pth
-    finally:
-        control_file_var.reset(token)
-
-
 class MilatoolsUserError(Exception):
     pass
 
@@ -87,10 +70,15 @@ class CommandNotFoundError(MilatoolsUserError):
 
 
 def yn(prompt: str, default: bool = True) -> bool:
+    import questionary as qn
+
     return qn.confirm(prompt, default=default).unsafe_ask()
 
 
 def askpath(prompt, remote):
+    import questionary as qn
+    from invoke.exceptions import UnexpectedExit
+
     while True:
         pth = qn.text(prompt).unsafe_ask()
         try:
@@ -111,6 +99,8 @@ class SSHConfig:
     """Wrapper around sshconf with some extra niceties."""
 
     def __init__(self, path):
+        from sshconf import read_ssh_config
+
         self.cfg = read_ssh_config(path)
         self.add = self.cfg.add
         self.remove = self.cfg.remove
@@ -132,3 +122,18 @@ def qualified(node_name):
     if "." not in node_name and not node_name.endswith(".server.mila.quebec"):
         node_name = f"{node_name}.server.mila.quebec"
     return node_name
+
+
+def running_on_mila():
+    """Return whether this machine is a node of the Mila cluster.
+
+    socket.getfqdn() can block on a reverse DNS lookup for seconds, so it is
+    only called when the hostname is not already qualified, and its result is
+    cached for each hostname.
+    """
+    hostname = socket.gethostname()
+    if "." in hostname:
+        return hostname.endswith(".server.mila.quebec")
+    cache = RemoteCache(hostname, "local", path=cache_dir() / "local.json")
+    fqdn = cache.get_or_set(f"fqdn:{hostname}", socket.getfqdn)
+    return fqdn.endswith(".server.mila.quebec")
@@ -1,5 +1,8 @@
+import shutil
 from subprocess import CompletedProcess
 
+import invoke
+
 cmdtest = """===============
 Captured stdout
 ===============
@@ -32,3 +35,21 @@ def output_tester(func, capsys, file_regression):
         file_regression.check(
             cmdtest.format(cout=captured.out, cerr=captured.err, out=out, err=err)
         )
+
+
+class LocalConnection(invoke.Context):
+    """Stand-in for fabric.Connection that runs commands on the local machine."""
+
+    def open(self):
+        pass
+
+    def run(self, command, **kwargs):
+        # Commands never need stdin in tests, and pytest does not allow it
+        kwargs.setdefault("in_stream", False)
+        return super().run(command, **kwargs)
+
+    def put(self, local, remote=None):
+        shutil.copy(local, remote)
+
+    def get(self, remote, local=None):
+        shutil.copy(remote, local)
@@ -0,0 +1,330 @@
+"""Stand-ins for salloc, srun, sbatch, squeue and scancel, for offline tests.
+
+Run as ``python fake_slurm.py <command> <args...>``. The jobs are JSON files
+in $FAKE_SLURM_DIR/jobs. A job waits $FAKE_SLURM_DELAY seconds in the queue,
+then runs on the nodes in $FAKE_SLURM_NODES (cn-a001 by default), where
+$SLURMD_NODENAME, $SLURM_JOB_ID and $SLURM_TMPDIR are set.
+"""
+
+import fcntl
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Options that take a value when it is not given with =
+value_options = {
+    "-J",
+    "-w",
+    "-N",
+    "-n",
+    "-c",
+    "-t",
+    "-p",
+    "-G",
+    "-o",
+    "--jobid",
+    "--job-name",
+    "--nodelist",
+    "--gres",
+    "--mem",
+    "--time",
+    "--partition",
+    "--cpus-per-task",
+    "--comment",
+    "--output",
+}
+
+
+def state_dir():
+    return Path(os.environ["FAKE_SLURM_DIR"])
+
+
+def job_file(jobid):
+    return state_dir() / "jobs" / f"{jobid}.json"
+
+
+def parse_options(args):
+    """Split args into ({option: value}, rest) at the first non-option.
+
+    >>> parse_options(["-J", "x", "--gres=gpu:1", "--overlap", "bash", "-c", "ls"])
+    ({'-J': 'x', '--gres': 'gpu:1', '--overlap': True}, ['bash', '-c', 'ls'])
+    """
+    options = {}
+    args = list(args)
+    while args and args[0].startswith("-"):
+        arg = args.pop(0)
+        if "=" in arg:
+            arg, value = arg.split("=", 1)
+        elif arg in value_options:
+            value = args.pop(0)
+        else:
+            value = True
+        options[arg] = value
+    return options, args
+
+
+def new_job(options, pid):
+    (state_dir() / "jobs").mkdir(parents=True, exist_ok=True)
+    with open(state_dir() / "next_id", "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        jobid = int(f.read() or 1000)
+        f.seek(0)
+        f.truncate()
+        f.write(str(jobid + 1))
+    job = {
+        "id": str(jobid),
+        "name": options.get("-J") or options.get("--job-name") or "bash",
+        "comment": options.get("--comment", "(null)"),
+        "state": "PENDING",
+        "nodes": "",
+        "pid": pid,
+    }
+    save_job(job)
+    return job
+
+
+def save_job(job):
+    tmp = job_file(job["id"]).with_suffix(".tmp")
+    tmp.write_text(json.dumps(job))
+    tmp.rename(job_file(job["id"]))
+
+
+def load_job(jobid):
+    try:
+        return json.loads(job_file(jobid).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def end_job(jobid):
+    try:
+        job_file(jobid).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def start_job(job):
+    """Wait in the queue, then mark the job as running and return its env."""
+    time.sleep(float(os.environ.get("FAKE_SLURM_DELAY", "0")))
+    job["state"] = "RUNNING"
+    job["nodes"] = os.environ.get("FAKE_SLURM_NODES", "cn-a001")
+    save_job(job)
+    return job_env(job)
+
+
+def first_node(nodes):
+    """Return the first node of a node list.
+
+    >>> first_node("cn-a[003-005,009],cn-b001")
+    'cn-a003'
+    """
+    prefix, _, rest = nodes.partition("[")
+    if not rest:
+        return prefix.split(",")[0]
+    return prefix + re.split("[-,\\]]", rest)[0]
+
+
+def job_env(job, node=None):
+    tmpdir = state_dir() / "tmp" / job["id"]
+    tmpdir.mkdir(parents=True, exist_ok=True)
+    return {
+        **os.environ,
+        "SLURM_JOB_ID": job["id"],
+        "SLURM_JOB_NODELIST": job["nodes"],
+        "SLURMD_NODENAME": node or first_node(job["nodes"]),
+        "SLURM_TMPDIR": str(tmpdir),
+    }
+
+
+def on_terminate(jobid):
+    def handler(signum, frame):
+        end_job(jobid)
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGHUP, handler)
+
+
+def salloc(args):
+    options, _ = parse_options(args)
+    job = new_job(options, os.getpid())
+    on_terminate(job["id"])
+    print(f"salloc: Pending job allocation {job['id']}", flush=True)
+    start_job(job)
+    print(f"salloc: Granted job allocation {job['id']}", flush=True)
+    print(f"salloc: Nodes {job['nodes']} are ready for job", flush=True)
+    # The allocation is held until salloc is killed
+    while True:
+        time.sleep(1000)
+
+
+def srun(args):
+    options, command = parse_options(args)
+    node = options.get("-w") or options.get("--nodelist")
+    jobid = options.get("--jobid")
+    if jobid is not None:
+        job = load_job(jobid)
+        if job is None:
+            sys.exit(f"srun: error: Invalid job id specified: {jobid}")
+        env = job_env(job, node)
+        return subprocess.call(command, env=env)
+    job = new_job(options, os.getpid())
+    on_terminate(job["id"])
+    try:
+        return subprocess.call(command, env=start_job(job))
+    finally:
+        end_job(job["id"])
+
+
+def sbatch(args):
+    options, rest = parse_options(args)
+    if rest:
+        script = rest[0]
+    else:
+        # Like sbatch, read the script from stdin if no file is given
+        (state_dir() / "scripts").mkdir(parents=True, exist_ok=True)
+        script = state_dir() / "scripts" / f"{time.time_ns()}.sh"
+        script.write_text(sys.stdin.read())
+    for line in Path(script).read_text().splitlines():
+        if line.startswith("#SBATCH "):
+            options = {**parse_options(line.split()[1:])[0], **options}
+    output = options.get("--output") or options.get("-o") or "slurm-%j.out"
+    job = new_job(options, None)
+    job["output"] = output.replace("%j", job["id"])
+    save_job(job)
+    proc = subprocess.Popen(
+        [sys.executable, __file__, "_batch", job["id"], script],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    job["pid"] = proc.pid
+    save_job(job)
+    print(f"Submitted batch job {job['id']}")
+
+
+def _batch(args):
+    jobid, script = args
+    on_terminate(jobid)
+    job = load_job(jobid)
+    while job["pid"] is None:
+        time.sleep(0.01)
+        job = load_job(jobid)
+    env = start_job(job)
+    try:
+        with open(job["output"], "a") as out:
+            return subprocess.call(["bash", script], stdout=out, stderr=out, env=env)
+    finally:
+        end_job(jobid)
+
+
+def alive(job):
+    try:
+        os.kill(job["pid"], 0)
+        return True
+    except (ProcessLookupError, TypeError):
+        return job["pid"] is None
+    except PermissionError:
+        return True
+
+
+def jobs():
+    for path in sorted((state_dir() / "jobs").glob("*.json")):
+        job = load_job(path.stem)
+        if job is None:
+            continue
+        if alive(job):
+            yield job
+        else:
+            end_job(job["id"])
+
+
+def squeue(args):
+    fmt = "%i %j %T %N"
+    header = True
+    filters = {}
+    while args:
+        arg = args.pop(0)
+        if arg in ("-h", "--noheader"):
+            header = False
+        elif arg in ("-o", "--format"):
+            fmt = args.pop(0)
+        elif arg.startswith("--format="):
+            fmt = arg.split("=", 1)[1]
+        elif arg in ("-ho", "-oh"):
+            header = False
+            fmt = args.pop(0)
+        elif arg in ("-j", "--jobs", "-n", "--name", "-t", "--states"):
+            filters[arg.lstrip("-")[0]] = args.pop(0).split(",")
+        elif arg.split("=")[0] in ("--jobs", "--name", "--states"):
+            key, value = arg.split("=", 1)
+            filters[key.lstrip("-")[0]] = value.split(",")
+    fields = {"i": "id", "j": "name", "T": "state", "N": "nodes", "k": "comment"}
+    if header:
+        print(fmt.replace("%", ""))
+    for job in jobs():
+        if (
+            job["id"] not in filters.get("j", [job["id"]])
+            or job["name"] not in filters.get("n", [job["name"]])
+            or job["state"] not in filters.get("t", [job["state"]])
+        ):
+            continue
+        line = fmt
+        for code, field in fields.items():
+            line = line.replace(f"%{code}", job[field])
+        print(line)
+
+
+def scancel(args):
+    for jobid in args:
+        job = load_job(jobid)
+        if job is None:
+            continue
+        end_job(jobid)
+        if job["pid"] is not None:
+            try:
+                # Batch jobs run in their own process group
+                os.killpg(job["pid"], signal.SIGTERM)
+            except ProcessLookupError:
+                try:
+                    os.kill(job["pid"], signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+
+commands = {
+    "salloc": salloc,
+    "srun": srun,
+    "sbatch": sbatch,
+    "squeue": squeue,
+    "scancel": scancel,
+    "_batch": _batch,
+}
+
+
+def install(bin_dir):
+    """Write a shim for each Slurm command in bin_dir, and one for hostname."""
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name in commands:
+        if not name.startswith("_"):
+            shim = bin_dir / name
+            shim.write_text(
+                f'#!/bin/sh\nexec {sys.executable} {__file__} {name} "$@"\n'
+            )
+            shim.chmod(0o755)
+    # Batch scripts find out which node they run on with $(hostname)
+    shim = bin_dir / "hostname"
+    shim.write_text('#!/bin/sh\necho "${SLURMD_NODENAME:-login-1}"\n')
+    shim.chmod(0o755)
+
+
+if __name__ == "__main__":
+    sys.exit(commands[sys.argv[1]](sys.argv[2:]))
@@ -0,0 +1,374 @@
+"""SSH server that runs commands on the local machine, for offline tests.
+
+It accepts any public key, runs exec requests with bash in a fake home
+directory, serves SFTP in that directory, and forwards direct-tcpip and
+direct-streamlocal channels. Connections to port 22 of any host come back to
+the server itself, so it also stands in for the compute nodes. Every request
+that takes a round trip on a real cluster is delayed by ``latency`` seconds
+and counted in ``stats``.
+"""
+
+import os
+import socket
+import subprocess
+import threading
+import time
+from collections import Counter
+
+import paramiko
+from paramiko.sftp import SFTP_NO_SUCH_FILE, SFTP_OK
+
+_host_key = None
+
+
+def host_key():
+    """Return the server's key, which is slow to generate, so it is shared."""
+    global _host_key
+    if _host_key is None:
+        _host_key = paramiko.RSAKey.generate(2048)
+    return _host_key
+
+
+def _relay(chan, sock):
+    """Copy data both ways between a channel and a socket until either closes."""
+
+    def pump(src, dst):
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for end in (src, dst):
+                try:
+                    end.close()
+                except OSError:
+                    pass
+
+    threading.Thread(target=pump, args=(chan, sock), daemon=True).start()
+    threading.Thread(target=pump, args=(sock, chan), daemon=True).start()
+
+
+class _Transport(paramiko.Transport):
+    # Transport only passes the kind of the channel to check_channel_request,
+    # so the socket path of direct-streamlocal channels is read here first.
+    def _parse_channel_open(self, m):
+        pos = m.packet.tell()
+        kind = m.get_text()
+        if kind == "direct-streamlocal@openssh.com":
+            m.get_int()
+            m.get_int()
+            m.get_int()
+            self.streamlocal_path = m.get_text()
+        m.packet.seek(pos)
+        return super()._parse_channel_open(m)
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _SFTPInterface(paramiko.SFTPServerInterface):
+    def __init__(self, server, fake, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.fake = fake
+
+    def _path(self, path):
+        return os.path.join(self.fake.home, path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(self._path(path))
+
+    def open(self, path, flags, attr):
+        self.fake.delay("sftp")
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [
+                paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(path, name)), name
+                )
+                for name in os.listdir(path)
+            ]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self._path(path), attr)
+            return SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+            return SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+            return SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+            return SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+            return SFTP_OK
+        except FileNotFoundError:
+            return SFTP_NO_SUCH_FILE
+
+
+class _Session(paramiko.ServerInterface):
+    """Handles the requests of one connection."""
+
+    def __init__(self, fake, transport):
+        self.fake = fake
+        self.transport = transport
+        self.ptys = set()
+        # Destination of the forwarded channels, by channel id
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        self.fake.delay("connect")
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        elif kind == "direct-streamlocal@openssh.com":
+            self.destinations[chanid] = self.transport.streamlocal_path
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, *args):
+        self.ptys.add(channel.get_id())
+        return True
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        pty = channel.get_id() in self.ptys
+        threading.Thread(
+            target=self.fake.execute,
+            args=(channel, command.decode("utf8"), pty),
+            daemon=True,
+        ).start()
+        return True
+
+
+class FakeSSHServer:
+    """SSH server on localhost that runs commands with env in home.
+
+    Each connection, command, SFTP file and forwarded channel is delayed by
+    latency seconds, and counted in stats.
+    """
+
+    def __init__(self, home, env=None, latency=0.0):
+        self.home = str(home)
+        self.env = {**os.environ, **(env or {}), "HOME": self.home}
+        self.latency = latency
+        self.stats = Counter()
+        self.commands = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        self.closed = False
+
+    def __enter__(self):
+        self.sock.listen(16)
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+    def reset(self):
+        self.stats.clear()
+        self.commands.clear()
+
+    def delay(self, kind):
+        self.stats[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, sock):
+        """Serve SSH on sock, which may also be a channel of another connection."""
+        transport = _Transport(sock)
+        self.transports.append(transport)
+        transport.add_server_key(host_key())
+        transport.set_subsystem_handler(
+            "sftp", paramiko.SFTPServer, _SFTPInterface, self
+        )
+        session = _Session(self, transport)
+        try:
+            transport.start_server(server=session)
+        except (paramiko.SSHException, EOFError, OSError):
+            return
+        # The transport only keeps weak references to the channels
+        sessions = []
+        while transport.is_active():
+            chan = transport.accept(timeout=0.5)
+            sessions = [c for c in sessions if not c.closed]
+            if chan is None:
+                continue
+            dest = session.destinations.pop(chan.get_id(), None)
+            if dest is None:
+                sessions.append(chan)
+            else:
+                threading.Thread(
+                    target=self._forward, args=(chan, dest), daemon=True
+                ).start()
+
+    def _forward(self, chan, dest):
+        self.delay("forward")
+        if isinstance(dest, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            addr = dest
+        elif dest[1] == 22:
+            # A compute node: the connection comes back to this server
+            return self.serve(chan)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            addr = ("127.0.0.1", dest[1])
+        try:
+            sock.connect(addr)
+        except OSError:
+            sock.close()
+            chan.close()
+            return
+        _relay(chan, sock)
+
+    def execute(self, chan, command, pty):
+        """Run command with bash, relaying stdin, stdout, stderr and the exit code.
+
+        The command is killed when the client closes the channel.
+        """
+        self.commands.append(command)
+        self.delay("exec")
+        proc = subprocess.Popen(
+            ["bash", "-c", command],
+            cwd=self.home,
+            env=self.env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if pty else subprocess.PIPE,
+            start_new_session=True,
+        )
+
+        def pump(src, send):
+            try:
+                for data in iter(lambda: src.read1(65536), b""):
+                    send(data)
+            except OSError:
+                pass
+
+        def feed():
+            try:
+                for data in iter(lambda: chan.recv(65536), b""):
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except OSError:
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        pumps = [threading.Thread(target=pump, args=(proc.stdout, chan.sendall))]
+        if not pty:
+            pumps.append(
+                threading.Thread(target=pump, args=(proc.stderr, chan.sendall_stderr))
+            )
+        for thread in [*pumps, threading.Thread(target=feed)]:
+            thread.daemon = True
+            thread.start()
+        while proc.poll() is None:
+            if chan.closed or not chan.get_transport().is_active():
+                try:
+                    os.killpg(proc.pid, 15)
+                except ProcessLookupError:
+                    pass
+            time.sleep(0.02)
+        for thread in pumps:
+            thread.join()
+        code = proc.returncode
+        try:
+            # Like a shell, 128 + the signal for killed processes
+            chan.send_exit_status(code if code >= 0 else 128 - code)
+            chan.close()
+        except OSError:
+            pass
@@ -0,0 +1,158 @@
+import asyncio
+import http.server
+import socket
+import threading
+import time
+
+import pytest
+from invoke.exceptions import UnexpectedExit
+
+from milatools.cli.aio import (
+    AsyncRemote,
+    to_thread,
+    wait_first,
+    wait_until_ready,
+)
+from milatools.cli.cache import cache_enabled
+from milatools.cli.remote import Remote
+
+from .common import LocalConnection
+
+
+def _remote():
+    return AsyncRemote(Remote("localhost", connection=LocalConnection()))
+
+
+def test_run_concurrently():
+    remote = _remote()
+
+    async def main():
+        return await asyncio.gather(
+            remote.get_output("sleep 0.5; echo a", hide=True),
+            remote.get_output("sleep 0.5; echo b", hide=True),
+        )
+
+    t0 = time.time()
+    assert asyncio.run(main()) == ["a", "b"]
+    assert time.time() - t0 < 0.9
+
+
+def test_lines():
+    remote = _remote()
+
+    async def main():
+        stream = remote.lines("printf 'a\\nb\\nc'", display=False, pty=False)
+        return [line async for line in stream]
+
+    assert asyncio.run(main()) == ["a\n", "b\n", "c"]
+
+
+def test_extract(capsys):
+    remote = _remote()
+
+    async def main():
+        stream, results = await remote.extract(
+            "echo start; echo 'port 1234'; sleep 10; echo end",
+            patterns={"port": "port ([0-9]+)"},
+            pty=False,
+        )
+        stream.kill()
+        return results
+
+    t0 = time.time()
+    assert asyncio.run(main()) == {"port": "1234"}
+    assert time.time() - t0 < 5
+    assert capsys.readouterr().out.endswith("start\nport 1234\n")
+
+
+def test_extract_failure():
+    remote = _remote()
+
+    async def main():
+        await remote.extract("echo nope; exit 3", patterns={"x": "x"}, pty=False)
+
+    with pytest.raises(UnexpectedExit):
+        asyncio.run(main())
+
+
+def test_extract_cancel():
+    remote = _remote()
+
+    async def main():
+        task = asyncio.ensure_future(
+            remote.extract("sleep 30", patterns={"x": "x"}, pty=False)
+        )
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    t0 = time.time()
+    asyncio.run(main())
+    assert time.time() - t0 < 5
+
+
+def test_to_thread_context():
+    async def main():
+        cache_enabled.set(False)
+        return await to_thread(cache_enabled.get)
+
+    assert asyncio.run(main()) is False
+
+
+def test_wait_first():
+    async def main():
+        return await wait_first(asyncio.sleep(10), asyncio.sleep(0.1))
+
+    t0 = time.time()
+    assert asyncio.run(main()) == 1
+    assert time.time() - t0 < 5
+
+
+def test_wait_until_ready():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+        assert asyncio.run(wait_until_ready("localhost", port, timeout=1)) < 1
+
+    assert asyncio.run(wait_until_ready("localhost", port, timeout=0.3)) is None
+
+
+def test_wait_until_ready_http():
+    server = http.server.HTTPServer(
+        ("localhost", 0), http.server.SimpleHTTPRequestHandler
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        port = server.server_address[1]
+        elapsed = asyncio.run(wait_until_ready("localhost", port, path="/", timeout=5))
+        assert elapsed is not None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_wait_until_ready_http_no_app():
+    # Like a tunnel to a port that nothing listens to yet: the connection is
+    # accepted, then closed without a response.
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+
+        def close_connections():
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except OSError:
+                    return
+                conn.close()
+
+        threading.Thread(target=close_connections, daemon=True).start()
+        t0 = time.time()
+        assert (
+            asyncio.run(wait_until_ready("localhost", port, path="/", timeout=1))
+            is None
+        )
+        assert time.time() - t0 < 2
@@ -0,0 +1,43 @@
+import io
+import json
+import os
+
+from milatools.cli.bench import Benchmark, summarize
+from milatools.cli.remote import Remote
+
+from .common import LocalConnection
+
+
+def test_summarize():
+    summary = summarize([0.3, 0.1, 0.2, 0.4, 0.5], unit="s")
+    assert summary["p50"] == 0.3
+    assert summary["min"] == 0.1
+    assert summary["max"] == 0.5
+    assert summary["n"] == 5
+    # The samples are kept, in order, so that runs can be compared later
+    assert summary["samples"] == [0.3, 0.1, 0.2, 0.4, 0.5]
+
+
+def test_login_and_transfer(tmp_path, monkeypatch):
+    (tmp_path / "bin").mkdir()
+    for name in ("squeue", "sinfo"):
+        (tmp_path / "bin" / name).write_text("#!/bin/sh\n")
+        (tmp_path / "bin" / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+    remote = Remote("localhost", connection=LocalConnection())
+    out = io.StringIO()
+    bench = Benchmark(host="localhost", repeat=3, out=out)
+    bench.login(remote)
+    bench.transfer(remote, size=1)
+    assert list(bench.results) == ["noop", "squeue", "sinfo", "put", "get"]
+    assert bench.results["put"]["unit"] == "MiB/s"
+    assert len(bench.results["get"]["samples"]) == 3
+    # The transferred file is removed
+    assert list((tmp_path / ".milatools/bench").iterdir()) == []
+    assert "noop" in out.getvalue()
+
+    path = bench.save(tmp_path / "results.json")
+    report = json.loads(path.read_text())
+    assert report["host"] == "localhost"
+    assert report["phases"]["noop"]["n"] == 3
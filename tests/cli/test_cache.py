@@ -0,0 +1,70 @@
+import pytest
+
+from milatools.cli.cache import RemoteCache, cache_enabled
+from milatools.cli.remote import Remote
+
+from .common import LocalConnection
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.delenv("MILATOOLS_NO_CACHE", raising=False)
+    return tmp_path
+
+
+def test_get_set(cache_home):
+    cache = RemoteCache("mila", "bob")
+    assert cache.get("home") is None
+    cache.set("home", "/home/bob")
+    assert cache.get("home") == "/home/bob"
+    assert (cache_home / "milatools" / "bob@mila.json").exists()
+    # Other hosts and users have their own cache
+    assert RemoteCache("mila", "alice").get("home") is None
+    assert RemoteCache("other", "bob").get("home") is None
+
+
+def test_ttl(monkeypatch):
+    cache = RemoteCache("mila", "bob")
+    cache.set("home", "/home/bob")
+    assert cache.get("home", ttl=10) == "/home/bob"
+    monkeypatch.setattr("time.time", lambda t=__import__("time").time(): t + 11)
+    assert cache.get("home", ttl=10) is None
+
+
+def test_invalidate():
+    cache = RemoteCache("mila", "bob")
+    cache.set("profiles", ["a.bash"])
+    cache.set("programs:a", ["python"])
+    cache.set("programs:b", ["python"])
+    cache.invalidate("programs:")
+    assert cache.get("profiles") == ["a.bash"]
+    assert cache.get("programs:a") is None
+    cache.invalidate()
+    assert cache.get("profiles") is None
+
+
+def test_get_or_set_disabled():
+    cache = RemoteCache("mila", "bob")
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get_or_set("x", compute) == 1
+    assert cache.get_or_set("x", compute) == 1
+    token = cache_enabled.set(False)
+    try:
+        assert cache.get_or_set("x", compute) == 2
+    finally:
+        cache_enabled.reset(token)
+    assert cache.get_or_set("x", compute) == 2
+
+
+def test_remote_home(monkeypatch):
+    monkeypatch.setenv("HOME", "/home/bob")
+    remote = Remote("localhost", connection=LocalConnection())
+    assert remote.home() == "/home/bob"
+    monkeypatch.setenv("HOME", "/somewhere/else")
+    assert remote.home() == "/home/bob"
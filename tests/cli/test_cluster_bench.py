@@ -0,0 +1,259 @@
+"""Benchmarks of mila commands against a fake cluster on localhost.
+
+The cluster is a FakeSSHServer with fake Slurm commands on its PATH, so the
+benchmarks run offline. Set MILATOOLS_BENCH_LATENCY to the round trip time
+to simulate (0.02s by default) and MILATOOLS_BENCH_QUEUE_DELAY to the time
+jobs wait in the queue (0.1s by default). The number of round trips of each
+command is saved in the extra_info of the benchmark, and checked against a
+budget so that regressions are caught.
+"""
+
+import io
+import os
+import shutil
+import sys
+import time
+import webbrowser
+
+import paramiko
+import pytest
+from prompt_toolkit.application import create_app_session
+
+from milatools.cli import commands
+from milatools.cli.remote import Remote, SlurmRemote
+
+from . import fake_slurm
+from .fake_sshd import FakeSSHServer
+
+pytest.importorskip("pytest_benchmark")
+
+latency = float(os.environ.get("MILATOOLS_BENCH_LATENCY", "0.02"))
+queue_delay = float(os.environ.get("MILATOOLS_BENCH_QUEUE_DELAY", "0.1"))
+
+ssh_config = """\
+Host mila
+    HostName 127.0.0.1
+    Port {port}
+    User bench
+
+Host *.server.mila.quebec
+    User bench
+"""
+
+# Serves HTTP on the socket given with --sock, like jupyter lab does
+fake_jupyter = """#!{python}
+import http.server, os, secrets, socketserver, sys
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    do_GET = do_HEAD
+
+    def address_string(self):
+        return "local"
+
+class Server(socketserver.UnixStreamServer):
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+sock = sys.argv[sys.argv.index("--sock") + 1]
+if os.path.exists(sock):
+    os.unlink(sock)
+server = Server(sock, Handler)
+print(f"http://localhost:8888/lab?token={{secrets.token_hex(24)}}", flush=True)
+server.serve_forever()
+"""
+
+
+class FakeCluster:
+    """A FakeSSHServer reachable as the "mila" host, with a fake Slurm."""
+
+    def __init__(self, server, home, slurm_dir):
+        self.server = server
+        self.home = home
+        self.slurm_dir = slurm_dir
+
+    @property
+    def stats(self):
+        return self.server.stats
+
+    def round_trips(self):
+        return sum(self.server.stats.values())
+
+    def cancel_all(self):
+        jobids = [p.stem for p in (self.slurm_dir / "jobs").glob("*.json")]
+        if jobids:
+            fake_slurm.scancel(jobids)
+
+    def reset(self):
+        """Forget the jobs, the servers and the local cache of the previous run."""
+        self.cancel_all()
+        shutil.rmtree(self.home / ".milatools" / "control", ignore_errors=True)
+        shutil.rmtree(os.environ["XDG_CACHE_HOME"], ignore_errors=True)
+        self.server.reset()
+
+
+@pytest.fixture
+def fake_cluster(tmp_path_factory, monkeypatch):
+    """Run the mila commands against a fake cluster on localhost.
+
+    The local ssh config points "mila" to a FakeSSHServer whose home
+    directory has a "bench" profile, jupyter, and the fake Slurm commands.
+    """
+    root = tmp_path_factory.mktemp("cluster")
+    home = root / "home"
+    local_home = root / "local"
+    slurm_dir = root / "slurm"
+    remote_bin = root / "bin"
+    for d in [home / ".milatools" / "profiles", local_home / ".ssh", slurm_dir]:
+        d.mkdir(parents=True)
+    (home / ".milatools" / "profiles" / "bench.bash").write_text("# bench profile\n")
+    fake_slurm.install(remote_bin)
+    for name in ["jupyter", "jupyter-lab"]:
+        (remote_bin / name).write_text(fake_jupyter.format(python=sys.executable))
+        (remote_bin / name).chmod(0o755)
+
+    key = paramiko.RSAKey.generate(2048)
+    key.write_private_key_file(str(local_home / ".ssh" / "id_rsa"))
+    monkeypatch.setenv("HOME", str(local_home))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(root / "cache"))
+    monkeypatch.delenv("SSH_AUTH_SOCK", raising=False)
+    monkeypatch.delenv("MILATOOLS_NO_CACHE", raising=False)
+    monkeypatch.setenv("MILATOOLS_NO_DAEMON", "1")
+    # Commands forward stdin, which pytest does not allow to read
+    monkeypatch.setattr(sys, "stdin", io.StringIO())
+
+    env = {
+        "PATH": f"{remote_bin}:{os.environ['PATH']}",
+        "FAKE_SLURM_DIR": str(slurm_dir),
+        "FAKE_SLURM_DELAY": str(queue_delay),
+    }
+    with FakeSSHServer(home, env=env, latency=latency) as server:
+        (local_home / ".ssh" / "config").write_text(ssh_config.format(port=server.port))
+        monkeypatch.setenv("FAKE_SLURM_DIR", str(slurm_dir))
+        cluster = FakeCluster(server, home, slurm_dir)
+        try:
+            yield cluster
+        finally:
+            cluster.cancel_all()
+
+
+def mila(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["mila", *argv])
+    # questionary's output would otherwise keep writing to this test's stdout
+    with create_app_session():
+        commands.main()
+
+
+def run_benchmark(benchmark, cluster, fn, budget):
+    """Benchmark fn and check that it takes at most budget round trips."""
+    trips = []
+
+    def target():
+        fn()
+        trips.append(cluster.round_trips())
+
+    benchmark.pedantic(target, setup=cluster.reset, rounds=3, iterations=1)
+    benchmark.extra_info["round_trips"] = trips[-1]
+    benchmark.extra_info["requests"] = dict(cluster.stats)
+    assert max(trips) <= budget
+
+
+def test_fake_cluster(fake_cluster):
+    remote = Remote("mila")
+    assert remote.get_output("echo $HOME") == str(fake_cluster.home)
+    remote.puttext("hello", "hello.txt")
+    assert (fake_cluster.home / "hello.txt").read_text() == "hello"
+    proc, results = remote.with_bash().extract(
+        "salloc -J test",
+        patterns={
+            "jobid": "Granted job allocation ([0-9]+)",
+            "node_name": "Nodes ([^ ]+) are ready",
+        },
+    )
+    assert results["node_name"] == "cn-a001"
+    jobid = results["jobid"]
+    assert remote.get_output("squeue -h -o '%i %T %N'") == f"{jobid} RUNNING cn-a001"
+    assert remote.get_output(f"srun --jobid {jobid} hostname") == "cn-a001"
+    proc.kill()
+    assert fake_cluster.stats["connect"] == 1
+    assert fake_cluster.stats["exec"] == 5
+    assert fake_cluster.stats["sftp"] == 1
+
+
+def test_run_stage(fake_cluster, monkeypatch, capfd):
+    (fake_cluster.home / "data").mkdir()
+    (fake_cluster.home / "data" / "0.txt").write_text("zero\n")
+    wait = 'while [ ! -e "$MILATOOLS_STAGED" ]; do sleep 0.05; done'
+    with pytest.raises(SystemExit) as exc:
+        mila(monkeypatch, "run", "--stage", "data", f"{wait}; cat $SLURM_TMPDIR/data/*")
+    assert exc.value.code == 0
+    out, err = capfd.readouterr()
+    assert "zero" in out
+    assert "Staging done" in out + err
+
+
+def test_allocation_stage(fake_cluster):
+    (fake_cluster.home / "data").mkdir()
+    (fake_cluster.home / "data" / "0.txt").write_text("zero\n")
+    remote = Remote("mila")
+    cnode = SlurmRemote(
+        connection=remote.connection, alloc=["-J", "test"], stage=[("data", "data")]
+    )
+    data, proc = cnode.ensure_allocation()
+    try:
+        (jobdir,) = (fake_cluster.slurm_dir / "tmp").iterdir()
+        for _ in range(100):
+            if (jobdir / ".milatools-staged").exists():
+                break
+            time.sleep(0.05)
+        assert (jobdir / "data" / "0.txt").read_text() == "zero\n"
+    finally:
+        proc.kill()
+
+
+def test_serve_list(benchmark, fake_cluster, monkeypatch, capsys):
+    def serve_list():
+        mila(monkeypatch, "serve", "list")
+
+    # connect, then the control files and squeue in one command
+    run_benchmark(benchmark, fake_cluster, serve_list, budget=2)
+
+
+def test_serve_lab_persist(benchmark, fake_cluster, monkeypatch, capsys):
+    # The benchmark ends when the browser would open
+    def open_browser(url):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(webbrowser, "open", open_browser)
+
+    def serve_lab():
+        mila(monkeypatch, "serve", "lab", "--persist", "--profile", "bench")
+
+    # Two connections (login and node), the preflight, the control file, the
+    # submission, and the forwarded socket
+    run_benchmark(benchmark, fake_cluster, serve_lab, budget=8)
+    assert "Ready in" in capsys.readouterr().out
+
+
+def test_code(benchmark, fake_cluster, monkeypatch, tmp_path, capsys):
+    editor = tmp_path / "code"
+    editor.write_text("#!/bin/sh\n")
+    editor.chmod(0o755)
+    monkeypatch.setenv("MILATOOLS_CODE_COMMAND", str(editor))
+
+    # The benchmark ends when the editor is closed
+    def close(*args):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr("builtins.input", close)
+
+    def code():
+        mila(monkeypatch, "code", "project")
+
+    # connect, then salloc and $HOME concurrently
+    run_benchmark(benchmark, fake_cluster, code, budget=3)
+    assert "Ended session on 'cn-a001'" in capsys.readouterr().out
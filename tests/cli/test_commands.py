@@ -0,0 +1,56 @@
+from milatools.cli.commands import (
+    _parse_control_dump,
+    _preflight,
+    dump_control_files,
+)
+from milatools.cli.remote import Remote
+
+from .common import LocalConnection
+
+
+def test_dump_control_files(tmp_path, monkeypatch):
+    control = tmp_path / ".milatools" / "control"
+    control.mkdir(parents=True)
+    (control / "jupyter-lab").write_text("jobid = 1234\nnode_name = cn-a001\n")
+    (control / "nojob").write_text("program = aim")
+    monkeypatch.chdir(tmp_path)
+
+    remote = Remote("localhost", connection=LocalConnection())
+    (dump,) = remote.run_batch([dump_control_files])
+    assert _parse_control_dump(dump.stdout) == {
+        "jupyter-lab": {"jobid": "1234", "node_name": "cn-a001"},
+        "nojob": {"program": "aim"},
+    }
+
+
+def test_preflight(tmp_path, monkeypatch):
+    profiles = tmp_path / ".milatools" / "profiles"
+    profiles.mkdir(parents=True)
+    (profiles / "a.bash").write_text("# profile a\n")
+    (profiles / "b.bash").write_text("# profile b\n")
+    (tmp_path / "project").mkdir()
+    (tmp_path / "project" / ".milatools-profile").write_text(
+        "~/.milatools/profiles/b.bash"
+    )
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.delenv("MILATOOLS_NO_CACHE", raising=False)
+    monkeypatch.chdir(tmp_path)
+
+    remote = Remote("localhost", connection=LocalConnection())
+    facts = _preflight(remote, "~/project", None, "sh", {}, sockets=True)
+    assert facts == {
+        "home": str(tmp_path),
+        "preferred": "~/.milatools/profiles/b.bash",
+        "contents": "# profile b",
+        "profiles": [str(profiles / "a.bash"), str(profiles / "b.bash")],
+    }
+    assert (tmp_path / ".milatools" / "sockets").is_dir()
+
+    facts = _preflight(remote, "~", "~/.milatools/profiles/a.bash", "sh", {})
+    assert facts["contents"] == "# profile a"
+    assert facts["which"].strip().endswith("/sh")
+    assert "preferred" not in facts
+
+    facts = _preflight(remote, "~", "~/.milatools/profiles/c.bash", "sh", {})
+    assert facts["contents"] is None
@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+from milatools.cli.control import (
+    create_control_record,
+    encode_record,
+    kill_record_command,
+    parse_control_record,
+    update_control_record,
+    with_control_file,
+)
+from milatools.cli.remote import Remote
+
+from .common import LocalConnection
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return Remote("localhost", connection=LocalConnection())
+
+
+def _read(tmp_path, name):
+    return parse_control_record((tmp_path / ".milatools/control" / name).read_text())
+
+
+def test_create(remote, tmp_path):
+    assert create_control_record(remote, ".milatools/control/x", {"program": "aim"})
+    assert _read(tmp_path, "x") == {"program": "aim"}
+    assert not create_control_record(remote, ".milatools/control/x", {"a": 1})
+    assert _read(tmp_path, "x") == {"program": "aim"}
+    # No temporary files are left behind
+    assert [p.name for p in (tmp_path / ".milatools/control").iterdir()] == ["x"]
+
+
+def test_update_compare_and_swap(remote, tmp_path):
+    pth = ".milatools/control/x"
+    old = {"program": "aim"}
+    new = {"program": "aim", "node_name": "cn-a001", "to_forward": 1234}
+    create_control_record(remote, pth, old)
+    assert update_control_record(remote, pth, old, new)
+    assert _read(tmp_path, "x") == new
+    # old is no longer the current value, so this must fail
+    assert not update_control_record(remote, pth, old, {"program": "oops"})
+    assert _read(tmp_path, "x") == new
+    assert json.loads((tmp_path / pth).read_text()) == new
+
+
+def test_with_control_file(remote, tmp_path):
+    with with_control_file(remote, name="lab", record={"program": "jupyter-lab"}):
+        assert _read(tmp_path, "lab") == {"program": "jupyter-lab"}
+        with pytest.raises(SystemExit):
+            with with_control_file(remote, name="lab"):
+                pass
+
+
+def test_with_control_file_released(remote, tmp_path):
+    # Nothing was recorded, e.g. the server did not start: the name is free
+    with pytest.raises(SystemExit):
+        with with_control_file(remote, name="lab", record={"program": "lab"}):
+            raise SystemExit("Exit: lab did not start.")
+    assert not (tmp_path / ".milatools/control/lab").exists()
+    # A server was recorded, so the record is kept
+    with pytest.raises(KeyboardInterrupt):
+        with with_control_file(remote, name="lab", record={"program": "lab"}) as pth:
+            update_control_record(remote, pth, {"program": "lab"}, {"jobid": "1"})
+            raise KeyboardInterrupt()
+    assert _read(tmp_path, "lab") == {"jobid": "1"}
+
+
+def test_parse_legacy_record():
+    assert parse_control_record("jobid = 1\nto_forward = a = b\n") == {
+        "jobid": "1",
+        "to_forward": "a = b",
+    }
+
+
+@pytest.mark.parametrize(
+    "record", [encode_record({"jobid": "1234", "program": "lab"}), "jobid = 1234\n"]
+)
+def test_kill_record(remote, tmp_path, monkeypatch, record):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "scancel").write_text(f'#!/bin/sh\necho "$@" > {tmp_path}/cancelled\n')
+    (bin_dir / "scancel").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    pth = tmp_path / ".milatools/control/lab"
+    pth.parent.mkdir(parents=True)
+    pth.write_text(record)
+    assert remote.run(kill_record_command(".milatools/control/lab"), hide=True).ok
+    assert (tmp_path / "cancelled").read_text() == "1234\n"
+    assert not pth.exists()
+    # There is nothing left to kill
+    result = remote.run(
+        kill_record_command(".milatools/control/lab"), warn=True, hide=True
+    )
+    assert not result.ok
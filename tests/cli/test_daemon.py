@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+from fabric import Connection
+from invoke.exceptions import UnexpectedExit
+
+from milatools.cli.daemon import Daemon, DaemonConnection, daemon_request
+from milatools.cli.remote import QueueIO, Remote, StreamReader, close_when_done
+
+from .common import LocalConnection
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    # LocalConnection has the same interface as fabric.Connection, so the
+    # "remote" commands simply run on the local machine.
+    d = Daemon(path=tmp_path / "daemon.sock", connect=lambda host: LocalConnection())
+    thread = threading.Thread(target=d.serve, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if d.path.exists():
+            break
+        time.sleep(0.01)
+    yield d
+    daemon_request(d.path, op="shutdown")
+    thread.join()
+
+
+def test_run(daemon):
+    conn = DaemonConnection("fake", daemon.path)
+    result = conn.run("echo hello && echo world >&2", hide=True)
+    assert result.stdout == "hello\n"
+    assert result.stderr == "world\n"
+    assert result.exited == 0
+
+
+def test_run_failure(daemon):
+    conn = DaemonConnection("fake", daemon.path)
+    with pytest.raises(UnexpectedExit):
+        conn.run("exit 3", hide=True)
+    assert conn.run("exit 3", hide=True, warn=True).exited == 3
+
+
+def test_remote_through_daemon(daemon):
+    remote = Remote("fake", connection=DaemonConnection("fake", daemon.path))
+    assert remote.get_output("echo $((1 + 2))", hide=True) == "3"
+
+
+def test_asynchronous_kill(daemon):
+    conn = DaemonConnection("fake", daemon.path)
+    qio = QueueIO()
+    proc = conn.run("echo start && exec sleep 60", asynchronous=True, out_stream=qio)
+    lines = qio.readlines(lambda: proc.runner.process_is_finished)
+    assert next(lines) == "start\n"
+    proc.runner.kill()
+    assert proc.runner.process_is_finished or proc.finished.wait(10)
+
+
+def test_close_when_done(daemon):
+    conn = DaemonConnection("fake", daemon.path)
+    reader = StreamReader()
+    proc = conn.run("echo hello", asynchronous=True, out_stream=reader, hide=True)
+    close_when_done(proc.runner, reader)
+    # Without close(), this would never stop
+    assert list(reader.readlines()) == ["hello\n"]
+
+
+def test_status(daemon):
+    DaemonConnection("fake", daemon.path).run("true", hide=True)
+    reply = daemon_request(daemon.path, op="ping")
+    assert reply["hosts"] == {"fake": {"connected": True, "sessions": 0}}
+
+
+def test_waiting_for_session(daemon, capsys):
+    daemon.max_sessions = 1
+    conn = DaemonConnection("busy", daemon.path)
+    proc = conn.run("sleep 1", hide=True, asynchronous=True)
+    time.sleep(0.2)
+    assert conn.run("echo done", hide=True).stdout == "done\n"
+    proc.join()
+    # The second command tells why it does not start right away
+    assert "Waiting for one of the 1 sessions on busy" in capsys.readouterr().err
+
+
+def test_socket_permissions(daemon):
+    # Nobody else may connect to the daemon
+    assert daemon.path.stat().st_mode & 0o077 == 0
+
+
+def test_connection_resolves_host(daemon, tmp_path, monkeypatch):
+    (tmp_path / ".ssh").mkdir()
+    (tmp_path / ".ssh" / "config").write_text(
+        "Host mila\n  HostName login.example.org\n  User bob\n"
+    )
+    monkeypatch.setenv("HOME", str(tmp_path))
+    conn = DaemonConnection("mila", daemon.path)
+    assert (conn.host, conn.original_host, conn.user) == (
+        "login.example.org",
+        "mila",
+        "bob",
+    )
+    # The cache is the same whether or not the daemon is running
+    through_daemon = Remote("mila", connection=conn)
+    direct = Remote("mila", connection=Connection("mila"))
+    assert through_daemon.cache.path == direct.cache.path
+    # The daemon is asked for the host by the name it was given
+    assert conn.run("true", hide=True).ok
+    assert "mila" in daemon.status()
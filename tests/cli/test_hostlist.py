@@ -0,0 +1,83 @@
+import pytest
+from hypothesis import example, given, strategies as st
+
+from milatools.cli.hostlist import Hostlist, compress, count, expand, first
+
+node_names = st.builds(
+    lambda prefix, n, width, suffix: f"{prefix}{n:0{width}d}{suffix}",
+    st.sampled_from(["cn-a", "cn-b", "cn-c", "kepler", "rtx"]),
+    st.integers(min_value=0, max_value=2000),
+    st.integers(min_value=1, max_value=4),
+    st.sampled_from(["", "-ib"]),
+)
+names_lists = st.lists(node_names | st.sampled_from(["login", "cn-x"]), max_size=60)
+
+
+@pytest.mark.parametrize(
+    "hostlist,expected",
+    [
+        ("cn-a001", ["cn-a001"]),
+        ("cn-a[001-003]", ["cn-a001", "cn-a002", "cn-a003"]),
+        (
+            "cn-a[001-002,010],cn-b[01-02]",
+            ["cn-a001", "cn-a002", "cn-a010", "cn-b01", "cn-b02"],
+        ),
+        ("cn-a[8-11]", ["cn-a8", "cn-a9", "cn-a10", "cn-a11"]),
+        ("cn-a[08-11]", ["cn-a08", "cn-a09", "cn-a10", "cn-a11"]),
+        ("r[1-2]n[1-2]", ["r1n1", "r1n2", "r2n1", "r2n2"]),
+        ("cn-c001,rtx8", ["cn-c001", "rtx8"]),
+        ("", []),
+    ],
+)
+def test_expand(hostlist, expected):
+    assert list(expand(hostlist)) == expected
+    assert count(hostlist) == len(expected)
+
+
+@pytest.mark.parametrize(
+    "hostlist", ["cn-a[001-003", "cn-a001]", "cn-a[3-1]", "cn-a[x]", "cn-a[[1]]"]
+)
+def test_expand_invalid(hostlist):
+    with pytest.raises(ValueError):
+        list(expand(hostlist))
+
+
+def test_expand_is_lazy():
+    names = expand("cn-a[000000000-999999999]")
+    assert next(names) == "cn-a000000000"
+    assert first("cn-a[000000000-999999999]") == "cn-a000000000"
+    assert count("cn-a[000000000-999999999]") == 10**9
+
+
+@given(names_lists)
+def test_compress_roundtrip(names):
+    assert set(expand(compress(names))) == set(names)
+
+
+@given(names_lists)
+def test_compress_no_duplicates(names):
+    expanded = list(expand(compress(names)))
+    assert len(expanded) == len(set(expanded))
+
+
+@given(names_lists)
+@example(["cn-b000-ib", "login", "cn-b0-ib", "cn-b100-ib"])
+def test_compress_idempotent(names):
+    once = compress(names)
+    assert compress(expand(once)) == once
+
+
+@given(names_lists, names_lists)
+def test_set_operations(a, b):
+    ha, hb = Hostlist(a), Hostlist(b)
+    assert set(ha | hb) == set(a) | set(b)
+    assert set(ha & hb) == set(a) & set(b)
+    assert set(ha - hb) == set(a) - set(b)
+    assert all(name in ha for name in a)
+
+
+def test_hostlist_str():
+    nodes = Hostlist(["cn-a003", "cn-a001", "cn-a002", "cn-a001"])
+    assert str(nodes) == "cn-a[001-003]"
+    assert len(nodes) == 3
+    assert nodes == Hostlist("cn-a[001-003]")
@@ -0,0 +1,64 @@
+import pytest
+
+from milatools.cli.matcher import PatternMatcher
+
+server_patterns = {
+    "node_name": "#### ([A-Za-z0-9_-]+)",
+    "port": "Listening at: http://[^:]+:([0-9]+)",
+    "token": r"\?token=([a-f0-9]+)",
+    "batch_id": "^Submitted batch job ([0-9]+)",
+}
+
+
+def test_first_match_wins():
+    m = PatternMatcher(server_patterns)
+    assert m.feed("Submitted batch job 1234") == {"batch_id": "1234"}
+    assert m.feed("Submitted batch job 5678") == {}
+    assert m.feed("#### cn-a001") == {"node_name": "cn-a001"}
+    assert not m.done
+    m.feed("http://localhost:8888/lab?token=abc123")
+    assert m.feed("[INFO] Listening at: http://127.0.0.1:5000 (42)") == {"port": "5000"}
+    assert m.done
+    assert m.results == {
+        "batch_id": "1234",
+        "node_name": "cn-a001",
+        "token": "abc123",
+        "port": "5000",
+    }
+
+
+def test_collect_all():
+    m = PatternMatcher({"job": "job ([0-9]+)", "word": "[a-z]+ing"}, mode="all")
+    for line in ["job 1 running", "nothing", "job 2", "job 3 pending"]:
+        m.feed(line)
+    assert m.results == {
+        "job": ["1", "2", "3"],
+        "word": ["running", "nothing", "pending"],
+    }
+
+
+def test_overlapping_patterns():
+    # Both patterns match at the same position
+    m = PatternMatcher(
+        {
+            "jobid": "Submitted batch job ([0-9]+)",
+            "batch_id": "^Submitted batch job ([0-9]+)",
+        }
+    )
+    assert m.feed("Submitted batch job 42") == {"jobid": "42", "batch_id": "42"}
+
+
+def test_groups():
+    m = PatternMatcher({"a": "(x)(y)(z)", "b": "b=([0-9]+)", "c": "c=[0-9]+"})
+    assert m.search("b=12 c=34 xyz") == {"b": "12", "c": "c=34", "a": "x"}
+
+
+def test_pattern_without_literal():
+    # Nothing can be used to prefilter lines for this one
+    m = PatternMatcher({"port": "port ([0-9]+)", "double": r"(\w)\1"})
+    assert m.feed("port 80 boo") == {"port": "80", "double": "o"}
+
+
+def test_bad_mode():
+    with pytest.raises(ValueError):
+        PatternMatcher({}, mode="some")
@@ -0,0 +1,118 @@
+import os
+import subprocess
+
+import pytest
+
+from milatools.cli.pool import Pool, member_command, pool_dir, pool_tag
+from milatools.cli.remote import Remote
+
+from .common import LocalConnection
+
+fake_squeue = """#!/bin/sh
+case "$*" in
+    *"%i %T %k"*) cat squeue.txt ;;
+    *) cut -d' ' -f1 squeue.txt ;;
+esac
+"""
+
+fake_logger = """#!/bin/sh
+echo "$(basename $0) $*" >> slurm.log
+"""
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    for name, script in [
+        ("squeue", fake_squeue),
+        ("sbatch", fake_logger),
+        ("scancel", fake_logger),
+    ]:
+        (bin / name).write_text(script)
+        (bin / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin}:{os.environ['PATH']}")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.delenv("MILATOOLS_NO_CACHE", raising=False)
+    monkeypatch.chdir(tmp_path)
+    return Remote("localhost", connection=LocalConnection())
+
+
+def _squeue(tmp_path, *members):
+    (tmp_path / "squeue.txt").write_text("".join(f"{m}\n" for m in members))
+
+
+def _log(tmp_path):
+    log = tmp_path / "slurm.log"
+    return log.read_text().splitlines() if log.exists() else []
+
+
+def test_start(remote, tmp_path):
+    alloc = ["--gres=gpu:1"]
+    other = pool_tag(["-c", "4"])
+    _squeue(tmp_path, f"10 PENDING {other}", f"11 RUNNING {pool_tag(alloc)}")
+    assert Pool(remote).start(alloc, size=3, idle=60) == 2
+    assert (tmp_path / pool_dir / "member.sh").exists()
+    log = _log(tmp_path)
+    assert log[0] == "scancel 10"
+    assert log[1:] == [log[1]] * 2
+    assert log[1].startswith(f"sbatch -J mila-pool --comment {pool_tag(alloc)}")
+    assert Pool(remote).config == {"alloc": alloc, "size": 3, "idle": 60}
+
+
+def test_claim(remote, tmp_path):
+    alloc = ["--gres=gpu:1"]
+    tag = pool_tag(alloc)
+    _squeue(tmp_path, f"10 PENDING {tag}", f"11 RUNNING {tag}", f"12 RUNNING {tag}")
+    pool = Pool(remote)
+    # There is no pool yet
+    assert pool.claim(alloc) is None
+    pool.start(alloc, size=3, idle=60)
+    assert _log(tmp_path) == []
+
+    # Members allocated with other options are never claimed
+    assert pool.claim(["-c", "4"]) is None
+    assert pool.claim(alloc) == "11"
+    pool.topup.result()
+    assert len(_log(tmp_path)) == 1
+    assert pool.claim(alloc) == "12"
+    pool.topup.result()
+    # The pending member is not claimed
+    assert pool.claim(alloc) is None
+    assert sorted(p.name for p in (tmp_path / pool_dir).glob("claimed-*")) == [
+        "claimed-11",
+        "claimed-12",
+    ]
+    assert [state for _, state, _ in pool.members()] == [
+        "PENDING",
+        "CLAIMED",
+        "CLAIMED",
+    ]
+
+
+def test_stop(remote, tmp_path):
+    alloc = []
+    tag = pool_tag(alloc)
+    _squeue(tmp_path, f"10 PENDING {tag}", f"11 RUNNING {tag}")
+    pool = Pool(remote)
+    pool.start(alloc, size=2, idle=60)
+    assert pool.claim(alloc) == "11"
+    pool.topup.result()
+    # Claimed members are not cancelled
+    assert pool.stop() == ["10"]
+    assert _log(tmp_path)[-1] == "scancel 10"
+    assert pool.config is None
+    assert not (tmp_path / pool_dir / "config").exists()
+
+
+def test_member_expires(tmp_path):
+    (tmp_path / pool_dir).mkdir(parents=True)
+    proc = subprocess.run(
+        ["bash", "-c", member_command.format(pool_dir=pool_dir, idle=0)],
+        cwd=tmp_path,
+        env={"SLURM_JOB_ID": "13", "PATH": "/usr/bin:/bin"},
+        timeout=10,
+    )
+    assert proc.returncode == 0
+    # The member claimed itself so that nobody else can
+    assert (tmp_path / pool_dir / "claimed-13").is_dir()
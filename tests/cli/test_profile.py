@@ -1,13 +1,23 @@
 import functools
+import os
 from contextlib import contextmanager
 from unittest.mock import patch
 
 import pytest
 from prompt_toolkit.input.defaults import create_pipe_input
 
-from milatools.cli.profile import _ask_name, qn
+from milatools.cli.profile import (
+    Discovery,
+    ProgramIndex,
+    _ask_name,
+    check_program,
+    conda_environments,
+    modules_signal,
+    qn,
+)
+from milatools.cli.remote import Remote
 
-from .common import output_tester
+from .common import LocalConnection, output_tester
 
 
 @pytest.mark.skip(reason="Test does not appear to be fully deterministic")
@@ -31,3 +41,124 @@ def test__ask_name(capsys, file_regression):
         return (None, None)
 
     output_tester(_test, capsys, file_regression)
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    # which that logs its calls and only knows the programs in bin
+    (bin / "which").write_text(
+        f'#!/bin/sh\necho "$*" >> {tmp_path}/which.log\n'
+        f'for p in "$@"; do [ -x {bin}/$p ] && echo {bin}/$p; done\n'
+    )
+    (bin / "pip").write_text("#!/bin/sh\n")
+    for p in bin.iterdir():
+        p.chmod(0o755)
+    (tmp_path / "profile.bash").write_text("module load python\n")
+    monkeypatch.setenv("PATH", f"{bin}:{os.environ['PATH']}")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.delenv("MILATOOLS_NO_CACHE", raising=False)
+    return Remote("localhost", connection=LocalConnection())
+
+
+def _check(remote, tmp_path):
+    profile = tmp_path / "profile.bash"
+    return check_program(
+        remote, str(profile), "lab", {"pip": "pip install lab"}, profile.read_text()
+    )
+
+
+def _which_calls(tmp_path):
+    return len((tmp_path / "which.log").read_text().splitlines())
+
+
+def test_check_program_index(remote, tmp_path):
+    # A missing program is checked every time
+    assert _check(remote, tmp_path) == (f"{tmp_path}/bin/pip\n", False)
+    assert _check(remote, tmp_path) == (f"{tmp_path}/bin/pip\n", False)
+    assert _which_calls(tmp_path) == 2
+
+    (tmp_path / "bin" / "lab").write_text("#!/bin/sh\n")
+    (tmp_path / "bin" / "lab").chmod(0o755)
+    output, indexed = _check(remote, tmp_path)
+    assert not indexed
+    assert _check(remote, tmp_path) == (output, True)
+    assert _which_calls(tmp_path) == 3
+
+    # The entry is ignored once the profile changes
+    (tmp_path / "profile.bash").write_text("module load python/3.10\n")
+    assert _check(remote, tmp_path) == (output, False)
+    assert _check(remote, tmp_path) == (output, True)
+    assert _which_calls(tmp_path) == 4
+
+
+def test_check_program_invalidate(remote, tmp_path):
+    (tmp_path / "bin" / "lab").write_text("#!/bin/sh\n")
+    (tmp_path / "bin" / "lab").chmod(0o755)
+    _check(remote, tmp_path)
+    assert _check(remote, tmp_path)[1]
+    ProgramIndex(remote, str(tmp_path / "profile.bash")).invalidate()
+    assert not _check(remote, tmp_path)[1]
+
+
+def test_discovery(remote, tmp_path):
+    data = tmp_path / "data.txt"
+    data.write_text("a b")
+    log = tmp_path / "slow.log"
+
+    def discovery():
+        return Discovery(
+            remote,
+            "test",
+            command=f"echo slow >> {log} && cat {data}",
+            signal=f"stat -c %Y {data}",
+            parse=lambda stdout, stderr: stdout.split(),
+        )
+
+    assert discovery().value() == ["a", "b"]
+    assert discovery().start().value() == ["a", "b"]
+    assert log.read_text() == "slow\n"
+
+    # The command runs again once the signal changes
+    data.write_text("c")
+    os.utime(data, (0, 0))
+    assert discovery().value() == ["c"]
+    assert log.read_text() == "slow\nslow\n"
+
+
+def test_conda_environments_loader(remote, tmp_path):
+    conda = tmp_path / "bin" / "conda"
+    conda.write_text('#!/bin/sh\necho "{\\"envs\\": [\\"$ENVS\\"]}"\n')
+    conda.chmod(0o755)
+
+    # Each module that provides conda has its own cache entry
+    assert conda_environments(remote, "export ENVS=/a").value() == ["/a"]
+    assert conda_environments(remote, "export ENVS=/b").value() == ["/b"]
+    assert conda_environments(remote, "export ENVS=/a").value() == ["/a"]
+
+
+def test_modules_signal(tmp_path):
+    modules = tmp_path / "modules"
+    cache = tmp_path / "cache"
+    (modules / "pytorch").mkdir(parents=True)
+    cache.mkdir()
+    (cache / "spiderT.lua").write_text("")
+    (tmp_path / "lmodrc.lua").write_text(
+        f'scDescriptT = {{ {{ dir = "{cache}", timestamp = "{tmp_path}/stamp" }} }}\n'
+    )
+    (tmp_path / "stamp").write_text("")
+    env = {
+        "MODULEPATH": str(modules),
+        "LMOD_SPIDER_CACHE_DIRS": str(cache),
+        "LMOD_RC": str(tmp_path / "lmodrc.lua"),
+    }
+
+    def signal():
+        return LocalConnection().run(modules_signal, hide=True, env=env).stdout
+
+    # A new version of a module, or a rebuilt spider cache, change the signal
+    for path in [modules / "pytorch", cache / "spiderT.lua", tmp_path / "stamp"]:
+        before = signal()
+        os.utime(path, (0, 0))
+        assert signal() != before
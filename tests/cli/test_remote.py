@@ -1,4 +1,21 @@
-from milatools.cli.remote import QueueIO, get_first_node_name
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from milatools.cli.remote import (
+    PrefixWriter,
+    QueueIO,
+    Remote,
+    SlurmRemote,
+    StreamReader,
+    get_first_node_name,
+)
+from milatools.cli.utils import MilatoolsUserError
+
+from .common import LocalConnection
 
 
 def test_QueueIO(file_regression):
@@ -37,3 +54,194 @@ def test_get_first_node_name(file_regression):
             )
         )
     )
+
+
+def test_run_batch():
+    remote = Remote("localhost", connection=LocalConnection())
+    results = remote.run_batch(
+        [
+            "echo hello",
+            "printf 'no newline'; echo oops >&2; exit 3",
+            "cd /; pwd",
+            "pwd",
+        ]
+    )
+    assert [r.stdout for r in results] == [
+        "hello\n",
+        "no newline",
+        "/\n",
+        f"{os.getcwd()}\n",
+    ]
+    assert [r.stderr for r in results] == ["", "oops\n", "", ""]
+    assert [r.exited for r in results] == [0, 3, 0, 0]
+    assert not results[1].ok
+    assert remote.run_batch([]) == []
+
+
+def test_run_async():
+    remote = Remote("localhost", connection=LocalConnection())
+    future = remote.run_async("echo hello", hide=True)
+    assert future.result().stdout == "hello\n"
+
+
+def test_StreamReader_line_endings():
+    reader = StreamReader()
+    reader.write("a\r\nprogress 1\rprogress 2\rdone\nunfinished")
+    assert list(reader.readlines(lambda: True)) == [
+        "a\r\n",
+        "progress 1\r",
+        "progress 2\r",
+        "done\n",
+        "unfinished",
+    ]
+
+
+def test_StreamReader_split_crlf():
+    reader = StreamReader()
+    reader.write("a\r")
+    reader.write("\nb\n")
+    reader.close()
+    assert list(reader.readlines()) == ["a\r\n", "b\n"]
+
+
+def test_StreamReader_max_line_length():
+    reader = StreamReader(max_line_length=4)
+    reader.write("abcdefghij\nxy\n")
+    reader.close()
+    assert list(reader.readlines()) == ["abcd", "efgh", "ij\n", "xy\n"]
+
+
+def test_StreamReader_blocks_until_line():
+    reader = StreamReader()
+    lines = reader.readlines()
+
+    def writer():
+        time.sleep(0.1)
+        reader.write("hel")
+        time.sleep(0.1)
+        reader.write("lo\nrest")
+        reader.close()
+
+    threading.Thread(target=writer).start()
+    start = time.time()
+    assert next(lines) == "hello\n"
+    assert time.time() - start < StreamReader.stop_check_interval + 0.15
+    assert list(lines) == ["rest"]
+
+
+def test_extract_notices_end_of_output(monkeypatch):
+    # The reader is closed when the command ends, without waiting for a poll
+    monkeypatch.setattr(StreamReader, "stop_check_interval", 10)
+    remote = Remote("fake", connection=LocalConnection())
+    start = time.time()
+    proc, results = remote.extract("echo done", patterns={}, hide=True)
+    assert time.time() - start < 5
+    assert proc.process_is_finished
+
+
+def test_StreamReader_long_unterminated_output():
+    # This used to be quadratic in the size of the output
+    reader = StreamReader()
+    start = time.time()
+    for _ in range(10_000):
+        reader.write("x" * 1000)
+    reader.close()
+    lines = list(reader.readlines())
+    assert time.time() - start < 5
+    assert sum(map(len, lines)) == 10_000_000
+
+
+def test_PrefixWriter():
+    out = io.StringIO()
+    writer = PrefixWriter("[cn-a001] ", out, threading.Lock())
+    writer.write("one\r\ntw")
+    assert out.getvalue() == "[cn-a001] one\n"
+    writer.write("o\nthree")
+    writer.close()
+    assert out.getvalue() == "[cn-a001] one\n[cn-a001] two\n[cn-a001] three\n"
+
+
+def test_fan_out(tmp_path, monkeypatch):
+    # Fake srun that runs the command locally, as if it were on the -w node
+    (tmp_path / "srun").write_text(
+        "#!/bin/bash\n"
+        'while [ "$1" != bash ]; do\n'
+        '  if [ "$1" = -w ]; then export SLURMD_NODENAME=$2; fi\n'
+        "  shift\n"
+        "done\n"
+        'exec "$@"\n'
+    )
+    (tmp_path / "squeue").write_text("#!/bin/bash\necho 'cn-a[001-003],cn-b01'\n")
+    for name in ("srun", "squeue"):
+        (tmp_path / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+    remote = SlurmRemote(connection=LocalConnection(), alloc=[], jobid="1234")
+    out = io.StringIO()
+    codes = remote.fan_out(
+        'echo hello from $SLURMD_NODENAME; [ "$SLURMD_NODENAME" != cn-a002 ]',
+        max_parallel=2,
+        out=out,
+    )
+    assert codes == {"cn-a001": 0, "cn-a002": 1, "cn-a003": 0, "cn-b01": 0}
+    assert sorted(out.getvalue().splitlines()) == [
+        "[cn-a001] hello from cn-a001",
+        "[cn-a002] hello from cn-a002",
+        "[cn-a003] hello from cn-a003",
+        "[cn-b01] hello from cn-b01",
+    ]
+
+
+def test_fan_out_pending(tmp_path, monkeypatch):
+    # squeue shows no nodes for a pending job
+    (tmp_path / "squeue").write_text("#!/bin/bash\necho\n")
+    (tmp_path / "squeue").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    remote = SlurmRemote(connection=LocalConnection(), alloc=[], jobid="1234")
+    with pytest.raises(MilatoolsUserError, match="Job 1234 has no nodes"):
+        remote.fan_out("true")
+
+
+def test_existing_job(tmp_path, monkeypatch):
+    (tmp_path / "squeue").write_text("#!/bin/bash\necho 'cn-a[001-003]'\n")
+    (tmp_path / "squeue").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+    remote = SlurmRemote(connection=LocalConnection(), alloc=[], jobid="1234")
+    assert remote.srun_transform("hostname") == (
+        "srun --jobid 1234 --overlap bash -c hostname"
+    )
+    data, proc = remote.ensure_allocation()
+    assert data == {"node_name": "cn-a001", "jobid": "1234"}
+    assert proc.jobid == "1234"
+
+
+def test_persist_inline(tmp_path, monkeypatch):
+    # Fake sbatch that runs the script it reads on stdin in the background
+    (tmp_path / "sbatch").write_text(
+        "#!/bin/bash\n"
+        'echo "$@" > sbatch-args.txt\n'
+        "cat > batch.sh\n"
+        "echo 'Submitted batch job 42'\n"
+        "out=$(sed -n 's/^#SBATCH --output=//p' batch.sh)\n"
+        'bash batch.sh > "$out" 2>&1 &\n'
+    )
+    (tmp_path / "sbatch").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+
+    connection = LocalConnection()
+    # Nothing is uploaded
+    connection.put = None
+    remote = SlurmRemote(connection=connection, alloc=["-c", "2"]).persist()
+    proc, results = remote.extract(
+        "echo 'port' $((1000 + 234))",
+        patterns={"port": "port ([0-9]+)"},
+        hide=True,
+    )
+    proc.kill()
+    assert results == {"batch_id": "42", "port": "1234"}
+    assert (tmp_path / "sbatch-args.txt").read_text() == "-c 2\n"
+    assert (
+        "#SBATCH --output=.milatools/batch/out-" in (tmp_path / "batch.sh").read_text()
+    )
@@ -0,0 +1,123 @@
+import os
+import subprocess
+import sys
+
+from milatools.cli.stage import helper, parse_stage, stage_script
+
+
+def _stage(tmp_path, venv, tmpdir=None):
+    """Source a staging profile for venv, and return the prefix of its python."""
+    env = {**os.environ, "HOME": str(tmp_path / "home")}
+    env.pop("SLURM_TMPDIR", None)
+    if tmpdir is not None:
+        tmpdir.mkdir(exist_ok=True)
+        env["SLURM_TMPDIR"] = str(tmpdir)
+    script = (
+        f"{helper}\nmilatools_stage venv {venv} && "
+        'echo "$VIRTUAL_ENV" && head -n 1 "$VIRTUAL_ENV/bin/tool" && '
+        "python -c 'import sys; print(sys.prefix)'"
+    )
+    return subprocess.run(
+        ["bash", "-c", script], env=env, capture_output=True, text=True, check=True
+    ).stdout.split()
+
+
+def test_stage_venv(tmp_path):
+    venv = tmp_path / "venv"
+    subprocess.run([sys.executable, "-m", "venv", "--without-pip", venv], check=True)
+    (venv / "bin" / "tool").write_text(f"#!{venv}/bin/python\n")
+
+    # Outside of a job, the environment is used in place
+    assert _stage(tmp_path, venv) == [str(venv), f"#!{venv}/bin/python", str(venv)]
+
+    node = tmp_path / "node1"
+    dest, shebang, prefix = _stage(tmp_path, venv, node)
+    assert dest.startswith(f"{node}/env-")
+    assert shebang == f"#!{dest}/bin/python"
+    assert prefix == dest
+
+    # The pack is reused by the other jobs until the packages change
+    (pack,) = (tmp_path / "home" / ".milatools" / "packs").glob("*/*.tar.gz")
+    assert _stage(tmp_path, venv, tmp_path / "node2")[0].startswith(
+        f"{tmp_path}/node2/env-"
+    )
+    assert list(pack.parent.glob("*.tar.gz")) == [pack]
+    site_packages = next((venv / "lib").glob("python*/site-packages"))
+    (site_packages / "new.pth").write_text("")
+    _stage(tmp_path, venv, tmp_path / "node3")
+    (new_pack,) = pack.parent.glob("*.tar.gz")
+    assert new_pack != pack
+
+
+def test_stage_venv_concurrent(tmp_path):
+    venv = tmp_path / "venv"
+    subprocess.run([sys.executable, "-m", "venv", "--without-pip", venv], check=True)
+    (venv / "bin" / "tool").write_text(f"#!{venv}/bin/python\n")
+    env = {**os.environ, "HOME": str(tmp_path / "home")}
+    script = f"{helper}\nmilatools_stage venv {venv} && echo $VIRTUAL_ENV"
+    procs = []
+    # Jobs on different nodes, that only share the home directory
+    for i in range(4):
+        node = tmp_path / f"node{i}"
+        node.mkdir()
+        procs.append(
+            subprocess.Popen(
+                ["bash", "-c", script],
+                env={**env, "SLURM_TMPDIR": str(node)},
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+        )
+    outputs = [proc.communicate() for proc in procs]
+    for i, (out, err) in enumerate(outputs):
+        assert out.startswith(f"{tmp_path}/node{i}/env-")
+    # The environment was packed once, for all of them
+    assert sum(err.count("Packing") for _, err in outputs) == 1
+
+
+def test_stage_script(tmp_path):
+    (tmp_path / "data" / "train").mkdir(parents=True)
+    (tmp_path / "data" / "train" / "0.txt").write_text("zero")
+    (tmp_path / "labels.txt").write_text("cat\n")
+    node = tmp_path / "node"
+    node.mkdir()
+    stages = [
+        parse_stage(f"{tmp_path}/data"),
+        parse_stage(f"{tmp_path}/labels.txt:meta/labels.txt"),
+    ]
+    script = (
+        f"{stage_script(stages)}"
+        'while [ ! -e "$MILATOOLS_STAGED" ]; do sleep 0.05; done\n'
+        'cat "$SLURM_TMPDIR/data/train/0.txt" "$SLURM_TMPDIR/meta/labels.txt"'
+    )
+    env = {**os.environ, "SLURM_TMPDIR": str(node)}
+
+    def run():
+        return subprocess.run(
+            ["bash", "-c", script], env=env, capture_output=True, text=True
+        )
+
+    result = run()
+    assert result.stdout == "zerocat\n"
+    assert "Staging done" in result.stderr
+
+    # The copies are only made once per job
+    (node / "data" / "train" / "0.txt").write_text("copied")
+    result = run()
+    assert result.stdout == "copiedcat\n"
+    assert "Staging" not in result.stderr
+
+
+def test_stage_script_separate_lock(tmp_path):
+    # Unpacking an environment does not delay or prevent the copies
+    (tmp_path / "data").mkdir()
+    node = tmp_path / "node"
+    node.mkdir()
+    script = (
+        f"exec 8> {node}/.milatools-stage.lock; flock 8\n"
+        f"{stage_script([parse_stage(f'{tmp_path}/data')])}"
+        'while [ ! -e "$MILATOOLS_STAGED" ]; do sleep 0.05; done'
+    )
+    env = {**os.environ, "SLURM_TMPDIR": str(node)}
+    subprocess.run(["bash", "-c", script], env=env, check=True, timeout=10)
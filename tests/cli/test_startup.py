@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from milatools.cli.utils import running_on_mila
+
+# Modules that only some commands need and that are slow to import
+heavy_modules = [
+    "fabric",
+    "paramiko",
+    "invoke",
+    "questionary",
+    "prompt_toolkit",
+    "blessed",
+    "sshconf",
+]
+
+# Time spent importing milatools itself, excluding coleo, in microseconds
+startup_budget = 200_000
+
+
+def _import_times(*argv, env):
+    """Run mila with -X importtime and return {module: cumulative time}."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "milatools.cli", *argv],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    assert proc.returncode == 0, proc.stderr
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.fixture
+def env(tmp_path):
+    return {**os.environ, "XDG_CACHE_HOME": str(tmp_path)}
+
+
+@pytest.mark.parametrize("argv", [["--version"], ["docs", "--help"]])
+def test_startup_budget(argv, env):
+    times = _import_times(*argv, env=env)
+    imported = [mod for mod in heavy_modules if mod in times]
+    assert not imported
+    # coleo and codefind, which it imports lazily, are needed to parse argv
+    own = times["milatools.cli.commands"] - times["coleo"] - times.get("codefind", 0)
+    assert own < startup_budget
+
+
+def test_running_on_mila(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.delenv("MILATOOLS_NO_CACHE", raising=False)
+    calls = []
+
+    def getfqdn():
+        calls.append(1)
+        return "cn-a001.server.mila.quebec"
+
+    monkeypatch.setattr("socket.gethostname", lambda: "cn-a001")
+    monkeypatch.setattr("socket.getfqdn", getfqdn)
+    assert running_on_mila()
+    assert running_on_mila()
+    # The slow lookup is only done once
+    assert len(calls) == 1
+
+    monkeypatch.setattr("socket.gethostname", lambda: "laptop.example.com")
+    assert not running_on_mila()
+    assert len(calls) == 1
@@ -0,0 +1,70 @@
+import io
+import json
+
+from milatools.cli.remote import Remote
+from milatools.cli.trace import Span, Tracer, span, tracing
+
+from .common import LocalConnection
+
+
+def test_disabled():
+    with span("run", "mila", command="true") as s:
+        s.set(exit_code=0)
+
+
+def test_remote_spans(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    out = io.StringIO()
+    remote = Remote("localhost", connection=LocalConnection())
+    with tracing(path, out=out):
+        remote.with_precommand("cd /").run("echo hello", hide=True)
+        remote.run("false", hide=True, warn=True)
+        remote.extract("echo 'port 1234'", patterns={"port": "port ([0-9]+)"})
+        remote.puttext("hello", str(tmp_path / "hello.txt"))
+    events = [json.loads(line) for line in path.read_text().splitlines()]
+    runs = [e for e in events if e["kind"] == "run"]
+    assert runs[0]["command"] == "cd / && echo hello"
+    assert runs[0]["transforms"] == ["{} && {{}}".format("cd /")]
+    assert runs[0]["exit_code"] == 0
+    assert runs[0]["bytes"] == len("hello\n")
+    assert runs[1]["exit_code"] == 1
+    extract = [e for e in events if e["kind"] == "extract"]
+    assert extract[0]["found"] == ["port"]
+    put = [e for e in events if e["kind"] == "put"]
+    assert put[0]["bytes"] == len("hello")
+    assert all(e["duration"] >= 0 for e in events)
+
+    summary = out.getvalue()
+    assert f"Trace written to {path}" in summary
+    assert "Round trips: 5" in summary
+    assert "Critical path:" in summary
+
+
+def test_chrome_trace(tmp_path):
+    path = tmp_path / "trace.json"
+    with tracing(path, out=io.StringIO()):
+        with span("run", "mila", command="hostname"):
+            pass
+    trace = json.loads(path.read_text())
+    (event,) = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+    assert event["name"] == "run mila"
+    assert event["args"]["command"] == "hostname"
+    assert event["dur"] >= 0
+
+
+def _span(kind, start, end):
+    s = Span(kind, "mila", {})
+    s.start, s.end = start, end
+    return s
+
+
+def test_critical_path():
+    tracer = Tracer()
+    connect = _span("connect", 0, 1)
+    which = _span("run", 1, 2)
+    home = _span("run", 1, 1.5)
+    salloc = _span("extract", 2, 10)
+    forward = _span("forward", 10, 11)
+    for s in [home, salloc, connect, forward, which]:
+        tracer.add(s)
+    assert tracer.critical_path() == [connect, which, salloc, forward]
@@ -0,0 +1,277 @@
+import socket
+import socketserver
+import threading
+import time
+
+import paramiko
+import pytest
+
+from milatools.cli.daemon import Daemon, DaemonConnection, daemon_request
+from milatools.cli.tunnel import Forwarder, Proxy, open_forwarder, proxy_pac
+
+
+class EchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            data = self.request.recv(1024)
+            if not data:
+                break
+            self.request.sendall(data)
+
+
+class SSHServer(paramiko.ServerInterface):
+    """Accepts anyone, and forwards the streamlocal channels to unix_path."""
+
+    def __init__(self, unix_path):
+        self.unix_path = unix_path
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return "none"
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "direct-streamlocal@openssh.com":
+            self.destinations[chanid] = self.unix_path
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+def _pipe(src, dst):
+    while True:
+        data = src.recv(1024)
+        if not data:
+            break
+        dst.sendall(data)
+    if isinstance(dst, paramiko.Channel):
+        dst.shutdown_write()
+    else:
+        dst.shutdown(socket.SHUT_WR)
+
+
+def _serve_ssh(sock, server):
+    transport = paramiko.Transport(sock)
+    transport.add_server_key(paramiko.RSAKey.generate(1024))
+    transport.start_server(server=server)
+    while True:
+        chan = transport.accept()
+        if chan is None:
+            break
+        dest = server.destinations[chan.get_id()]
+        if isinstance(dest, str):
+            target = socket.socket(socket.AF_UNIX)
+            target.connect(dest)
+        else:
+            target = socket.create_connection(dest)
+        threading.Thread(target=_pipe, args=(chan, target), daemon=True).start()
+        threading.Thread(target=_pipe, args=(target, chan), daemon=True).start()
+
+
+@pytest.fixture
+def ssh_transport(tmp_path):
+    unix_path = str(tmp_path / "echo.sock")
+    unix_echo = socketserver.ThreadingUnixStreamServer(unix_path, EchoHandler)
+    tcp_echo = socketserver.ThreadingTCPServer(("localhost", 0), EchoHandler)
+    for server in (unix_echo, tcp_echo):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    client_sock, server_sock = socket.socketpair()
+    threading.Thread(
+        target=_serve_ssh, args=(server_sock, SSHServer(unix_path)), daemon=True
+    ).start()
+    transport = paramiko.Transport(client_sock)
+    transport.start_client()
+    transport.auth_none("user")
+    yield transport, tcp_echo.server_address[1]
+    transport.close()
+    for server in (unix_echo, tcp_echo):
+        server.shutdown()
+        server.server_close()
+
+
+def _echo(port, data):
+    with socket.create_connection(("localhost", port), timeout=10) as sock:
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        received = b""
+        while True:
+            chunk = sock.recv(1024)
+            if not chunk:
+                return received
+            received += chunk
+
+
+def test_forward_tcp_and_unix(ssh_transport, tmp_path):
+    transport, echo_port = ssh_transport
+    forwarder = Forwarder(transport)
+    try:
+        tcp_port = forwarder.forward(("localhost", echo_port))
+        unix_port = forwarder.forward(str(tmp_path / "echo.sock"))
+        assert tcp_port != unix_port
+        assert _echo(tcp_port, b"hello") == b"hello"
+        assert _echo(unix_port, b"world" * 100_000) == b"world" * 100_000
+    finally:
+        forwarder.close()
+        forwarder.join(5)
+    assert forwarder.closed.is_set()
+
+
+def test_forward_concurrent_connections(ssh_transport):
+    transport, echo_port = ssh_transport
+    forwarder = Forwarder(transport)
+    port = forwarder.forward(("localhost", echo_port))
+    results = {}
+
+    def run(i):
+        results[i] = _echo(port, f"message {i}".encode())
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    forwarder.close()
+    assert results == {i: f"message {i}".encode() for i in range(10)}
+
+
+def test_forward_slow_reader(ssh_transport):
+    transport, echo_port = ssh_transport
+    forwarder = Forwarder(transport)
+    port = forwarder.forward(("localhost", echo_port))
+    data = b"x" * 20_000_000
+
+    def send():
+        slow.sendall(data)
+        slow.shutdown(socket.SHUT_WR)
+
+    # This client does not read the echoes for now, so they pile up
+    slow = socket.create_connection(("localhost", port), timeout=10)
+    threading.Thread(target=send, daemon=True).start()
+    time.sleep(2)
+    try:
+        # Other connections are still relayed meanwhile
+        for i in range(3):
+            assert _echo(port, f"message {i}".encode()) == f"message {i}".encode()
+        received = bytearray()
+        while len(received) < len(data):
+            chunk = slow.recv(1 << 20)
+            if not chunk:
+                break
+            received += chunk
+        assert received == data
+    finally:
+        slow.close()
+        forwarder.close()
+
+
+def test_forwarder_closes_with_transport(ssh_transport):
+    transport, _ = ssh_transport
+    forwarder = Forwarder(transport)
+    closed = threading.Event()
+    forwarder.add_done_callback(closed.set)
+    transport.close()
+    assert closed.wait(5)
+
+
+def _proxy(transport, **kwargs):
+    forwarder = Forwarder(transport)
+    resolve = {"echo-node": "localhost"}.get
+    port = forwarder.proxy(Proxy(resolve=resolve, **kwargs))
+    return forwarder, port
+
+
+def test_socks5_proxy(ssh_transport):
+    transport, echo_port = ssh_transport
+    forwarder, port = _proxy(transport)
+    with socket.create_connection(("localhost", port)) as sock:
+        sock.sendall(b"\x05\x01\x00")
+        assert sock.recv(2) == b"\x05\x00"
+        host = b"echo-node"
+        sock.sendall(
+            b"\x05\x01\x00\x03"
+            + bytes([len(host)])
+            + host
+            + echo_port.to_bytes(2, "big")
+        )
+        assert sock.recv(10)[:2] == b"\x05\x00"
+        sock.sendall(b"ping")
+        assert sock.recv(4) == b"ping"
+    forwarder.close()
+
+
+def test_http_connect_proxy(ssh_transport):
+    transport, echo_port = ssh_transport
+    forwarder, port = _proxy(transport, pac=proxy_pac(1234, [".example.com"]))
+    with socket.create_connection(("localhost", port)) as sock:
+        sock.sendall(f"CONNECT echo-node:{echo_port} HTTP/1.1\r\n\r\n".encode())
+        assert sock.recv(1024).startswith(b"HTTP/1.1 200")
+        sock.sendall(b"ping")
+        assert sock.recv(4) == b"ping"
+    with socket.create_connection(("localhost", port)) as sock:
+        sock.sendall(b"GET /proxy.pac HTTP/1.1\r\n\r\n")
+        response = sock.recv(4096)
+        assert b'dnsDomainIs(host, ".example.com")' in response
+        assert b"SOCKS5 localhost:1234" in response
+    forwarder.close()
+
+
+def test_proxy_no_http(ssh_transport):
+    transport, echo_port = ssh_transport
+    forwarder, port = _proxy(transport, http=False)
+    with socket.create_connection(("localhost", port)) as sock:
+        sock.sendall(f"CONNECT echo-node:{echo_port} HTTP/1.1\r\n\r\n".encode())
+        try:
+            response = sock.recv(1024)
+        except ConnectionResetError:
+            # The connection is closed with our request unread
+            response = b""
+        assert response == b""
+    forwarder.close()
+
+
+class TransportConnection:
+    """Stand-in for the daemon's fabric.Connection, on an existing transport."""
+
+    def __init__(self, transport, gateway=None):
+        self.transport = transport
+        self.gateway = gateway
+
+
+def test_forward_through_daemon(ssh_transport, tmp_path):
+    transport, echo_port = ssh_transport
+    connections = {}
+
+    def connect(host, gateway=None):
+        connections[host] = TransportConnection(transport, gateway)
+        return connections[host]
+
+    d = Daemon(path=tmp_path / "daemon.sock", connect=connect)
+    thread = threading.Thread(target=d.serve, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if d.path.exists():
+            break
+        time.sleep(0.01)
+    try:
+        login = DaemonConnection("mila", d.path)
+        for host in ["mila", "cn-a001"]:
+            forwarder = open_forwarder(host, login)
+            try:
+                tcp_port = forwarder.forward(("localhost", echo_port))
+                unix_port = forwarder.forward(str(tmp_path / "echo.sock"))
+                assert _echo(tcp_port, b"hello") == b"hello"
+                assert _echo(unix_port, b"world" * 100_000) == b"world" * 100_000
+            finally:
+                forwarder.close()
+                forwarder.join(5)
+        # The daemon connected to the compute node through the login node
+        assert connections["cn-a001"].gateway is connections["mila"]
+    finally:
+        daemon_request(d.path, op="shutdown")
+        thread.join()
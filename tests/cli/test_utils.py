@@ -3,9 +3,10 @@ import random
 from unittest.mock import patch
 
 import pytest
+import questionary as qn
 from prompt_toolkit.input.defaults import create_pipe_input
 
-from milatools.cli.utils import qn, randname, yn
+from milatools.cli.utils import randname, yn
 
 
 def test_randname(file_regression):